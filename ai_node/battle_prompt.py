@@ -0,0 +1,64 @@
+# 戰鬥敘事提示詞範本：由精簡的對戰參數（matchup）渲染出送給 LLM 的提示詞。
+# 此檔案與 ai_node/battle_prompt.py 內容必須一致 —— 聚合器只傳送 matchup，節點在本機渲染，
+# 本地回退生成時也用同一份範本，確保兩邊送給 LLM 的提示詞逐字相同。
+#
+# matchup 格式（版本 1）：
+# {
+#   "v": 1,
+#   "seed": 戰鬥種子,
+#   "hp": 初始血量,
+#   "fighters": [
+#     {"id", "name", "desc", "skill", "str", "agi", "luk", "dmg": [下限, 上限], "crit", "dodge"},
+#     ...（共兩位，索引 0 為角色1）
+#   ],
+#   "log": [[攻擊者索引, 動作, 傷害, 防守方剩餘血量], ...],
+#   "winner": 勝者索引
+# }
+from typing import Dict
+
+MATCHUP_VERSION = 1
+SUPPORTED_MATCHUP_VERSIONS = (1,)
+
+LABELS = 'AB'
+
+
+class MatchupError(ValueError):
+    """matchup 版本不支援或內容不完整"""
+
+
+def render_prompt(matchup: Dict) -> str:
+    """把 matchup 渲染成精簡（無縮排）的敘事提示詞"""
+    version = matchup.get('v')
+    if version not in SUPPORTED_MATCHUP_VERSIONS:
+        raise MatchupError(f'unsupported matchup version: {version}')
+    try:
+        fighters = matchup['fighters']
+        first, second = fighters
+        winner = fighters[matchup['winner']]
+        rounds = [
+            f"{i}|{LABELS[a]}→{LABELS[1 - a]}|{action}|{damage}|{remaining_hp}"
+            for i, (a, action, damage, remaining_hp) in enumerate(matchup['log'], start=1)
+        ]
+        lines = [
+            '為一場數值已決定的戰鬥撰寫敘事。',
+            '先自行想像一個極具創意、天馬行空的戰鬥地點，再為固定戰鬥日誌的每個回合撰寫具電影感的描述（環境、音效、鏡頭語言），融入場景對戰局的影響（地形、高度差、天氣、機關）。',
+            '角色：',
+            *(
+                f"{LABELS[i]} ID={f['id']} 名稱={f['name']} 力量/敏捷/幸運={f['str']}/{f['agi']}/{f['luk']}\n"
+                f"描述：{f['desc']}\n特殊能力：{f['skill']}"
+                for i, f in enumerate((first, second))
+            ),
+            f"固定戰鬥日誌（初始血量 {matchup['hp']}；回合|攻擊者→防守者|動作|傷害|防守者剩餘血量）：",
+            *rounds,
+            '規則：',
+            '1.battle_log 與日誌逐回合一一對應，回合數與順序相同。',
+            '2.attacker、defender 填入對應角色的 ID；damage、remaining_hp 原樣照抄。',
+            '3.action 可改寫為具體招式名稱；damage 為 0 代表攻擊被閃避。',
+            f"4.description 生動描寫該回合，可用擬聲詞，並使用角色名稱（{first['name']}、{second['name']}）。",
+            '5.運用角色的特殊能力，至少一次「招牌技能」的戲劇性演出。',
+            f"6.winner 必須填入：{winner['id']}",
+            '7.battle_description 總結整場戰鬥。',
+        ]
+    except (KeyError, IndexError, TypeError, ValueError) as e:
+        raise MatchupError(f'malformed matchup: {e}') from e
+    return '\n'.join(lines)
@@ -0,0 +1,99 @@
+# 戰鬥結果驗證與修補：檢查 LLM 輸出是否與 matchup 的固定戰鬥日誌一致（回合數、攻防雙方、傷害、剩餘血量、勝者）。
+# 此檔案與 ai_node/battle_verifier.py 內容必須一致 —— 節點在回應前先驗證並修補自己的輸出，
+# 聚合器對未回報驗證結果的舊版節點做同樣的檢查。matchup 格式見 battle_prompt.py。
+from typing import Dict, List
+
+# 問題類型；STRUCTURAL 代表敘事本身不完整，時間允許時應重新生成，其餘可直接修補
+ROUND_COUNT = 'round_count'
+MISSING_DESCRIPTION = 'missing_description'
+WRONG_FIGHTER = 'wrong_fighter'
+WRONG_DAMAGE = 'wrong_damage'
+WRONG_HP = 'wrong_hp'
+WRONG_WINNER = 'wrong_winner'
+MALFORMED = 'malformed'
+
+STRUCTURAL = {ROUND_COUNT, MISSING_DESCRIPTION, MALFORMED}
+
+
+def expected_log(matchup: Dict) -> List[Dict]:
+    """由 matchup 還原權威的逐回合數值"""
+    fighters = matchup['fighters']
+    return [
+        {
+            'attacker': fighters[a]['id'],
+            'defender': fighters[1 - a]['id'],
+            'action': action,
+            'damage': damage,
+            'remaining_hp': remaining_hp,
+        }
+        for a, action, damage, remaining_hp in matchup['log']
+    ]
+
+
+def verify_result(result: Dict, matchup: Dict) -> List[str]:
+    """回傳結果與固定戰鬥日誌不一致之處（問題類型，不重複）；空清單代表通過"""
+    if not isinstance(result, dict) or not isinstance(result.get('battle_log'), list):
+        return [MALFORMED]
+
+    issues = []
+    expected = expected_log(matchup)
+    log = result['battle_log']
+    if len(log) != len(expected):
+        issues.append(ROUND_COUNT)
+    for entry, truth in zip(log, expected):
+        if not isinstance(entry, dict):
+            issues.append(MALFORMED)
+            continue
+        if not str(entry.get('description') or '').strip():
+            issues.append(MISSING_DESCRIPTION)
+        if str(entry.get('attacker')) != truth['attacker'] or str(entry.get('defender')) != truth['defender']:
+            issues.append(WRONG_FIGHTER)
+        if entry.get('damage') != truth['damage']:
+            issues.append(WRONG_DAMAGE)
+        if entry.get('remaining_hp') != truth['remaining_hp']:
+            issues.append(WRONG_HP)
+    if str(result.get('winner')) != matchup['fighters'][matchup['winner']]['id']:
+        issues.append(WRONG_WINNER)
+    return list(dict.fromkeys(issues))
+
+
+def needs_retry(issues: List[str]) -> bool:
+    """敘事不完整（缺回合、缺描述、格式錯誤）時值得重新生成"""
+    return any(issue in STRUCTURAL for issue in issues)
+
+
+def _default_description(attacker: str, defender: str, action: str, damage: int, remaining_hp: int) -> str:
+    if damage == 0:
+        return f"{defender} 閃過了 {attacker} 的攻擊！"
+    return f"{attacker} 發動{action}，對 {defender} 造成 {damage} 點傷害（剩餘 {remaining_hp}）"
+
+
+def repair_result(result: Dict, matchup: Dict) -> Dict:
+    """
+    以固定戰鬥日誌修補結果：數值與勝者一律照 matchup，逐回合保留 LLM 的 action 與 description，
+    缺少的回合補上預設描述、多出的回合捨棄
+    """
+    names = {fighter['id']: fighter['name'] for fighter in matchup['fighters']}
+    narrated = result.get('battle_log') if isinstance(result, dict) else None
+    narrated = narrated if isinstance(narrated, list) else []
+
+    battle_log = []
+    for i, truth in enumerate(expected_log(matchup)):
+        story = narrated[i] if i < len(narrated) and isinstance(narrated[i], dict) else {}
+        description = str(story.get('description') or '').strip() or _default_description(
+            names[truth['attacker']], names[truth['defender']],
+            truth['action'], truth['damage'], truth['remaining_hp'],
+        )
+        battle_log.append({
+            **truth,
+            'action': str(story.get('action') or truth['action']),
+            'description': description,
+        })
+
+    winner = matchup['fighters'][matchup['winner']]
+    battle_description = str(result.get('battle_description') or '') if isinstance(result, dict) else ''
+    return {
+        'winner': winner['id'],
+        'battle_log': battle_log,
+        'battle_description': battle_description or f"經過 {len(battle_log)} 次交鋒，{winner['name']} 最終獲得了勝利！",
+    }
@@ -0,0 +1,249 @@
+# LLM 後端：戰鬥敘事與角色屬性生成透過這個介面呼叫 LLM，由環境變數 LLM_BACKEND 選擇實作。
+# 此檔案與 ai_node/llm_backend.py 內容必須一致 —— 節點與聚合器（本地回退、角色屬性）共用同一套後端。
+#
+#   gemini（預設）：Google Gemini API
+#   stub：不連網的確定性假 LLM，依提示詞產生符合 BattleResult 結構的結果，可設定延遲分佈、
+#         錯誤率與格式錯誤率，用於在單機上重複地壓測共識、驗證與回退流程
+#
+# stub 的設定：
+#   LLM_STUB_LATENCY        平均延遲秒數（預設 0.5）
+#   LLM_STUB_LATENCY_DIST   fixed / uniform（0 ~ 2 倍平均）/ exponential / lognormal（預設 fixed）
+#   LLM_STUB_LATENCY_SIGMA  lognormal 的 sigma（預設 0.5）
+#   LLM_STUB_ERROR_RATE     呼叫失敗（拋出 LLMError）的機率
+#   LLM_STUB_MALFORMED_RATE 回傳格式錯誤結果的機率（無法解析、缺回合、數值錯誤）
+#   LLM_STUB_SEED           隨機種子；同一提示詞（與請求種子）的第 n 次呼叫結果固定
+#
+# generate_json / agenerate_json 的 seed 是請求的種子（通常為戰鬥引擎種子）：Gemini 以它作為取樣種子，
+# stub 把它併入自己的 random.Random，兩者都不使用行程全域的 random 狀態
+import asyncio
+import hashlib
+import json
+import math
+import os
+import random
+import re
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+DEFAULT_MODEL = 'gemini-2.0-flash'
+
+# stub 會從 battle_prompt.render_prompt 渲染的提示詞中讀出角色與固定戰鬥日誌
+_FIGHTER_RE = re.compile(r'^([AB]) ID=(\S+) 名稱=(.*?) 力量/敏捷/幸運=', re.MULTILINE)
+_ROUND_RE = re.compile(r'^\d+\|([AB])→([AB])\|(.*)\|(-?\d+)\|(-?\d+)$', re.MULTILINE)
+_WINNER_RE = re.compile(r'winner 必須填入：(\S+)')
+_RANGE_RE = re.compile(r'(\d+)~(\d+)的整數')
+
+MALFORMED_KINDS = ('unparseable', 'missing_rounds', 'wrong_numbers')
+
+
+class LLMError(RuntimeError):
+    """stub 模擬的 LLM 呼叫失敗"""
+
+
+class LLMBackend:
+    name = 'base'
+
+    def generate_json(self, prompt: str, schema=None, seed: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        """結構化輸出：回傳符合 schema 的 dict，無法解析時回傳 None，呼叫失敗時拋出例外"""
+        raise NotImplementedError
+
+    async def agenerate_json(self, prompt: str, schema=None, seed: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        return await asyncio.to_thread(self.generate_json, prompt, schema, seed)
+
+    def generate_text(self, prompt: str) -> str:
+        raise NotImplementedError
+
+    async def aclose(self):
+        pass
+
+
+class GeminiBackend(LLMBackend):
+    name = 'gemini'
+
+    def __init__(self, api_key: Optional[str] = None, model: str = DEFAULT_MODEL):
+        # 匯入 google.genai 需要數秒，只在實際使用 Gemini 時才匯入
+        from google import genai
+
+        api_key = api_key or os.getenv('GEMINI_API_KEY')
+        if not api_key:
+            raise ValueError("GEMINI_API_KEY 環境變數未設定。")
+        self.model = model
+        self.client = genai.Client(api_key=api_key)
+
+    def _json_config(self, schema, seed):
+        config = {"response_mime_type": "application/json"}
+        if schema is not None:
+            config["response_schema"] = schema
+        if seed is not None:
+            # Gemini 的取樣種子為 32 位元整數
+            config["seed"] = seed % 2 ** 31
+        return config
+
+    @staticmethod
+    def _parsed(response):
+        parsed = response.parsed
+        if not parsed:
+            return None
+        return parsed.model_dump() if hasattr(parsed, 'model_dump') else parsed
+
+    def generate_json(self, prompt, schema=None, seed=None):
+        response = self.client.models.generate_content(
+            model=self.model, contents=prompt, config=self._json_config(schema, seed)
+        )
+        return self._parsed(response)
+
+    async def agenerate_json(self, prompt, schema=None, seed=None):
+        response = await self.client.aio.models.generate_content(
+            model=self.model, contents=prompt, config=self._json_config(schema, seed)
+        )
+        return self._parsed(response)
+
+    def generate_text(self, prompt):
+        return self.client.models.generate_content(model=self.model, contents=prompt).text
+
+    async def aclose(self):
+        aclose = getattr(self.client.aio, 'aclose', None)
+        if aclose:
+            await aclose()
+
+
+class StubBackend(LLMBackend):
+    """
+    確定性的假 LLM：以 (種子, 請求種子, 提示詞, 第幾次呼叫) 決定延遲、是否失敗與輸出，
+    因此同一提示詞在不同節點上得到相同結果（可形成共識），重試則可能得到不同結果
+    """
+    name = 'stub'
+
+    def __init__(self, latency: float = 0.5, latency_dist: str = 'fixed', latency_sigma: float = 0.5,
+                 error_rate: float = 0.0, malformed_rate: float = 0.0, seed: int = 0):
+        if latency_dist not in ('fixed', 'uniform', 'exponential', 'lognormal'):
+            raise ValueError(f"未知的延遲分佈: {latency_dist}")
+        self.latency = latency
+        self.latency_dist = latency_dist
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.malformed_rate = malformed_rate
+        self.seed = seed
+        self._calls = OrderedDict()  # (請求種子, 提示詞雜湊) -> 已呼叫次數（保留最近 10000 個）
+
+    def _rng(self, prompt: str, seed: Optional[int] = None) -> random.Random:
+        digest = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+        key = (seed, digest)
+        attempt = self._calls.pop(key, 0)
+        self._calls[key] = attempt + 1
+        if len(self._calls) > 10000:
+            self._calls.popitem(last=False)
+        return random.Random(f'{self.seed}:{seed}:{digest}:{attempt}')
+
+    def _delay(self, rng: random.Random) -> float:
+        mean = self.latency
+        if mean <= 0:
+            return 0.0
+        if self.latency_dist == 'uniform':
+            return rng.uniform(0, 2 * mean)
+        if self.latency_dist == 'exponential':
+            return rng.expovariate(1 / mean)
+        if self.latency_dist == 'lognormal':
+            sigma = self.latency_sigma
+            return rng.lognormvariate(math.log(mean) - sigma * sigma / 2, sigma)
+        return mean
+
+    def _plan(self, prompt: str, seed: Optional[int] = None):
+        """決定這次呼叫的 (延遲秒數, rng, 是否失敗, 格式錯誤類型或 None)"""
+        rng = self._rng(prompt, seed)
+        delay = self._delay(rng)
+        failed = rng.random() < self.error_rate
+        malformed = rng.choice(MALFORMED_KINDS) if rng.random() < self.malformed_rate else None
+        return delay, rng, failed, malformed
+
+    def _battle(self, prompt: str, rng: random.Random, malformed: Optional[str]) -> Optional[Dict]:
+        if malformed == 'unparseable':
+            return None
+        fighters = {label: (fighter_id, name) for label, fighter_id, name in _FIGHTER_RE.findall(prompt)}
+        battle_log = []
+        for attacker, defender, action, damage, remaining_hp in _ROUND_RE.findall(prompt):
+            attacker_id, attacker_name = fighters.get(attacker, (attacker, attacker))
+            defender_id, defender_name = fighters.get(defender, (defender, defender))
+            damage, remaining_hp = int(damage), int(remaining_hp)
+            description = (
+                f"{defender_name} 閃過了 {attacker_name} 的{action}！" if damage == 0
+                else f"{attacker_name} 施展{action}，{defender_name} 受到 {damage} 點傷害"
+            )
+            battle_log.append({
+                'attacker': attacker_id,
+                'defender': defender_id,
+                'action': action,
+                'damage': damage,
+                'description': description,
+                'remaining_hp': remaining_hp,
+            })
+        winner = _WINNER_RE.search(prompt)
+        winner = winner.group(1) if winner else next(iter(fighters.values()), ('stub',))[0]
+
+        if malformed == 'missing_rounds' and battle_log:
+            battle_log = battle_log[:rng.randrange(len(battle_log))]
+        elif malformed == 'wrong_numbers' and battle_log:
+            entry = rng.choice(battle_log)
+            entry['damage'] += rng.randint(1, 20)
+            loser = [fighter_id for fighter_id, _ in fighters.values() if fighter_id != winner]
+            winner = loser[0] if loser else winner
+        return {
+            'winner': winner,
+            'battle_log': battle_log,
+            'battle_description': f"（stub）經過 {len(battle_log)} 次交鋒，{winner} 獲得勝利。",
+        }
+
+    def _structured(self, prompt, schema, rng, malformed):
+        result = self._battle(prompt, rng, malformed)
+        if result is not None and schema is not None:
+            result = schema.model_validate(result).model_dump()
+        return result
+
+    def generate_json(self, prompt, schema=None, seed=None):
+        delay, rng, failed, malformed = self._plan(prompt, seed)
+        time.sleep(delay)
+        if failed:
+            raise LLMError("stub LLM error")
+        return self._structured(prompt, schema, rng, malformed)
+
+    async def agenerate_json(self, prompt, schema=None, seed=None):
+        delay, rng, failed, malformed = self._plan(prompt, seed)
+        await asyncio.sleep(delay)
+        if failed:
+            raise LLMError("stub LLM error")
+        return self._structured(prompt, schema, rng, malformed)
+
+    def generate_text(self, prompt):
+        """角色屬性等自由格式 JSON：數值取提示詞中的範圍"""
+        delay, rng, failed, malformed = self._plan(prompt)
+        time.sleep(delay)
+        if failed:
+            raise LLMError("stub LLM error")
+        if malformed:
+            return "（stub）這不是 JSON"
+        bounds = _RANGE_RE.search(prompt)
+        low, high = (int(bounds.group(1)), int(bounds.group(2))) if bounds else (30, 60)
+        return json.dumps({
+            'skill_description': '（stub）以確定性的力量擊倒對手',
+            'strength': rng.randint(low, high),
+            'agility': rng.randint(low, high),
+            'luck': rng.randint(low, high),
+        }, ensure_ascii=False)
+
+
+def create_backend(name: Optional[str] = None, api_key: Optional[str] = None) -> LLMBackend:
+    """依 LLM_BACKEND 建立後端；gemini 未設定 API 金鑰時拋出 ValueError"""
+    name = (name or os.getenv('LLM_BACKEND', 'gemini')).lower()
+    if name == 'gemini':
+        return GeminiBackend(api_key=api_key)
+    if name == 'stub':
+        return StubBackend(
+            latency=float(os.getenv('LLM_STUB_LATENCY', '0.5')),
+            latency_dist=os.getenv('LLM_STUB_LATENCY_DIST', 'fixed'),
+            latency_sigma=float(os.getenv('LLM_STUB_LATENCY_SIGMA', '0.5')),
+            error_rate=float(os.getenv('LLM_STUB_ERROR_RATE', '0')),
+            malformed_rate=float(os.getenv('LLM_STUB_MALFORMED_RATE', '0')),
+            seed=int(os.getenv('LLM_STUB_SEED', '0')),
+        )
+    raise ValueError(f"未知的 LLM_BACKEND: {name}")
@@ -0,0 +1,166 @@
+# AI Node load test with a stubbed LLM
+#
+# Starts the node app in-process with the stub LLM backend (llm_backend.StubBackend),
+# then for each concurrency level keeps that many
+# /generate_battle requests in flight while polling /health.
+# Throughput should scale with the concurrency level and /health latency should
+# stay flat; --blocking-stub simulates a synchronous SDK call to show the stall.
+# --log-mode sync|async|none with --log-write-delay compares logging on the event loop
+# against the background writer when the log disk is slow.
+#
+#   python load_test.py --concurrency 1 2 5 10 --requests 40 --latency 0.5
+#   python load_test.py --concurrency 10 --log-mode sync --log-write-delay 20
+import argparse
+import asyncio
+import logging
+import os
+import socket
+import statistics
+import tempfile
+import threading
+import time
+
+os.environ.setdefault('AGGREGATOR_URL', '')  # do not register with an aggregator
+os.environ.setdefault('NODE_NAME', 'load-test')
+os.environ.setdefault('LOG_DIR', os.path.join(tempfile.gettempdir(), 'ai-node-load-test'))
+
+import aiohttp
+import uvicorn
+
+import main
+from llm_backend import StubBackend
+
+
+class BlockingStubBackend(StubBackend):
+    """Sleeps on the event loop thread like a synchronous SDK call"""
+
+    async def agenerate_json(self, prompt, schema=None, seed=None):
+        return self.generate_json(prompt, schema, seed)
+
+
+def configure_logging(mode: str, write_delay: float):
+    """Re-create the node's logging in the given mode; write_delay (s) emulates a slow log disk"""
+    if mode == 'none':
+        logging.disable(logging.CRITICAL)
+        return
+    file_handler = main.setup_logging(main.log_dir, main.node_name, mode)
+    if write_delay > 0:
+        emit = file_handler.emit
+
+        def slow_emit(record):
+            time.sleep(write_delay)
+            emit(record)
+
+        file_handler.emit = slow_emit
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(port: int) -> uvicorn.Server:
+    server = uvicorn.Server(uvicorn.Config(main.app, host='127.0.0.1', port=port, log_level='warning'))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+def set_concurrency(limit: int):
+    main.max_concurrent_requests = limit
+    main.admission = main.AdmissionQueue(limit, main.MAX_QUEUE_SIZE)
+
+
+async def run_level(base_url: str, concurrency: int, total: int) -> dict:
+    health_latencies = []
+    completed = 0
+    failed = 0
+    next_index = 0
+    done = asyncio.Event()
+
+    async with aiohttp.ClientSession() as session:
+        async def worker():
+            nonlocal completed, failed, next_index
+            while next_index < total:
+                index = next_index
+                next_index += 1
+                payload = {'battle_id': f'load-{concurrency}-{index}', 'prompt': 'x' * 2000, 'seed': index}
+                async with session.post(f'{base_url}/generate_battle', json=payload) as response:
+                    await response.read()
+                    if response.status == 200:
+                        completed += 1
+                    else:
+                        failed += 1
+
+        async def health_poller():
+            while not done.is_set():
+                started = time.perf_counter()
+                async with session.get(f'{base_url}/health') as response:
+                    await response.read()
+                health_latencies.append((time.perf_counter() - started) * 1000)
+                await asyncio.sleep(0.05)
+
+        poller = asyncio.create_task(health_poller())
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+        done.set()
+        await poller
+
+    health_latencies.sort()
+    return {
+        'throughput': completed / elapsed,
+        'completed': completed,
+        'failed': failed,
+        'health_p50': statistics.median(health_latencies),
+        'health_p99': health_latencies[min(len(health_latencies) - 1, int(len(health_latencies) * 0.99))],
+        'health_max': health_latencies[-1],
+    }
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description='AI Node load test with a stubbed LLM')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 5, 10])
+    parser.add_argument('--requests', type=int, default=40, help='battles per concurrency level')
+    parser.add_argument('--latency', type=float, default=0.5, help='stub LLM latency in seconds')
+    parser.add_argument('--latency-dist', choices=['fixed', 'uniform', 'exponential', 'lognormal'],
+                        default='fixed', help='stub LLM latency distribution (mean is --latency)')
+    parser.add_argument('--error-rate', type=float, default=0, help='fraction of stub LLM calls that fail')
+    parser.add_argument('--malformed-rate', type=float, default=0,
+                        help='fraction of stub LLM calls returning malformed output')
+    parser.add_argument('--blocking-stub', action='store_true',
+                        help='stub blocks the event loop like a synchronous SDK call')
+    parser.add_argument('--log-mode', choices=['async', 'sync', 'none'], default='async',
+                        help='async: background writer thread, sync: write on the event loop, none: logging off')
+    parser.add_argument('--log-write-delay', type=float, default=0,
+                        help='extra milliseconds per log file write (slow disk)')
+    args = parser.parse_args()
+
+    configure_logging(args.log_mode, args.log_write_delay / 1000)
+    stub = BlockingStubBackend if args.blocking_stub else StubBackend
+    main.llm = stub(latency=args.latency, latency_dist=args.latency_dist,
+                    error_rate=args.error_rate, malformed_rate=args.malformed_rate)
+    port = free_port()
+    server = start_server(port)
+    base_url = f'http://127.0.0.1:{port}'
+
+    print(f"stub latency {args.latency:.2f}s, {args.requests} battles per level"
+          f"{' (blocking stub)' if args.blocking_stub else ''}, logging {args.log_mode}"
+          f"{f' (+{args.log_write_delay:g}ms per write)' if args.log_write_delay else ''}")
+    print(f"{'concurrency':>11} {'battles/s':>10} {'ideal':>7} {'failed':>9} "
+          f"{'health p50':>11} {'health p99':>11} {'health max':>11}")
+    try:
+        for concurrency in args.concurrency:
+            set_concurrency(concurrency)
+            result = asyncio.run(run_level(base_url, concurrency, args.requests))
+            print(f"{concurrency:>11} {result['throughput']:>10.2f} {concurrency / args.latency:>7.2f} "
+                  f"{result['failed']:>9} {result['health_p50']:>9.1f}ms {result['health_p99']:>9.1f}ms "
+                  f"{result['health_max']:>9.1f}ms")
+    finally:
+        server.should_exit = True
+
+
+if __name__ == '__main__':
+    main_cli()
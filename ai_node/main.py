@@ -1,64 +1,73 @@
 # AI Node FastAPI Service
-from fastapi import FastAPI, HTTPException, Depends, BackgroundTasks
+from fastapi import FastAPI, HTTPException, Depends, BackgroundTasks, Request
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel
 from typing import List, Optional
 from contextlib import asynccontextmanager
+from collections import OrderedDict
 import os
 import asyncio
 import aiohttp
+import heapq
+import itertools
+import json
+import math
 import time
 import uuid
-import random
 from datetime import datetime
 import logging
-from google import genai
-from google.genai import types
-
-# Configure logging
-import os
-from datetime import datetime
-
-# Create logs directory if it doesn't exist
-log_dir = "/app/logs"
-if not os.path.exists(log_dir):
-    os.makedirs(log_dir)
-
-# Use node name in log filename for multiple instances
+from battle_prompt import MatchupError, SUPPORTED_MATCHUP_VERSIONS, render_prompt
+from battle_verifier import needs_retry, repair_result, verify_result
+import metrics
+from llm_backend import create_backend
+from node_logging import setup_logging, stop_logging
+from node_url import UrlCache, detect_node_url
+
+# Configure logging: records are written by a background thread (see node_logging),
+# one rotating log file per node name for multiple instances
+log_dir = os.getenv('LOG_DIR', "/app/logs")
 node_name = os.getenv('NODE_NAME', 'ai-node')
-log_filename = f"{log_dir}/{node_name}_{datetime.now().strftime('%Y%m%d')}.log"
-
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(log_filename, encoding='utf-8'),
-        logging.StreamHandler()  # Keep console output
-    ]
-)
+setup_logging(log_dir, node_name)
 logger = logging.getLogger(__name__)
 
 # Global variables
+start_time_global = time.time()
 heartbeat_task = None
+# Seconds from process start to the first successful registration
+registration_seconds = None
+# Shared LLM backend (LLM_BACKEND: gemini or stub), created once in lifespan
+# (the Gemini client keeps its HTTP connection pool across battles)
+llm = None
+llm_loading = None
+
+
+async def load_llm_backend():
+    # In a worker thread: google.genai takes seconds to import and would hold up /health at boot
+    global llm
+    try:
+        llm = await asyncio.to_thread(create_backend)
+    except ValueError as e:
+        logger.error(f"{e} 戰鬥生成請求將失敗")
+        return
+    logger.info(f"LLM backend ready: {llm.name}")
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Manage application lifespan"""
-    global heartbeat_task, NODE_ID
+    global heartbeat_task, llm_loading
     
     # Startup
     logger.info(f"Starting AI Node: {NODE_NAME} (ID: {NODE_ID})")
     logger.info(f"Aggregator URL: {AGGREGATOR_URL}")
     
-    # Register with aggregator
+    if llm is None:
+        llm_loading = asyncio.create_task(load_llm_backend())
+    
+    # Register with aggregator in the background so /health is served right away
     if AGGREGATOR_URL:
-        registered_id = await register_with_aggregator()
-        if registered_id:
-            NODE_ID = registered_id
-            logger.info(f"Node registered with ID: {NODE_ID}")
-        
-        # Start heartbeat loop
-        heartbeat_task = asyncio.create_task(heartbeat_loop())
+        heartbeat_task = asyncio.create_task(registration_loop())
     
     logger.info("AI Node started successfully")
     
@@ -72,6 +81,9 @@ async def lifespan(app: FastAPI):
             await heartbeat_task
         except asyncio.CancelledError:
             pass
+    if llm is not None:
+        await llm.aclose()
+    stop_logging()
 
 app = FastAPI(
     title="AI Battle Node",
@@ -88,12 +100,125 @@ NODE_ID = os.getenv('NODE_ID', str(uuid.uuid4()))
 NODE_NAME = os.getenv('NODE_NAME', f'node-{NODE_ID[:8]}')
 AGGREGATOR_URL = os.getenv('AGGREGATOR_URL', 'http://localhost:8000')
 NODE_API_KEY = os.getenv('NODE_API_KEY')
-GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
 HEARTBEAT_INTERVAL = int(os.getenv('HEARTBEAT_INTERVAL', '60'))  # seconds
+# URL detection: registration waits at most URL_DETECT_DEADLINE, background revalidation
+# waits up to URL_REVALIDATE_DEADLINE (long enough for a tunnel to come up)
+URL_DETECT_DEADLINE = float(os.getenv('URL_DETECT_DEADLINE', '2'))
+URL_REVALIDATE_DEADLINE = float(os.getenv('URL_REVALIDATE_DEADLINE', '60'))
+url_cache = UrlCache(
+    os.getenv('URL_CACHE_FILE', os.path.join(log_dir, f'{node_name}.url.json')),
+    float(os.getenv('URL_CACHE_MAX_AGE', '86400')),
+)
 
 # Node state
-current_requests = 0
 max_concurrent_requests = int(os.getenv('MAX_CONCURRENT_REQUESTS', '5'))
+MAX_BATCH_SIZE = int(os.getenv('MAX_BATCH_SIZE', '32'))
+# Admission queue: requests wait for a slot up to their max_wait instead of an immediate 503
+MAX_QUEUE_SIZE = int(os.getenv('MAX_QUEUE_SIZE', '20'))
+DEFAULT_MAX_WAIT = float(os.getenv('DEFAULT_MAX_WAIT', '10'))
+# Lower rank is admitted first
+PRIORITY_RANKS = {'ladder': 0, 'casual': 1}
+# Assumed generation time until the first battle has been measured
+DEFAULT_SERVICE_TIME = float(os.getenv('DEFAULT_SERVICE_TIME', '15'))
+# Result cache: an aggregator retry of the same battle_id/seed reuses the stored result
+RESULT_CACHE_SIZE = int(os.getenv('RESULT_CACHE_SIZE', '256'))
+RESULT_CACHE_TTL = float(os.getenv('RESULT_CACHE_TTL', '600'))  # seconds
+# Output verification: an incomplete narrative is regenerated while the deadline allows, otherwise repaired
+GENERATION_DEADLINE = float(os.getenv('GENERATION_DEADLINE', '25'))  # seconds, below the aggregator timeout
+MAX_GENERATION_ATTEMPTS = int(os.getenv('MAX_GENERATION_ATTEMPTS', '2'))
+
+
+class AdmissionRejected(Exception):
+    """Request could not get a generation slot in time (queue full or wait deadline)"""
+    
+    def __init__(self, message: str, reason: str):
+        super().__init__(message)
+        self.reason = reason
+
+
+class AdmissionQueue:
+    """
+    Bounded priority admission for the node's generation slots.
+    A request runs at once when a slot is free; otherwise it waits (ladder before casual,
+    FIFO within a priority) until a slot is handed to it or its max_wait passes.
+    Requests whose estimated wait already exceeds max_wait are rejected up front.
+    """
+    
+    def __init__(self, capacity: int, max_queue: int):
+        self.capacity = capacity
+        self.max_queue = max_queue
+        self.active = 0
+        self.avg_service_time = None  # EWMA of generation time (seconds)
+        self._waiters = []  # heap of [rank, seq, future]
+        self._seq = itertools.count()
+    
+    @property
+    def depth(self) -> int:
+        return len(self._waiters)
+    
+    def eta(self, priority: Optional[str] = None) -> float:
+        """Estimated wait (seconds) for a new request of this priority"""
+        if self.active < self.capacity and not self._waiters:
+            return 0.0
+        rank = PRIORITY_RANKS.get(priority, max(PRIORITY_RANKS.values()))
+        ahead = sum(1 for waiter in self._waiters if waiter[0] <= rank)
+        service_time = self.avg_service_time or DEFAULT_SERVICE_TIME
+        return (ahead + 1) / max(1, self.capacity) * service_time
+    
+    async def acquire(self, priority: str = 'casual', max_wait: Optional[float] = None, bounded: bool = True):
+        if self.active < self.capacity and not self._waiters:
+            self.active += 1
+            return
+        if bounded and len(self._waiters) >= self.max_queue:
+            raise self._reject(f"Node queue full ({len(self._waiters)}/{self.max_queue})", 'queue_full')
+        if max_wait is not None:
+            eta = self.eta(priority)
+            if eta > max_wait:
+                raise self._reject(f"Estimated wait {eta:.1f}s exceeds max_wait {max_wait:.1f}s", 'estimated_wait')
+        
+        rank = PRIORITY_RANKS.get(priority, max(PRIORITY_RANKS.values()))
+        future = asyncio.get_running_loop().create_future()
+        entry = [rank, next(self._seq), future]
+        heapq.heappush(self._waiters, entry)
+        try:
+            await asyncio.wait_for(future, timeout=max_wait)
+        except asyncio.TimeoutError:
+            self._remove(entry)
+            raise self._reject(f"Waited {max_wait:.1f}s without a free slot", 'wait_timeout')
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was handed over just as the caller went away: pass it on
+                self.release()
+            else:
+                self._remove(entry)
+            raise
+        # A slot freed by release() is handed over directly; active is unchanged
+    
+    def _reject(self, message: str, reason: str) -> AdmissionRejected:
+        metrics.rejections_total.inc(reason=reason)
+        return AdmissionRejected(message, reason)
+    
+    def _remove(self, entry):
+        if entry in self._waiters:
+            self._waiters.remove(entry)
+            heapq.heapify(self._waiters)
+    
+    def release(self, service_time: Optional[float] = None):
+        if service_time is not None:
+            self.avg_service_time = (
+                service_time if self.avg_service_time is None
+                else 0.2 * service_time + 0.8 * self.avg_service_time
+            )
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+
+admission = AdmissionQueue(max_concurrent_requests, MAX_QUEUE_SIZE)
+
 
 # Pydantic models matching the main server
 class BattleLogEntry(BaseModel):
@@ -109,10 +234,127 @@ class BattleResult(BaseModel):
     battle_log: List[BattleLogEntry]
     battle_description: str
 
+class VerifiedBattleResult(BattleResult):
+    # None: no matchup to verify against (legacy prompt); True/False: whether the model's own output
+    # matched the fixed battle log. Either way a verified result has been repaired to match it.
+    valid: Optional[bool] = None
+    repairs: List[str] = []
+
 class BattleRequest(BaseModel):
     battle_id: str
-    prompt: str
+    prompt: Optional[str] = None        # full prompt (older aggregators)
+    matchup: Optional[dict] = None      # compact matchup payload, rendered locally (see battle_prompt.py)
     seed: Optional[int] = None
+    priority: str = 'casual'            # 'ladder' is admitted before 'casual'
+    max_wait: Optional[float] = None    # seconds to wait for a slot before 503
+
+class BatchBattleRequest(BaseModel):
+    battles: List[BattleRequest]
+
+
+class ResultCache:
+    """
+    Bounded TTL/LRU cache of generated battles keyed by (battle_id, seed).
+    A repeat request returns the stored result without taking a generation slot, and a
+    duplicate that arrives while the first is still generating waits for that generation.
+    Failures are not cached, so a retry after an error generates again.
+    """
+    
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.joined = 0  # duplicates that waited for an in-flight generation
+        self._entries = OrderedDict()  # key -> (expires_at, result)
+        self._inflight = {}  # key -> future of the running generation
+    
+    @property
+    def size(self) -> int:
+        return len(self._entries)
+    
+    def _get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+    
+    def _store(self, key, result):
+        if self.max_entries <= 0:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl, result)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+    
+    async def get_or_generate(self, request: BattleRequest, generate):
+        """Return the cached result for this battle, or run generate() once for all callers"""
+        key = (request.battle_id, request.seed)
+        while True:
+            result = self._get(key)
+            if result is not None:
+                self.hits += 1
+                logger.info(f"戰鬥 {request.battle_id} 命中結果快取")
+                return result
+            pending = self._inflight.get(key)
+            if pending is None:
+                break
+            self.joined += 1
+            logger.info(f"戰鬥 {request.battle_id} 正在生成中，等待同一次生成的結果")
+            try:
+                return await asyncio.shield(pending)
+            except asyncio.CancelledError:
+                if pending.cancelled():
+                    continue  # the first caller went away: generate it ourselves
+                raise
+        
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            result = await generate()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # waiters re-raise it; don't warn if there are none
+            raise
+        else:
+            self._store(key, result)
+            future.set_result(result)
+            return result
+        finally:
+            self._inflight.pop(key, None)
+    
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses + self.joined
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "inflight_joins": self.joined,
+            "hit_rate": (self.hits + self.joined) / lookups if lookups else 0.0,
+            "entries": self.size,
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+        }
+
+
+result_cache = ResultCache(RESULT_CACHE_SIZE, RESULT_CACHE_TTL)
+
+# State read at scrape time
+metrics.registry.gauge('ai_node_in_flight', 'Battles currently generating', lambda: admission.active)
+metrics.registry.gauge('ai_node_queue_depth', 'Requests waiting for a generation slot', lambda: admission.depth)
+metrics.registry.gauge('ai_node_max_concurrent_requests', 'Generation slots', lambda: admission.capacity)
+metrics.registry.gauge('ai_node_result_cache_hits', 'Result cache hits since start', lambda: result_cache.hits)
+metrics.registry.gauge('ai_node_result_cache_misses', 'Result cache misses since start', lambda: result_cache.misses)
+metrics.registry.gauge('ai_node_registration_seconds', 'Seconds from process start to first registration',
+                       lambda: registration_seconds)
+
 
 class NodeRegistration(BaseModel):
     name: str
@@ -124,6 +366,8 @@ class NodeRegistration(BaseModel):
 class HeartbeatData(BaseModel):
     node_id: str
     current_requests: int = 0
+    queued_requests: int = 0
+    queue_eta: float = 0.0
 
 
 def verify_api_key(credentials: HTTPAuthorizationCredentials = Depends(security)):
@@ -141,84 +385,260 @@ async def health_check():
         "status": "healthy",
         "node_id": NODE_ID,
         "node_name": NODE_NAME,
-        "current_requests": current_requests,
+        "current_requests": admission.active,
+        "queued_requests": admission.depth,
+        "queue_eta": admission.eta(),
         "max_concurrent_requests": max_concurrent_requests,
+        "max_queue_size": MAX_QUEUE_SIZE,
+        "matchup_versions": list(SUPPORTED_MATCHUP_VERSIONS),
+        "llm_backend": llm.name if llm is not None else None,
         "timestamp": datetime.utcnow().isoformat()
     }
 
 
-@app.post("/generate_battle", response_model=BattleResult)
-async def generate_battle(
-    request: BattleRequest,
-    credentials: HTTPAuthorizationCredentials = Depends(verify_api_key)
-):
-    """Generate battle result using Gemini API"""
-    global current_requests
+@asynccontextmanager
+async def generation_slot(priority: str = 'casual', max_wait: Optional[float] = None, bounded: bool = True):
+    """Hold one of the node's generation slots (raises AdmissionRejected if none in time)"""
+    queued_at = time.perf_counter()
+    await admission.acquire(priority, max_wait, bounded)
+    metrics.queue_seconds.observe(time.perf_counter() - queued_at)
+    start_time = time.time()
+    try:
+        yield
+    finally:
+        admission.release(time.time() - start_time)
+
+
+def resolve_prompt(request: BattleRequest):
+    """Render the prompt from the matchup payload; raises HTTP 422 so the aggregator can resend the full prompt"""
+    if request.matchup is not None:
+        try:
+            request.prompt = render_prompt(request.matchup)
+        except MatchupError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+    elif not request.prompt:
+        raise HTTPException(status_code=422, detail="Either prompt or matchup is required")
+
+
+def observe_request_size(http_request: Request):
+    size = http_request.headers.get("content-length")
+    if size and size.isdigit():
+        metrics.payload_bytes.observe(int(size), direction='request')
+
+
+def serialize_result(result: BattleResult, envelope: Optional[dict] = None) -> str:
+    """Serialize a result (optionally wrapped as a batch NDJSON line), recording time and size"""
+    started = time.perf_counter()
+    if envelope is None:
+        body = result.model_dump_json()
+    else:
+        body = json.dumps({**envelope, "result": result.model_dump()}, ensure_ascii=False) + "\n"
+    metrics.serialization_seconds.observe(time.perf_counter() - started)
+    metrics.payload_bytes.observe(len(body.encode("utf-8")), direction='response')
+    return body
+
+
+async def generate_once(request: BattleRequest, max_wait: Optional[float], bounded: bool = True) -> BattleResult:
+    """Generate a battle through the result cache; only a cache miss takes a generation slot"""
+    async def generate():
+        async with generation_slot(request.priority, max_wait, bounded):
+            return await run_generation(request)
+    return await result_cache.get_or_generate(request, generate)
+
+
+async def run_generation(request: BattleRequest) -> VerifiedBattleResult:
+    """
+    Generate one battle result with the LLM backend (caller holds a generation slot).
+    With a matchup the output is checked against its fixed battle log: an incomplete narrative is
+    regenerated if another attempt fits in GENERATION_DEADLINE, remaining mismatches are repaired.
+    """
+    start_time = time.time()
+    log_context = {'battle_id': request.battle_id}
     
-    # Check concurrent request limit
-    if current_requests >= max_concurrent_requests:
-        raise HTTPException(
-            status_code=503, 
-            detail=f"Node at capacity ({current_requests}/{max_concurrent_requests})"
-        )
+    logger.info("開始生成戰鬥", extra={
+        **log_context,
+        'seed': request.seed,
+        'prompt_chars': len(request.prompt),
+        'active': admission.active,
+        'queued': admission.depth,
+    })
     
-    current_requests += 1
-    start_time = time.time()
+    if llm is None and llm_loading is not None:
+        # Request arrived while the backend is still loading at boot
+        await asyncio.shield(llm_loading)
+    if llm is None:
+        logger.error("LLM 後端未配置", extra=log_context)
+        raise HTTPException(status_code=500, detail="LLM backend not configured")
     
-    try:
-        logger.info(f"=== 開始生成戰鬥 ===")
-        logger.info(f"戰鬥ID: {request.battle_id}")
-        logger.info(f"種子值: {request.seed}")
-        logger.info(f"Prompt長度: {len(request.prompt)} 字符")
-        logger.info(f"當前並發請求: {current_requests}/{max_concurrent_requests}")
-        
-        # Initialize Gemini client
-        if not GEMINI_API_KEY:
-            logger.error("GEMINI_API_KEY 未配置")
-            raise HTTPException(status_code=500, detail="GEMINI_API_KEY not configured")
+    attempts = 0
+    
+    def can_retry() -> bool:
+        # Another attempt is assumed to take as long as the average one so far
+        elapsed = time.time() - start_time
+        return attempts < MAX_GENERATION_ATTEMPTS and elapsed + elapsed / attempts <= GENERATION_DEADLINE
+    
+    while True:
+        attempts += 1
+        logger.debug("調用 LLM（第 %d 次）", attempts, extra=log_context)
+        metrics.generation_attempts_total.inc()
         
-        genai_client = genai.Client(api_key=GEMINI_API_KEY)
+        # Generate battle result using structured output (async API: the event loop stays free for /health and heartbeats)
+        llm_started = time.perf_counter()
+        try:
+            # The request seed goes to the backend's own sampler; never reseed the process-global RNG,
+            # concurrent requests share it
+            generated = await llm.agenerate_json(request.prompt, BattleResult, seed=request.seed)
+        except Exception as e:
+            metrics.gemini_errors_total.inc(type=type(e).__name__)
+            raise
+        finally:
+            metrics.llm_seconds.observe(time.perf_counter() - llm_started)
         
-        # Set random seed for reproducibility if provided
-        if request.seed:
-            random.seed(request.seed)
-            logger.info(f"設置隨機種子: {request.seed}")
+        if not generated:
+            logger.error("LLM 返回結果解析失敗", extra=log_context)
+            metrics.gemini_errors_total.inc(type='parse_failure')
+            if can_retry():
+                continue
+            raise HTTPException(status_code=500, detail="Failed to parse battle result from the LLM")
         
-        logger.info("開始調用 Gemini API...")
+        if request.matchup is None:
+            # Legacy prompt: nothing to verify against
+            battle_result = VerifiedBattleResult(**generated)
+            break
         
-        # Generate battle result using structured output
-        response = genai_client.models.generate_content(
-            model="gemini-2.0-flash",
-            contents=request.prompt,
-            config={
-                "response_mime_type": "application/json",
-                "response_schema": BattleResult,
-            }
+        issues = verify_result(generated, request.matchup)
+        if needs_retry(issues) and can_retry():
+            logger.warning("戰鬥敘事不完整 %s，重新生成", issues, extra=log_context)
+            continue
+        if issues:
+            logger.warning("戰鬥結果與固定日誌不一致 %s，本機修補", issues, extra=log_context)
+            for issue in issues:
+                metrics.repairs_total.inc(issue=issue)
+            battle_result = VerifiedBattleResult(
+                **repair_result(generated, request.matchup), valid=False, repairs=issues
+            )
+        else:
+            battle_result = VerifiedBattleResult(**generated, valid=True)
+        break
+    
+    # Log processing time and result
+    processing_time = time.time() - start_time
+    metrics.battle_rounds.observe(len(battle_result.battle_log))
+    logger.info("戰鬥生成完成", extra={
+        **log_context,
+        'processing_time': round(processing_time, 3),
+        'winner': battle_result.winner,
+        'rounds': len(battle_result.battle_log),
+        'description_chars': len(battle_result.battle_description),
+        'attempts': attempts,
+        'valid': battle_result.valid,
+    })
+    # Full result only for a sample of battles (LOG_SAMPLE_RATE); unsampled records are dropped before formatting
+    logger.info("戰鬥結果: %s", battle_result, extra={**log_context, 'verbose': True})
+    
+    return battle_result
+
+
+@app.post("/generate_battle", response_model=VerifiedBattleResult)
+async def generate_battle(
+    request: BattleRequest,
+    http_request: Request,
+    credentials: HTTPAuthorizationCredentials = Depends(verify_api_key)
+):
+    """Generate battle result with the LLM backend"""
+    started = time.perf_counter()
+    observe_request_size(http_request)
+    max_wait = DEFAULT_MAX_WAIT if request.max_wait is None else request.max_wait
+    resolve_prompt(request)
+    try:
+        result = await generate_once(request, max_wait)
+        body = serialize_result(result)
+        metrics.requests_total.inc(endpoint='generate_battle', outcome='ok')
+        metrics.request_seconds.observe(time.perf_counter() - started)
+        return Response(content=body, media_type="application/json")
+    except AdmissionRejected as e:
+        # Busy, not broken: tell the aggregator when to retry
+        metrics.requests_total.inc(endpoint='generate_battle', outcome='busy')
+        logger.warning(f"Rejected battle {request.battle_id}: {e}", extra={'battle_id': request.battle_id})
+        raise HTTPException(
+            status_code=503,
+            detail=f"Node busy: {e}",
+            headers={"Retry-After": str(max(1, math.ceil(admission.eta(request.priority))))}
         )
-        
-        if not response.parsed:
-            logger.error("Gemini API 返回結果解析失敗")
-            raise HTTPException(status_code=500, detail="Failed to parse battle result from Gemini API")
-        
-        battle_result = response.parsed
-        
-        # Log processing time and result
-        processing_time = time.time() - start_time
-        logger.info(f"=== 戰鬥生成完成 ===")
-        logger.info(f"處理時間: {processing_time:.2f}秒")
-        logger.info(f"獲勝者: {battle_result.winner}")
-        logger.info(f"戰鬥回合數: {len(battle_result.battle_log)}")
-        logger.info(f"戰鬥描述長度: {len(battle_result.battle_description)} 字符")
-        logger.info(f"戰鬥結果: {battle_result}")
-        
-        return battle_result
-        
     except Exception as e:
-        logger.error(f"Error generating battle {request.battle_id}: {str(e)}")
+        metrics.requests_total.inc(endpoint='generate_battle', outcome='error')
+        logger.error(f"Error generating battle {request.battle_id}: {str(e)}", extra={'battle_id': request.battle_id})
         raise HTTPException(status_code=500, detail=f"Battle generation failed: {str(e)}")
+
+
+@app.post("/generate_battles")
+async def generate_battles(
+    request: BatchBattleRequest,
+    http_request: Request,
+    credentials: HTTPAuthorizationCredentials = Depends(verify_api_key)
+):
+    """
+    Generate many battles in one request.
+    Battles run concurrently within the node's slot budget (queued by priority; the batch
+    size limit bounds them instead of MAX_QUEUE_SIZE), and results stream back as NDJSON
+    in completion order.
+    Each line: {"index", "battle_id", "status": "ok", "result", "processing_time"}
+    or {"index", "battle_id", "status": "error" | "busy", "error"}.
+    """
+    if not request.battles:
+        raise HTTPException(status_code=400, detail="No battles in batch")
+    if len(request.battles) > MAX_BATCH_SIZE:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Batch too large ({len(request.battles)} > {MAX_BATCH_SIZE})"
+        )
+    for item in request.battles:
+        resolve_prompt(item)
+    observe_request_size(http_request)
     
-    finally:
-        current_requests -= 1
+    logger.info(f"收到批次請求: {len(request.battles)} 場戰鬥")
+    
+    async def run_item(index: int, item: BattleRequest) -> str:
+        start_time = time.time()
+        started = time.perf_counter()
+        try:
+            result = await generate_once(item, item.max_wait, bounded=False)
+            line = serialize_result(result, {
+                "index": index,
+                "battle_id": item.battle_id,
+                "status": "ok",
+                "processing_time": time.time() - start_time,
+            })
+            metrics.requests_total.inc(endpoint='generate_battles', outcome='ok')
+            metrics.request_seconds.observe(time.perf_counter() - started)
+            return line
+        except AdmissionRejected as e:
+            metrics.requests_total.inc(endpoint='generate_battles', outcome='busy')
+            line = {"index": index, "battle_id": item.battle_id, "status": "busy", "error": str(e)}
+        except Exception as e:
+            metrics.requests_total.inc(endpoint='generate_battles', outcome='error')
+            detail = e.detail if isinstance(e, HTTPException) else str(e)
+            logger.error(f"Error generating battle {item.battle_id}: {detail}", extra={'battle_id': item.battle_id})
+            line = {"index": index, "battle_id": item.battle_id, "status": "error", "error": detail}
+        return json.dumps(line, ensure_ascii=False) + "\n"
+    
+    async def stream():
+        tasks = [asyncio.create_task(run_item(i, item)) for i, item in enumerate(request.battles)]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield await next_done
+        finally:
+            # Client went away: stop the remaining battles and free their slots
+            for task in tasks:
+                task.cancel()
+    
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics(credentials: HTTPAuthorizationCredentials = Depends(verify_api_key)):
+    """Prometheus text exposition of the node's counters and histograms"""
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
 
 
 @app.get("/stats")
@@ -227,183 +647,22 @@ async def get_node_stats(credentials: HTTPAuthorizationCredentials = Depends(ver
     return {
         "node_id": NODE_ID,
         "node_name": NODE_NAME,
-        "current_requests": current_requests,
+        "current_requests": admission.active,
+        "queued_requests": admission.depth,
+        "queue_eta": admission.eta(),
+        "avg_generation_time": admission.avg_service_time,
+        "result_cache": result_cache.stats(),
         "max_concurrent_requests": max_concurrent_requests,
         "uptime": time.time() - start_time_global,
+        "registration_seconds": registration_seconds,
         "aggregator_url": AGGREGATOR_URL
     }
 
 
-# Global variable to track startup time
-start_time_global = time.time()
 
-
-def get_public_ip():
-    """Get public IP address"""
-    try:
-        import requests
-        response = requests.get('https://api.ipify.org?format=text', timeout=5)
-        return response.text.strip()
-    except:
-        return None
-
-def get_local_ip():
-    """Get local network IP address"""
-    try:
-        import socket
-        # Connect to a remote address to determine local IP
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.connect(("8.8.8.8", 80))
-        local_ip = s.getsockname()[0]
-        s.close()
-        return local_ip
-    except:
-        return None
-
-def get_tunnel_url():
-    """Get Cloudflare Tunnel URL from tunnel container logs"""
-    try:
-        if os.getenv('USE_TUNNEL', 'false').lower() != 'true':
-            return None
-        
-        logger.info("檢測 Cloudflare Tunnel URL...")
-        
-        import subprocess
-        import re
-        import time
-        
-        # 等待 tunnel 容器啟動
-        max_retries = 30
-        for i in range(max_retries):
-            try:
-                result = subprocess.run(
-                    ['docker', 'logs', 'ai-node-tunnel', '--tail', '100'],
-                    capture_output=True,
-                    text=True,
-                    timeout=5
-                )
-                
-                # 查找 trycloudflare.com URL
-                match = re.search(r'https://([a-z0-9\-]+\.trycloudflare\.com)', result.stdout + result.stderr)
-                if match:
-                    tunnel_host = match.group(1)
-                    logger.info(f"✅ 檢測到 Tunnel URL: https://{tunnel_host}")
-                    return tunnel_host
-                
-                # 如果還沒有 URL，等待一下
-                if i < max_retries - 1:
-                    time.sleep(2)
-                    
-            except subprocess.TimeoutExpired:
-                logger.warning(f"Docker logs timeout, retry {i+1}/{max_retries}")
-                time.sleep(2)
-            except FileNotFoundError:
-                logger.error("Docker 命令不可用")
-                return None
-            except Exception as e:
-                logger.error(f"讀取 tunnel logs 失敗: {e}")
-                time.sleep(2)
-        
-        logger.warning("⚠️  無法檢測 Tunnel URL，請檢查 tunnel 容器狀態")
-        return None
-        
-    except Exception as e:
-        logger.error(f"Tunnel URL 檢測異常: {e}")
-        return None
-
-def detect_node_url():
-    """Auto-detect the correct URL for this node"""
-    node_port = os.getenv('NODE_PORT', '8001')
-    
-    # Priority order for determining external host:
-    # 1. Explicit configuration (NODE_EXTERNAL_HOST)
-    # 2. Cloudflare Tunnel (if USE_TUNNEL=true)
-    # 3. Public IP (for production)
-    # 4. Local network IP
-    # 5. Docker host (for local development)
-    # 6. localhost (fallback)
-    
-    node_external_host = os.getenv('NODE_EXTERNAL_HOST')
-    
-    if node_external_host:
-        # Explicitly configured - highest priority
-        node_host = node_external_host
-        logger.info(f"使用配置的外部地址: {node_host}")
-        # 如果是 trycloudflare.com，使用 HTTPS
-        if 'trycloudflare.com' in node_host:
-            return f"https://{node_host}"
-        return f"http://{node_host}:{node_port}"
-    
-    # Check if using Cloudflare Tunnel
-    tunnel_host = get_tunnel_url()
-    if tunnel_host:
-        logger.info(f"使用 Cloudflare Tunnel: https://{tunnel_host}")
-        return f"https://{tunnel_host}"
-    
-    # Original detection logic
-    else:
-        # Auto-detect based on environment
-        deployment_mode = os.getenv('DEPLOYMENT_MODE', 'auto')
-        
-        # 智能判斷：如果 AGGREGATOR_URL 不是本地地址，自動切換到 production 模式
-        if deployment_mode == 'auto':
-            if 'localhost' not in AGGREGATOR_URL and 'host.docker.internal' not in AGGREGATOR_URL and '127.0.0.1' not in AGGREGATOR_URL:
-                logger.info("檢測到遠程 AGGREGATOR_URL，自動切換到 production 模式")
-                deployment_mode = 'production'
-            else:
-                logger.info("檢測到本地 AGGREGATOR_URL，使用 local 模式")
-                deployment_mode = 'local'
-        
-        if deployment_mode == 'production':
-            # Production mode - try to get public IP
-            public_ip = get_public_ip()
-            if public_ip:
-                node_host = public_ip
-                logger.info(f"Production mode: Using public IP: {node_host}")
-            else:
-                # Fallback to local IP
-                local_ip = get_local_ip()
-                node_host = local_ip if local_ip else 'localhost'
-                logger.warning(f"Could not get public IP, using local IP: {node_host}")
-        
-        elif deployment_mode == 'local':
-            # Local development mode
-            if os.path.exists('/.dockerenv'):
-                node_host = 'host.docker.internal'
-                logger.info(f"Local Docker mode: Using host.docker.internal")
-            else:
-                node_host = 'localhost'
-                logger.info(f"Local native mode: Using localhost")
-        
-        else:
-            # Auto-detect mode
-            if os.getenv('NODE_EXTERNAL_HOST'):
-                node_host = os.getenv('NODE_EXTERNAL_HOST')
-            elif os.path.exists('/.dockerenv'):
-                # In Docker - check if we can reach host.docker.internal
-                try:
-                    import socket
-                    socket.gethostbyname('host.docker.internal')
-                    node_host = 'host.docker.internal'
-                    logger.info(f"Auto-detect: Using host.docker.internal")
-                except:
-                    # host.docker.internal not available, try local IP
-                    local_ip = get_local_ip()
-                    node_host = local_ip if local_ip else 'localhost'
-                    logger.info(f"Auto-detect: host.docker.internal unavailable, using {node_host}")
-            else:
-                # Not in Docker
-                local_ip = get_local_ip()
-                node_host = local_ip if local_ip else 'localhost'
-                logger.info(f"Auto-detect: Native mode, using {node_host}")
-    
-    return f"http://{node_host}:{node_port}"
-
-async def register_with_aggregator():
+async def register_with_aggregator(node_url: str):
     """Register this node with the aggregator"""
     try:
-        # Auto-detect the correct URL for this node
-        node_url = detect_node_url()
         logger.info(f"Registering node with URL: {node_url}")
         
         registration_data = NodeRegistration(
@@ -449,7 +708,9 @@ async def send_heartbeat():
     try:
         heartbeat_data = HeartbeatData(
             node_id=NODE_ID,
-            current_requests=current_requests
+            current_requests=admission.active,
+            queued_requests=admission.depth,
+            queue_eta=admission.eta()
         )
         
         # 確保 URL 正確拼接
@@ -471,6 +732,49 @@ async def send_heartbeat():
         logger.error(f"Error sending heartbeat: {str(e)}")
 
 
+async def register_until_done(node_url: str):
+    """Register, retrying with backoff while the aggregator is unreachable"""
+    global NODE_ID, registration_seconds
+    delay = 1
+    while True:
+        registered_id = await register_with_aggregator(node_url)
+        if registered_id:
+            NODE_ID = registered_id
+            logger.info(f"Node registered with ID: {NODE_ID}")
+            if registration_seconds is None:
+                registration_seconds = time.time() - start_time_global
+                logger.info(f"首次註冊完成，距啟動 {registration_seconds:.2f} 秒", extra={'url': node_url})
+            return
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, HEARTBEAT_INTERVAL)
+
+
+async def registration_loop():
+    """
+    Register with the cached URL (or one detected within URL_DETECT_DEADLINE), then run full
+    detection in the background: a URL that changed (e.g. the tunnel came up late) is re-registered.
+    """
+    cached = url_cache.load()
+    if cached:
+        node_url, source = cached
+        logger.info(f"使用快取的節點 URL: {node_url}（來源: {source}）")
+    else:
+        node_url, source = await detect_node_url(AGGREGATOR_URL, URL_DETECT_DEADLINE)
+        logger.info(f"檢測到節點 URL: {node_url}（來源: {source}）")
+    await register_until_done(node_url)
+    
+    heartbeats = asyncio.create_task(heartbeat_loop())
+    try:
+        detected_url, detected_source = await detect_node_url(AGGREGATOR_URL, URL_REVALIDATE_DEADLINE)
+        url_cache.save(detected_url, detected_source)
+        if detected_url != node_url:
+            logger.info(f"節點 URL 已變更: {node_url} -> {detected_url}（來源: {detected_source}），重新註冊")
+            await register_until_done(detected_url)
+        await heartbeats
+    finally:
+        heartbeats.cancel()
+
+
 async def heartbeat_loop():
     """Background task to send periodic heartbeats"""
     await asyncio.sleep(5)  # Wait a bit before starting heartbeats
@@ -489,10 +793,7 @@ if __name__ == "__main__":
     port = int(os.getenv('NODE_PORT', '8001'))
     # Always bind to 0.0.0.0 inside container to accept connections from any interface
     host = "0.0.0.0"
-    
-    # Get external URL for logging
-    external_url = detect_node_url()
-    logger.info(f"Starting AI Node on {host}:{port} (external URL: {external_url})")
+    logger.info(f"Starting AI Node on {host}:{port}")
     
     uvicorn.run(
         "main:app",
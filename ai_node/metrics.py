@@ -0,0 +1,144 @@
+# Minimal Prometheus-style metrics for the AI node (text exposition format, no extra dependency)
+#
+# The node serves requests on a single asyncio event loop, so updates are plain dict/list
+# operations without locks: recording a sample is a dict lookup plus a bisect.
+from bisect import bisect_left
+from typing import Callable, Dict, List, Sequence, Tuple
+
+# Bucket upper bounds (seconds / bytes / count); +Inf is implicit
+LATENCY_BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 3, 5, 8, 13, 21, 34)
+SIZE_BUCKETS = (256, 512, 1024, 2048, 4096, 8192, 16384, 32768, 65536)
+ROUND_BUCKETS = (2, 4, 6, 8, 10, 12, 14, 16, 18, 20)
+
+
+def _format_labels(names: Sequence[str], values: Tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{str(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(tuple(labels.get(name, '') for name in self.labelnames), 0)
+
+    def collect(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        for key, value in sorted(self._values.items()):
+            lines.append(f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, buckets: Sequence[float], labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self.labelnames = tuple(labelnames)
+        self._series: Dict[Tuple, list] = {}  # key -> [per-bucket counts (+Inf last), sum]
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def collect(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        bounds = self.buckets + (float('inf'),)
+        for key, (counts, total) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                le = 'le="' + _format_value(bound) + '"'
+                lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}')
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class Gauge:
+    """Value read from a callback at scrape time (no hot-path cost)"""
+
+    def __init__(self, name: str, documentation: str, read: Callable[[], float]):
+        self.name = name
+        self.documentation = documentation
+        self.read = read
+
+    def collect(self) -> List[str]:
+        return [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} gauge',
+            f'{self.name} {_format_value(self.read() or 0)}',
+        ]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, buckets: Sequence[float] = LATENCY_BUCKETS,
+                  labelnames: Sequence[str] = ()) -> Histogram:
+        return self.register(Histogram(name, documentation, buckets, labelnames))
+
+    def gauge(self, name: str, documentation: str, read: Callable[[], float]) -> Gauge:
+        return self.register(Gauge(name, documentation, read))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.collect())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+requests_total = registry.counter(
+    'ai_node_requests_total', 'Battle generation requests by endpoint and outcome', ('endpoint', 'outcome'))
+rejections_total = registry.counter(
+    'ai_node_rejections_total', 'Requests rejected by the admission queue', ('reason',))
+gemini_errors_total = registry.counter(
+    'ai_node_gemini_errors_total', 'Failed Gemini calls by error type', ('type',))
+generation_attempts_total = registry.counter(
+    'ai_node_generation_attempts_total', 'Gemini generation attempts (retries included)')
+repairs_total = registry.counter(
+    'ai_node_repairs_total', 'Battle results repaired locally by issue', ('issue',))
+
+request_seconds = registry.histogram(
+    'ai_node_request_seconds', 'End-to-end battle generation time on the node')
+queue_seconds = registry.histogram(
+    'ai_node_queue_seconds', 'Time spent waiting in the admission queue')
+llm_seconds = registry.histogram(
+    'ai_node_llm_seconds', 'Time per Gemini generate_content call')
+serialization_seconds = registry.histogram(
+    'ai_node_serialization_seconds', 'Time to serialize a battle result')
+payload_bytes = registry.histogram(
+    'ai_node_payload_bytes', 'Request and response body sizes', SIZE_BUCKETS, ('direction',))
+battle_rounds = registry.histogram(
+    'ai_node_battle_rounds', 'Rounds per generated battle', ROUND_BUCKETS)
@@ -0,0 +1,158 @@
+# Logging pipeline for the AI node
+#
+# Request handlers run on the asyncio event loop, so they must never wait on disk. Records go
+# through a QueueHandler into an in-memory queue; a QueueListener thread formats them and writes
+# them to the rotating JSON log file and the console. Verbose per-battle dumps are sampled by
+# battle_id before they are even queued.
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import zlib
+from datetime import datetime, timezone
+from typing import Optional
+
+CONSOLE_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Attributes every LogRecord has; anything else was passed through extra= and goes into the JSON record
+_RESERVED = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime', 'taskName'}
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def _extra_fields(record: logging.LogRecord) -> dict:
+    return {
+        key: value for key, value in vars(record).items()
+        if key not in _RESERVED and key != 'verbose' and not key.startswith('_')
+    }
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: ts, level, logger, message plus extra fields (battle_id, latency, ...)"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        entry.update(_extra_fields(record))
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class ConsoleFormatter(logging.Formatter):
+    """Plain text line with extra fields appended as key=value"""
+
+    def __init__(self):
+        super().__init__(CONSOLE_FORMAT)
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        fields = _extra_fields(record)
+        if fields:
+            line += ' ' + ' '.join(f'{key}={value}' for key, value in fields.items())
+        return line
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keep only a fraction of records marked extra={'verbose': True}.
+    Sampling is by battle_id, so a sampled battle keeps all of its verbose records.
+    """
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.threshold = int(max(0.0, min(1.0, rate)) * 10000)
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not getattr(record, 'verbose', False):
+            return True
+        key = str(getattr(record, 'battle_id', '') or record.created).encode()
+        return zlib.crc32(key) % 10000 < self.threshold
+
+
+class RotatingFileHandler(logging.handlers.TimedRotatingFileHandler):
+    """Rotates at the configured time boundary or when the file grows past max_bytes, whichever comes first"""
+
+    def __init__(self, filename: str, when: str, max_bytes: int, backup_count: int):
+        super().__init__(filename, when=when, backupCount=backup_count, encoding='utf-8', delay=True)
+        self.max_bytes = max_bytes
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        if super().shouldRollover(record):
+            return True
+        if self.max_bytes <= 0:
+            return False
+        if self.stream is None:
+            self.stream = self._open()
+        return self.stream.tell() >= self.max_bytes
+
+    def rotation_filename(self, default_name: str) -> str:
+        # Several size rollovers can happen within one time interval: never overwrite a backup
+        name, suffix = default_name, 1
+        while os.path.exists(name):
+            name = f'{default_name}.{suffix}'
+            suffix += 1
+        return name
+
+
+def setup_logging(log_dir: str, node_name: str, mode: Optional[str] = None) -> logging.Handler:
+    """
+    Configure the root logger and return the file handler.
+    mode 'async' (default) writes through a queue on a background thread; 'sync' writes in the
+    caller's thread (the old behaviour, kept for benchmarking). Calling it again replaces the setup.
+    """
+    global _listener
+    mode = mode or os.getenv('LOG_MODE', 'async')
+    os.makedirs(log_dir, exist_ok=True)
+
+    file_handler = RotatingFileHandler(
+        os.path.join(log_dir, f'{node_name}.log'),
+        when=os.getenv('LOG_ROTATE_WHEN', 'midnight'),
+        max_bytes=int(os.getenv('LOG_MAX_BYTES', str(50 * 1024 * 1024))),
+        backup_count=int(os.getenv('LOG_BACKUP_COUNT', '7')),
+    )
+    if os.getenv('LOG_FORMAT', 'json') == 'json':
+        file_handler.setFormatter(JsonFormatter())
+    else:
+        file_handler.setFormatter(ConsoleFormatter())
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(ConsoleFormatter())
+    sampling = SamplingFilter(float(os.getenv('LOG_SAMPLE_RATE', '0.05')))
+
+    stop_logging()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+        handler.close()
+    root.setLevel(getattr(logging, os.getenv('LOG_LEVEL', 'INFO').upper(), logging.INFO))
+
+    if mode == 'sync':
+        for handler in (file_handler, console_handler):
+            handler.addFilter(sampling)
+            root.addHandler(handler)
+        return file_handler
+
+    queue_handler = logging.handlers.QueueHandler(queue.SimpleQueue())
+    queue_handler.addFilter(sampling)
+    root.addHandler(queue_handler)
+    _listener = logging.handlers.QueueListener(
+        queue_handler.queue, file_handler, console_handler, respect_handler_level=True
+    )
+    _listener.start()
+    return file_handler
+
+
+def stop_logging():
+    """Flush queued records and stop the writer thread"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
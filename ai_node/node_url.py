@@ -0,0 +1,194 @@
+# External URL detection for the AI node
+#
+# The aggregator needs a URL it can reach this node on. Candidate sources (configured host,
+# Cloudflare tunnel, public IP, local IP, Docker host) are probed concurrently and the
+# highest-priority one that answers within the deadline wins. The last detected URL is cached
+# on disk so a restarted node can register immediately and confirm the URL in the background.
+import asyncio
+import json
+import logging
+import os
+import re
+import socket
+import time
+from typing import Optional, Tuple
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+TUNNEL_CONTAINER = 'ai-node-tunnel'
+TUNNEL_POLL_INTERVAL = 2
+_TUNNEL_RE = re.compile(r'https://([a-z0-9\-]+\.trycloudflare\.com)')
+
+# Settings that change the detected URL; a cached URL is only reused when they are unchanged
+_FINGERPRINT_ENV = ('NODE_PORT', 'NODE_EXTERNAL_HOST', 'USE_TUNNEL', 'DEPLOYMENT_MODE', 'AGGREGATOR_URL')
+
+
+async def probe_tunnel() -> Optional[str]:
+    """Poll the tunnel container logs until a trycloudflare.com URL shows up (cancelled by the deadline)"""
+    while True:
+        try:
+            process = await asyncio.create_subprocess_exec(
+                'docker', 'logs', TUNNEL_CONTAINER, '--tail', '100',
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+            )
+        except FileNotFoundError:
+            logger.error("Docker 命令不可用")
+            return None
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=5)
+        except asyncio.TimeoutError:
+            process.kill()
+            logger.warning("Docker logs timeout")
+        else:
+            match = _TUNNEL_RE.search((stdout + stderr).decode(errors='replace'))
+            if match:
+                logger.info(f"✅ 檢測到 Tunnel URL: https://{match.group(1)}")
+                return f"https://{match.group(1)}"
+        await asyncio.sleep(TUNNEL_POLL_INTERVAL)
+
+
+async def probe_public_ip() -> Optional[str]:
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.get('https://api.ipify.org?format=text',
+                                   timeout=aiohttp.ClientTimeout(total=5)) as response:
+                if response.status == 200:
+                    return (await response.text()).strip() or None
+    except Exception as e:
+        logger.info(f"無法取得公網 IP: {e}")
+    return None
+
+
+def _local_ip() -> Optional[str]:
+    # Connecting a UDP socket sends nothing; it only selects the outgoing interface
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.connect(("8.8.8.8", 80))
+            return s.getsockname()[0]
+    except OSError:
+        return None
+
+
+async def probe_local_ip() -> Optional[str]:
+    return await asyncio.to_thread(_local_ip)
+
+
+async def probe_docker_host() -> Optional[str]:
+    try:
+        await asyncio.get_running_loop().getaddrinfo('host.docker.internal', None)
+        return 'host.docker.internal'
+    except OSError:
+        return None
+
+
+async def _constant(value: str) -> str:
+    return value
+
+
+def candidate_sources(aggregator_url: str, port: str) -> list:
+    """(source, coroutine returning a URL or None) in priority order"""
+    def http(probe):
+        async def url():
+            host = await probe
+            return f"http://{host}:{port}" if host else None
+        return url()
+
+    candidates = []
+    if os.getenv('USE_TUNNEL', 'false').lower() == 'true':
+        candidates.append(('tunnel', probe_tunnel()))
+
+    deployment_mode = os.getenv('DEPLOYMENT_MODE', 'auto')
+    if deployment_mode == 'auto':
+        # 智能判斷：如果 AGGREGATOR_URL 不是本地地址，自動切換到 production 模式
+        local_hosts = ('localhost', 'host.docker.internal', '127.0.0.1')
+        deployment_mode = 'local' if any(host in aggregator_url for host in local_hosts) else 'production'
+
+    in_docker = os.path.exists('/.dockerenv')
+    if deployment_mode == 'production':
+        candidates.append(('public_ip', http(probe_public_ip())))
+        candidates.append(('local_ip', http(probe_local_ip())))
+    elif deployment_mode == 'local':
+        candidates.append(('docker_host' if in_docker else 'localhost',
+                           http(_constant('host.docker.internal' if in_docker else 'localhost'))))
+    else:
+        if in_docker:
+            candidates.append(('docker_host', http(probe_docker_host())))
+        candidates.append(('local_ip', http(probe_local_ip())))
+    candidates.append(('localhost', http(_constant('localhost'))))
+    return candidates
+
+
+async def detect_node_url(aggregator_url: str, deadline: float) -> Tuple[str, str]:
+    """
+    Detect this node's external URL, returning (url, source).
+    All sources are probed at once; a source is only skipped for a lower-priority one after it
+    has failed or the deadline has passed, so the result is the one the old sequential order gave.
+    """
+    port = os.getenv('NODE_PORT', '8001')
+    external_host = os.getenv('NODE_EXTERNAL_HOST')
+    if external_host:
+        # 如果是 trycloudflare.com，使用 HTTPS
+        if 'trycloudflare.com' in external_host:
+            return f"https://{external_host}", 'configured'
+        return f"http://{external_host}:{port}", 'configured'
+
+    candidates = candidate_sources(aggregator_url, port)
+    tasks = [(source, asyncio.ensure_future(probe)) for source, probe in candidates]
+    expires = time.monotonic() + deadline
+    try:
+        for source, task in tasks:
+            remaining = expires - time.monotonic()
+            try:
+                if remaining > 0:
+                    url = await asyncio.wait_for(asyncio.shield(task), remaining)
+                else:
+                    url = task.result() if task.done() else None
+            except asyncio.TimeoutError:
+                logger.info(f"URL 來源 {source} 未在 {deadline:g} 秒內回應")
+                url = None
+            except Exception as e:
+                logger.warning(f"URL 來源 {source} 檢測失敗: {e}")
+                url = None
+            if url:
+                return url, source
+    finally:
+        for _, task in tasks:
+            task.cancel()
+    return f"http://localhost:{port}", 'localhost'
+
+
+class UrlCache:
+    """Last detected URL on disk, valid while the URL-related settings are unchanged and it is not too old"""
+
+    def __init__(self, path: str, max_age: float):
+        self.path = path
+        self.max_age = max_age
+
+    @staticmethod
+    def fingerprint() -> dict:
+        return {name: os.getenv(name) for name in _FINGERPRINT_ENV}
+
+    def load(self) -> Optional[Tuple[str, str]]:
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry.get('fingerprint') != self.fingerprint():
+            return None
+        if time.time() - entry.get('detected_at', 0) > self.max_age:
+            return None
+        return entry['url'], entry.get('source', 'cache')
+
+    def save(self, url: str, source: str):
+        entry = {'url': url, 'source': source, 'detected_at': time.time(), 'fingerprint': self.fingerprint()}
+        try:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            tmp_path = f'{self.path}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning(f"無法寫入 URL 快取 {self.path}: {e}")
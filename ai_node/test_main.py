@@ -0,0 +1,165 @@
+# Unit tests for the node's admission queue, result cache and retry handling
+#
+#   python -m unittest test_main
+import asyncio
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+os.environ.setdefault('AGGREGATOR_URL', '')  # do not register with an aggregator
+os.environ.setdefault('LOG_DIR', os.path.join(tempfile.gettempdir(), 'ai-node-tests'))
+
+from fastapi.testclient import TestClient
+
+import main
+
+
+class AdmissionQueueTests(unittest.IsolatedAsyncioTestCase):
+    async def test_ladder_is_admitted_before_casual(self):
+        queue = main.AdmissionQueue(capacity=1, max_queue=10)
+        await queue.acquire('casual')
+        admitted = []
+
+        async def wait(name, priority):
+            await queue.acquire(priority)
+            admitted.append(name)
+
+        waiters = [
+            asyncio.create_task(wait('casual-1', 'casual')),
+            asyncio.create_task(wait('ladder-1', 'ladder')),
+            asyncio.create_task(wait('casual-2', 'casual')),
+            asyncio.create_task(wait('ladder-2', 'ladder')),
+        ]
+        await asyncio.sleep(0)
+        self.assertEqual(queue.depth, 4)
+
+        for _ in waiters:
+            queue.release()
+            await asyncio.sleep(0)
+        await asyncio.gather(*waiters)
+        # Ladder first, FIFO within a priority; each release hands the slot over directly
+        self.assertEqual(admitted, ['ladder-1', 'ladder-2', 'casual-1', 'casual-2'])
+        self.assertEqual(queue.active, 1)
+        queue.release()
+        self.assertEqual(queue.active, 0)
+
+    async def test_full_queue_rejects(self):
+        queue = main.AdmissionQueue(capacity=1, max_queue=1)
+        await queue.acquire()
+        waiter = asyncio.create_task(queue.acquire())
+        await asyncio.sleep(0)
+        with self.assertRaises(main.AdmissionRejected) as rejected:
+            await queue.acquire()
+        self.assertEqual(rejected.exception.reason, 'queue_full')
+        queue.release()
+        await waiter
+
+    async def test_wait_timeout_leaves_the_queue(self):
+        queue = main.AdmissionQueue(capacity=1, max_queue=10)
+        queue.avg_service_time = 0.01  # keep the up-front estimate below max_wait
+        await queue.acquire()
+        with self.assertRaises(main.AdmissionRejected) as rejected:
+            await queue.acquire(max_wait=0.05)
+        self.assertEqual(rejected.exception.reason, 'wait_timeout')
+        self.assertEqual(queue.depth, 0)
+
+
+class ResultCacheTests(unittest.IsolatedAsyncioTestCase):
+    def request(self, battle_id='battle-1', seed=7):
+        return main.BattleRequest(battle_id=battle_id, prompt='prompt', seed=seed)
+
+    async def test_duplicate_joins_in_flight_generation(self):
+        cache = main.ResultCache(max_entries=8, ttl=60)
+        release = asyncio.Event()
+        calls = 0
+
+        async def generate():
+            nonlocal calls
+            calls += 1
+            await release.wait()
+            return {'winner': 'a'}
+
+        first = asyncio.create_task(cache.get_or_generate(self.request(), generate))
+        second = asyncio.create_task(cache.get_or_generate(self.request(), generate))
+        await asyncio.sleep(0)
+        release.set()
+        self.assertEqual(await asyncio.gather(first, second), [{'winner': 'a'}, {'winner': 'a'}])
+        self.assertEqual(calls, 1)
+        self.assertEqual((cache.misses, cache.joined), (1, 1))
+
+        # Later repeat is served from the cache; another seed is a different battle
+        self.assertEqual(await cache.get_or_generate(self.request(), generate), {'winner': 'a'})
+        self.assertEqual(cache.hits, 1)
+        await cache.get_or_generate(self.request(seed=8), generate)
+        self.assertEqual(calls, 2)
+
+    async def test_failures_are_not_cached(self):
+        cache = main.ResultCache(max_entries=8, ttl=60)
+        release = asyncio.Event()
+
+        async def fail():
+            await release.wait()
+            raise RuntimeError('boom')
+
+        async def succeed():
+            return {'winner': 'b'}
+
+        first = asyncio.create_task(cache.get_or_generate(self.request(), fail))
+        joined = asyncio.create_task(cache.get_or_generate(self.request(), succeed))
+        await asyncio.sleep(0)
+        release.set()
+        for task in (first, joined):
+            with self.assertRaises(RuntimeError):
+                await task
+        self.assertEqual(await cache.get_or_generate(self.request(), succeed), {'winner': 'b'})
+        self.assertEqual(cache.size, 1)
+
+
+class CountingLLM:
+    def __init__(self):
+        self.calls = []
+
+    async def agenerate_json(self, prompt, schema=None, seed=None):
+        self.calls.append(seed)
+        return {
+            'winner': 'hero',
+            'battle_log': [{
+                'attacker': 'hero', 'defender': 'rival', 'action': 'attack',
+                'damage': 10, 'description': 'hit', 'remaining_hp': 90,
+            }],
+            'battle_description': 'a fight',
+        }
+
+
+class RetryTests(unittest.TestCase):
+    def setUp(self):
+        self.llm = CountingLLM()
+        self.cache = main.ResultCache(max_entries=8, ttl=60)
+        patches = [
+            mock.patch.object(main, 'llm', self.llm),
+            mock.patch.object(main, 'result_cache', self.cache),
+        ]
+        for patcher in patches:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.client = TestClient(main.app)  # no lifespan: no registration or heartbeats
+
+    def post(self, seed):
+        response = self.client.post('/generate_battle', json={'battle_id': 'battle-1', 'prompt': 'prompt', 'seed': seed})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_retry_with_same_seed_hits_cache(self):
+        # The aggregator resends a battle with its engine seed, so a retry is the same cache key
+        first = self.post(seed=1234)
+        self.assertEqual(self.post(seed=1234), first)
+        self.assertEqual(self.llm.calls, [1234])
+        self.assertEqual((self.cache.misses, self.cache.hits), (1, 1))
+
+        self.post(seed=5678)
+        self.assertEqual(self.llm.calls, [1234, 5678])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -58,6 +58,24 @@ app.conf.beat_schedule = {
         'task': 'game.tasks.check_node_health',
         'schedule': 30.0,  # 每30秒執行
     },
+
+    # 每30秒抓取節點的 /metrics（LLM 延遲、Gemini 錯誤、拒絕數）
+    'scrape-node-metrics': {
+        'task': 'game.tasks.scrape_node_metrics',
+        'schedule': 30.0,  # 每30秒執行
+    },
+
+    # 每10秒把緩衝在 Redis 的節點心跳寫回資料庫
+    'flush-node-heartbeats': {
+        'task': 'game.tasks.flush_node_heartbeats',
+        'schedule': 10.0,  # 每10秒執行
+    },
+
+    # 每10秒把行程內緩衝的節點請求統計寫回資料庫
+    'flush-node-stats': {
+        'task': 'game.tasks.flush_node_stats',
+        'schedule': 10.0,  # 每10秒執行
+    },
 }
 
 app.conf.timezone = 'Asia/Taipei' 
\ No newline at end of file
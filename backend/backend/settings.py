@@ -193,6 +193,18 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 CELERY_BROKER_URL = os.getenv('CELERY_BROKER_URL', 'redis://redis:6379/0')
 CELERY_RESULT_BACKEND = os.getenv('CELERY_RESULT_BACKEND', 'redis://redis:6379/0')
 
+# 節點註冊表快取等共用狀態使用的 Redis（預設與 Celery broker 相同）
+REDIS_URL = os.getenv('REDIS_URL', CELERY_BROKER_URL)
+
+# 戰鬥流程分階段，各自使用獨立隊列（生成 → 發獎 → IPFS → 送交易 → 確認收據）
+CELERY_TASK_ROUTES = {
+    'game.tasks.run_battle_task': {'queue': 'battle_generate'},
+    'game.tasks.settle_battle_rewards_task': {'queue': 'battle_settle'},
+    'game.tasks.pin_battle_result_task': {'queue': 'battle_pin'},
+    'game.tasks.submit_battle_tx_task': {'queue': 'battle_submit'},
+    'game.tasks.confirm_battle_tx_task': {'queue': 'battle_confirm'},
+}
+
 # JWT settings
 SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(minutes=60),
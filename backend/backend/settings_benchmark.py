@@ -0,0 +1,37 @@
+"""
+端到端戰鬥吞吐量基準測試用的設定（python manage.py benchmark_battles --settings=backend.settings_benchmark）
+
+- 資料庫：預設為獨立的 SQLite 檔案；BENCHMARK_DB=postgres 時沿用 POSTGRES_* 設定（請指向專用的測試庫）
+- Celery：memory broker，由 benchmark_battles 在行程內啟動執行緒池 worker（--celery eager 則在呼叫端同步執行）
+- Redis：不使用，節點註冊表、斷路器、心跳改用行程內狀態
+- LLM：聚合器本地回退使用離線的 stub 後端
+"""
+import os
+import tempfile
+
+from .settings import *  # noqa: F401,F403
+
+# benchmark_battles 會建立 / 刪除測試資料，只允許在此設定下執行
+BENCHMARK = True
+
+if os.getenv('BENCHMARK_DB', 'sqlite') == 'sqlite':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.getenv('BENCHMARK_SQLITE_PATH', os.path.join(tempfile.gettempdir(), 'aiherobattle_benchmark.sqlite3')),
+            # 多個 worker 執行緒同時寫入時等待鎖，而不是立刻失敗
+            'OPTIONS': {'timeout': 30},
+        }
+    }
+
+CELERY_TASK_ALWAYS_EAGER = False
+CELERY_TASK_EAGER_PROPAGATES = False
+CELERY_BROKER_URL = 'memory://'
+# memory broker 預設每秒輪詢一次隊列，會把排隊時間灌進延遲
+CELERY_BROKER_TRANSPORT_OPTIONS = {'polling_interval': 0.01}
+CELERY_RESULT_BACKEND = 'cache+memory://'
+REDIS_URL = ''
+
+os.environ.setdefault('LLM_BACKEND', 'stub')
+
+DEBUG = False
@@ -1,3 +1,5 @@
+import json
+import time
 from django.contrib import admin
 from django.utils.html import format_html
 from django.urls import reverse
@@ -13,7 +15,10 @@ from .models import (
 from .ladder_service import LadderService
 from django.shortcuts import redirect
 from .node_service import NodeHealthChecker
-import asyncio
+from .node_registry import invalidate_node_registry
+from .node_stats import node_stats
+from .node_metrics import health_factor
+from .node_breaker import breakers, STATE_LABELS, CLOSED, HALF_OPEN, OPEN
 
 
 @admin.register(Player)
@@ -577,31 +582,35 @@ class AINodeAdmin(admin.ModelAdmin):
     """AI節點管理"""
     list_display = [
         'name', 'url', 'status', 'is_online_display', 'is_available_display',
-        'success_rate_display', 'avg_response_time', 'current_load',
-        'last_heartbeat', 'actions_display'
+        'success_rate_display', 'avg_response_time', 'ewma_response_time', 'latency_p95_display',
+        'current_load', 'breaker_display', 'last_heartbeat', 'actions_display'
     ]
     list_filter = ['status', 'last_heartbeat', 'weight']
     search_fields = ['name', 'url']
     readonly_fields = [
         'id', 'created_at', 'updated_at', 'last_heartbeat', 
         'total_requests', 'successful_requests', 'avg_response_time',
-        'is_online_display', 'success_rate_display'
+        'ewma_response_time', 'latency_percentiles_display',
+        'is_online_display', 'success_rate_display', 'breaker_display', 'node_metrics_display'
     ]
-    actions = ['health_check_nodes', 'reset_stats', 'set_maintenance', 'set_online']
+    actions = ['health_check_nodes', 'reset_stats', 'reset_breakers', 'set_maintenance', 'set_online']
     
     fieldsets = (
         ('節點基本信息', {
             'fields': ('name', 'url', 'api_key', 'status')
         }),
         ('負載均衡設定', {
-            'fields': ('weight', 'max_concurrent_requests', 'current_requests')
+            'fields': ('weight', 'max_concurrent_requests', 'current_requests', 'queued_requests', 'queue_eta')
         }),
         ('性能統計', {
-            'fields': ('total_requests', 'successful_requests', 'avg_response_time', 'success_rate_display'),
+            'fields': (
+                'total_requests', 'successful_requests', 'avg_response_time', 'success_rate_display',
+                'ewma_response_time', 'latency_percentiles_display', 'node_metrics_display',
+            ),
             'classes': ('collapse',)
         }),
         ('狀態監控', {
-            'fields': ('last_heartbeat', 'is_online_display'),
+            'fields': ('last_heartbeat', 'is_online_display', 'breaker_display'),
             'classes': ('collapse',)
         }),
         ('系統信息', {
@@ -647,9 +656,64 @@ class AINodeAdmin(admin.ModelAdmin):
         return format_html('<span style="color: {};">{}</span>', color, f"{rate:.1f}%")
     success_rate_display.short_description = '成功率'
     
+    def latency_p95_display(self, obj):
+        p95 = obj.latency_p95
+        return '-' if p95 is None else f"{p95:.2f}s"
+    latency_p95_display.short_description = 'p95延遲'
+    
+    def latency_percentiles_display(self, obj):
+        stats = node_stats(obj)
+        if stats['latency_p50'] is None:
+            return '尚無樣本'
+        return (f"p50 {stats['latency_p50']:.2f}s / p95 {stats['latency_p95']:.2f}s / "
+                f"p99 {stats['latency_p99']:.2f}s（{stats['latency_samples']} 個樣本）")
+    latency_percentiles_display.short_description = '延遲分佈'
+    
+    def node_metrics_display(self, obj):
+        window = (obj.metrics or {}).get('window')
+        if not window:
+            return '尚未抓取（節點未提供 /metrics）'
+        def seconds(value):
+            return '-' if value is None else f"{value:.2f}s"
+        rounds = window.get('avg_rounds')
+        return format_html(
+            'LLM p50 {} / p95 {}，排隊 p95 {}<br>'
+            '請求 {}（忙碌 {}、錯誤 {}），Gemini 錯誤 {}（{}），本機修補 {}，平均回合 {}<br>'
+            '<span style="color: gray;">{} 前抓取，健康係數 {}</span>',
+            seconds(window.get('llm_p50')), seconds(window.get('llm_p95')), seconds(window.get('queue_p95')),
+            f"{window.get('requests', 0):.0f}", f"{window.get('busy', 0):.0f}", f"{window.get('errors', 0):.0f}",
+            f"{window.get('gemini_errors', 0):.0f}", f"{window.get('gemini_error_rate', 0):.0%}",
+            f"{window.get('repairs', 0):.0f}", '-' if rounds is None else f"{rounds:.1f}",
+            f"{time.time() - obj.metrics.get('scraped_at', time.time()):.0f}秒", f"{health_factor(obj):.2f}",
+        )
+    node_metrics_display.short_description = '節點端指標'
+    
+    def get_changelist_instance(self, request):
+        # 一次取回本頁所有節點的熔斷器狀態，避免每列各查一次 Redis
+        changelist = super().get_changelist_instance(request)
+        nodes = list(changelist.result_list)
+        states = breakers.states([node.id for node in nodes])
+        for node in nodes:
+            node.breaker_state = states[str(node.id)]
+        return changelist
+    
+    def breaker_display(self, obj):
+        info = getattr(obj, 'breaker_state', None) or breakers.states([obj.id])[str(obj.id)]
+        color = {CLOSED: 'green', HALF_OPEN: 'orange', OPEN: 'red'}[info['state']]
+        label = STATE_LABELS[info['state']]
+        if info['state'] == OPEN:
+            label += f"（{max(0, info['open_until'] - time.time()):.0f}秒後探測）"
+        elif info['failures']:
+            label += f"（連續失敗 {info['failures']} 次）"
+        return format_html('<span style="color: {};">{}</span>', color, label)
+    breaker_display.short_description = '熔斷器'
+    
     def current_load(self, obj):
         percentage = (obj.current_requests / obj.max_concurrent_requests) * 100 if obj.max_concurrent_requests > 0 else 0
-        return f"{obj.current_requests}/{obj.max_concurrent_requests} ({percentage:.0f}%)"
+        load = f"{obj.current_requests}/{obj.max_concurrent_requests} ({percentage:.0f}%)"
+        if obj.queued_requests:
+            load += f"，排隊 {obj.queued_requests}（約 {obj.queue_eta:.0f}秒）"
+        return load
     current_load.short_description = '當前負載'
     
     def actions_display(self, obj):
@@ -670,19 +734,14 @@ class AINodeAdmin(admin.ModelAdmin):
     def health_check_nodes(self, request, queryset):
         """健康檢查選中的節點"""
         try:
-            # 使用asyncio運行異步健康檢查
-            total_checked = 0
-            online_count = 0
-            
-            for node in queryset:
-                total_checked += 1
-                # 這裡應該調用實際的健康檢查邏輯
-                try:
-                    is_healthy = asyncio.run(NodeHealthChecker.check_node_health(node))
-                    if is_healthy:
-                        online_count += 1
-                except Exception as e:
-                    messages.warning(request, f'節點 {node.name} 健康檢查失敗: {str(e)}')
+            # 在同一個事件迴圈內並行檢查選中的節點，共用連線池
+            nodes = list(queryset)
+            total_checked = len(nodes)
+            results = NodeHealthChecker.probe_nodes(nodes)
+            online_count = sum(results)
+            for node, is_healthy in zip(nodes, results):
+                if not is_healthy:
+                    messages.warning(request, f'節點 {node.name} 健康檢查失敗')
             
             messages.success(request, f'健康檢查完成: {online_count}/{total_checked} 節點在線')
             
@@ -696,20 +755,44 @@ class AINodeAdmin(admin.ModelAdmin):
             node.total_requests = 0
             node.successful_requests = 0
             node.avg_response_time = 0.0
+            node.ewma_response_time = 0.0
+            node.latency_histogram = []
             node.save()
+        invalidate_node_registry()
         
         messages.success(request, f'已重置 {queryset.count()} 個節點的統計數據')
     reset_stats.short_description = '重置統計數據'
     
+    def reset_breakers(self, request, queryset):
+        """手動恢復熔斷中的節點"""
+        node_ids = list(queryset.values_list('id', flat=True))
+        breakers.reset(node_ids)
+        messages.success(request, f'已重置 {len(node_ids)} 個節點的熔斷器')
+    reset_breakers.short_description = '重置熔斷器'
+    
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        invalidate_node_registry()
+    
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        invalidate_node_registry()
+    
+    def delete_queryset(self, request, queryset):
+        super().delete_queryset(request, queryset)
+        invalidate_node_registry()
+    
     def set_maintenance(self, request, queryset):
         """設為維護狀態"""
         queryset.update(status='maintenance')
+        invalidate_node_registry()
         messages.success(request, f'已將 {queryset.count()} 個節點設為維護狀態')
     set_maintenance.short_description = '設為維護狀態'
     
     def set_online(self, request, queryset):
         """設為在線狀態"""
         queryset.update(status='online')
+        invalidate_node_registry()
         messages.success(request, f'已將 {queryset.count()} 個節點設為在線狀態')
     set_online.short_description = '設為在線狀態'
 
@@ -719,21 +802,21 @@ class BattleVotingRecordAdmin(admin.ModelAdmin):
     """戰鬥投票記錄管理"""
     list_display = [
         'battle_info', 'node_name', 'voted_winner_id', 
-        'is_valid', 'response_time', 'created_at'
+        'is_valid', 'is_late', 'response_time', 'created_at'
     ]
-    list_filter = ['is_valid', 'node__status', 'created_at']
+    list_filter = ['is_valid', 'is_late', 'node__status', 'created_at']
     search_fields = ['battle__id', 'node__name', 'voted_winner_id']
     readonly_fields = [
-        'id', 'battle', 'node', 'voted_winner_id', 'battle_result',
-        'response_time', 'is_valid', 'error_message', 'created_at'
+        'id', 'battle', 'node', 'voted_winner_id', 'result_blob', 'result_display',
+        'response_time', 'is_valid', 'is_late', 'error_message', 'created_at'
     ]
     
     fieldsets = (
         ('投票信息', {
-            'fields': ('battle', 'node', 'voted_winner_id', 'is_valid')
+            'fields': ('battle', 'node', 'voted_winner_id', 'is_valid', 'is_late')
         }),
         ('結果數據', {
-            'fields': ('battle_result',),
+            'fields': ('result_blob', 'result_display'),
             'classes': ('collapse',)
         }),
         ('性能數據', {
@@ -746,6 +829,10 @@ class BattleVotingRecordAdmin(admin.ModelAdmin):
         }),
     )
     
+    def result_display(self, obj):
+        return format_html('<pre>{}</pre>', json.dumps(obj.result, ensure_ascii=False, indent=2))
+    result_display.short_description = '節點返回的戰鬥結果'
+
     def battle_info(self, obj):
         return f"戰鬥 {obj.battle.id}"
     battle_info.short_description = '戰鬥'
@@ -0,0 +1,212 @@
+# 確定性戰鬥引擎：依屬性與種子計算權威的回合數值，LLM 只負責敘事
+import hashlib
+import os
+import random
+from typing import Dict, Optional
+
+# 戰鬥參數
+INITIAL_HP = int(os.getenv('BATTLE_INITIAL_HP', 300))  # 預設 300，可用環境變數覆寫
+MAX_ROUNDS = int(os.getenv('BATTLE_MAX_ROUNDS', 10))  # 回合上限（每回合雙方各出手一次）
+MAX_HIT = int(INITIAL_HP * 0.15)  # 單次傷害不超過初始血量的 15%
+CRIT_MULTIPLIER = 1.35
+LUCK_SWING = 0.15  # 幸運一次性意外：最多約 ±15% 偏移
+INITIATIVE_EDGE = 0.6  # 敏捷較高者的先手機率
+
+
+def dmg_params(STR, AGI):
+    """每回合基礎傷害區間"""
+    # 進一步降低係數與上限，延長回合
+    base = 0.3*STR + 0.15*AGI
+    low = max(3, int(base*0.8))
+    high = int(min(low + 12, base*0.95 + 10))
+    return low, high
+
+
+def crit_rate(LUK):
+    return min(0.15, 0.005*LUK)  # 上限 15%
+
+
+def dodge_suggestion(a_agi, d_agi):
+    diff = max(0, a_agi - d_agi)
+    return min(0.15, diff/180.0)  # 提升上限到 15%
+
+
+def luck_one_off(LUK):
+    """全場最多一次的幸運意外機率"""
+    return min(0.08, 0.0015*LUK)
+
+
+def battle_seed(battle_id) -> int:
+    """由 battle_id 推導種子，確保同一場戰鬥在任何節點都得到相同數值"""
+    return int(hashlib.sha256(str(battle_id).encode()).hexdigest()[:16], 16)
+
+
+def combat_profile(fighter, opponent) -> Dict:
+    """整理單一角色對上指定對手時的戰鬥參數"""
+    low, high = dmg_params(fighter.strength, fighter.agility)
+    return {
+        'dmg_low': low,
+        'dmg_high': high,
+        'crit': crit_rate(fighter.luck),
+        # 沿用原本提示詞的對應方式：被攻時的閃避率取 dodge_suggestion(對手敏捷, 自身敏捷)
+        'dodge': dodge_suggestion(opponent.agility, fighter.agility),
+        'luck': luck_one_off(fighter.luck),
+    }
+
+
+def _roll_damage(rng: random.Random, attacker: Dict, luck_state: Dict, side: int):
+    """計算單次攻擊，回傳 (傷害, 動作類型)"""
+    damage = rng.randint(attacker['dmg_low'], attacker['dmg_high']) + rng.randint(0, 2)
+    action = 'attack'
+    if rng.random() < attacker['crit']:
+        damage = damage * CRIT_MULTIPLIER
+        action = 'critical'
+    if not luck_state['used'] and rng.random() < attacker['luck']:
+        luck_state['used'] = True
+        luck_state['side'] = side
+        damage = damage * (1 + rng.uniform(-LUCK_SWING, LUCK_SWING))
+        action = 'lucky_' + action
+    return max(1, min(MAX_HIT, int(round(damage)))), action
+
+
+ACTION_LABELS = {
+    'attack': '攻擊',
+    'critical': '暴擊',
+    'lucky_attack': '幸運一擊',
+    'lucky_critical': '幸運暴擊',
+    'dodged': '閃避',
+}
+
+
+def _default_description(attacker, defender, action: str, damage: int, remaining_hp: int) -> str:
+    if action == 'dodged':
+        return f"{defender.name} 閃過了 {attacker.name} 的攻擊！"
+    return f"{attacker.name} 發動{ACTION_LABELS.get(action, '攻擊')}，對 {defender.name} 造成 {damage} 點傷害（剩餘 {remaining_hp}）"
+
+
+def simulate_battle(player, opponent, seed: int, max_rounds: Optional[int] = None) -> Dict:
+    """
+    依屬性與種子模擬整場戰鬥，回傳與 BattleResult 相同結構的權威戰鬥日誌。
+    同樣的 (角色屬性, seed) 一定得到同樣的結果。
+    """
+    rng = random.Random(seed)
+    max_rounds = max_rounds or MAX_ROUNDS
+
+    fighters = (player, opponent)
+    profiles = (combat_profile(player, opponent), combat_profile(opponent, player))
+    hp = [INITIAL_HP, INITIAL_HP]
+    luck_state = {'used': False, 'side': None}
+    battle_log = []
+
+    # 基於敏捷，較高者約 60% 機率先手
+    if player.agility > opponent.agility:
+        p_first = INITIATIVE_EDGE
+    elif player.agility < opponent.agility:
+        p_first = 1 - INITIATIVE_EDGE
+    else:
+        p_first = 0.5
+
+    rounds = 0
+    while rounds < max_rounds and hp[0] > 0 and hp[1] > 0:
+        rounds += 1
+        order = (0, 1) if rng.random() < p_first else (1, 0)
+        for a in order:
+            d = 1 - a
+            attacker, defender = fighters[a], fighters[d]
+            if rng.random() < profiles[d]['dodge']:
+                damage, action = 0, 'dodged'
+            else:
+                damage, action = _roll_damage(rng, profiles[a], luck_state, a)
+            hp[d] = max(0, hp[d] - damage)
+            battle_log.append({
+                'attacker': str(attacker.id),
+                'defender': str(defender.id),
+                'action': ACTION_LABELS[action],
+                'damage': damage,
+                'description': _default_description(attacker, defender, action, damage, hp[d]),
+                'remaining_hp': hp[d],
+            })
+            if hp[d] <= 0:
+                break
+
+    # 血量先歸零者輸；回合用盡則血量高者勝，平手由種子決定
+    if hp[1] <= 0:
+        winner = player
+    elif hp[0] <= 0:
+        winner = opponent
+    elif hp[0] != hp[1]:
+        winner = player if hp[0] > hp[1] else opponent
+    else:
+        winner = player if rng.random() < 0.5 else opponent
+
+    return {
+        'winner': str(winner.id),
+        'battle_log': battle_log,
+        'battle_description': f"經過 {rounds} 回合的激烈戰鬥，{winner.name} 最終獲得了勝利！",
+        'seed': seed,
+        'final_hp': {str(player.id): hp[0], str(opponent.id): hp[1]},
+    }
+
+
+def matchup_payload(player, opponent, engine_result: Dict) -> Dict:
+    """
+    精簡的對戰參數，取代完整提示詞送往 AI 節點（格式見 battle_prompt.py），
+    節點以同一份範本在本機渲染提示詞
+    """
+    from .battle_prompt import MATCHUP_VERSION
+
+    fighters = (player, opponent)
+    index = {str(fighter.id): i for i, fighter in enumerate(fighters)}
+    profiles = (combat_profile(player, opponent), combat_profile(opponent, player))
+    return {
+        'v': MATCHUP_VERSION,
+        'seed': engine_result['seed'],
+        'hp': INITIAL_HP,
+        'fighters': [
+            {
+                'id': str(fighter.id),
+                'name': fighter.name,
+                'desc': fighter.prompt,
+                'skill': fighter.skill_description,
+                'str': fighter.strength,
+                'agi': fighter.agility,
+                'luk': fighter.luck,
+                'dmg': [profile['dmg_low'], profile['dmg_high']],
+                'crit': round(profile['crit'], 4),
+                'dodge': round(profile['dodge'], 4),
+            }
+            for fighter, profile in zip(fighters, profiles)
+        ],
+        'log': [
+            [index[entry['attacker']], entry['action'], entry['damage'], entry['remaining_hp']]
+            for entry in engine_result['battle_log']
+        ],
+        'winner': index[engine_result['winner']],
+    }
+
+
+def apply_narration(engine_result: Dict, narrated: Optional[Dict]) -> Dict:
+    """
+    將 LLM / AI 節點撰寫的敘事套用到權威戰鬥日誌上。
+    數值欄位（attacker / defender / damage / remaining_hp / winner）一律以引擎為準，
+    只取用 action、description 與 battle_description。
+    """
+    result = {
+        **engine_result,
+        'battle_log': [dict(entry) for entry in engine_result['battle_log']],
+    }
+    if not narrated:
+        return result
+
+    narrated_log = narrated.get('battle_log') or []
+    for entry, story in zip(result['battle_log'], narrated_log):
+        if not isinstance(story, dict):
+            continue
+        if story.get('description'):
+            entry['description'] = str(story['description'])
+        if story.get('action'):
+            entry['action'] = str(story['action'])
+
+    if narrated.get('battle_description'):
+        result['battle_description'] = str(narrated['battle_description'])
+    return result
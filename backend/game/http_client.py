@@ -0,0 +1,95 @@
+# 聚合器到 AI 節點的共用 HTTP 連線池：每個 worker 行程一份，重用 keep-alive 連線，
+# 省去每次投票重新建立 TCP / TLS（Cloudflare tunnel 後的節點尤其明顯）
+import asyncio
+import os
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from typing import Tuple
+
+import aiohttp
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+_lock = threading.Lock()
+_state = {'pid': None, 'session': None, 'executor': None}
+# aiohttp session 綁定事件迴圈，每個迴圈各一份
+_aio_sessions = weakref.WeakKeyDictionary()
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def node_timeouts() -> Tuple[float, float]:
+    """(連線逾時, 讀取逾時)"""
+    return (
+        float(_setting('AI_NODE_CONNECT_TIMEOUT', 5)),
+        float(_setting('AI_NODE_TIMEOUT', 30)),
+    )
+
+
+def _ensure_process_state():
+    """prefork 之後子行程不可沿用父行程的 socket 與執行緒，偵測到 pid 變動就重建"""
+    pid = os.getpid()
+    if _state['pid'] != pid:
+        _state.update({'pid': pid, 'session': None, 'executor': None})
+        _aio_sessions.clear()
+
+
+def get_session() -> requests.Session:
+    """同步呼叫用的共用 Session（連線池上限依節點分開計算）"""
+    with _lock:
+        _ensure_process_state()
+        if _state['session'] is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=_setting('AI_NODE_POOL_HOSTS', 32),
+                pool_maxsize=_setting('AI_NODE_POOL_PER_HOST', 8),
+                max_retries=0,
+            )
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _state['session'] = session
+        return _state['session']
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """節點呼叫共用的執行緒池，避免每場戰鬥重建"""
+    with _lock:
+        _ensure_process_state()
+        if _state['executor'] is None:
+            _state['executor'] = ThreadPoolExecutor(
+                max_workers=_setting('AI_NODE_MAX_WORKERS', 32),
+                thread_name_prefix='ai-node',
+            )
+        return _state['executor']
+
+
+def get_aiohttp_session() -> aiohttp.ClientSession:
+    """目前事件迴圈的共用 aiohttp session（需在協程中呼叫）"""
+    loop = asyncio.get_running_loop()
+    with _lock:
+        _ensure_process_state()
+        session = _aio_sessions.get(loop)
+        if session is None or session.closed:
+            connect_timeout, read_timeout = node_timeouts()
+            connector = aiohttp.TCPConnector(
+                limit=_setting('AI_NODE_POOL_HOSTS', 32) * _setting('AI_NODE_POOL_PER_HOST', 8),
+                limit_per_host=_setting('AI_NODE_POOL_PER_HOST', 8),
+                ttl_dns_cache=_setting('AI_NODE_DNS_CACHE_TTL', 300),
+            )
+            session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=read_timeout, sock_connect=connect_timeout),
+            )
+            _aio_sessions[loop] = session
+        return session
+
+
+async def close_aiohttp_session():
+    """關閉目前事件迴圈的共用 session；用於 asyncio.run 這類短命迴圈結束前"""
+    session = _aio_sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None and not session.closed:
+        await session.close()
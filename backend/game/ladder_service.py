@@ -129,10 +129,30 @@ class LadderService:
         )
         
         # 計算初始賠率
-        battle.calculate_odds()
+        LadderService.set_opening_odds([battle])
         
         return battle
     
+    @staticmethod
+    def set_opening_odds(battles):
+        """以蒙地卡羅模擬一次為多場戰鬥計算開盤賠率"""
+        from .win_probability import price_matchups
+        from .battle_engine import battle_seed
+        
+        battles = list(battles)
+        if not battles:
+            return []
+        
+        matchups = [(b.fighter1.character, b.fighter2.character) for b in battles]
+        priced = price_matchups(matchups, seed=battle_seed(''.join(str(b.id) for b in battles)))
+        
+        for battle, odds in zip(battles, priced):
+            battle.fighter1_odds = odds['fighter1_odds']
+            battle.fighter2_odds = odds['fighter2_odds']
+        
+        ScheduledBattle.objects.bulk_update(battles, ['fighter1_odds', 'fighter2_odds'])
+        return priced
+    
     @staticmethod
     def select_fighters(season: LadderSeason):
         """選擇戰鬥對手"""
@@ -192,7 +212,8 @@ class LadderService:
         # 觸發戰鬥任務（避免循環導入）
         try:
             from .tasks import run_battle_task
-            run_battle_task.delay(actual_battle.id)
+            # 天梯戰鬥在節點的准入佇列中優先於一般戰鬥
+            run_battle_task.delay(actual_battle.id, priority='ladder')
         except ImportError:
             print("無法導入戰鬥任務，跳過任務觸發")
         
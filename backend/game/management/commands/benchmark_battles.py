@@ -0,0 +1,421 @@
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone as dt_timezone
+
+import requests
+from celery.signals import task_postrun, task_prerun
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.db.backends.signals import connection_created
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from backend.celery import app
+from game.models import AINode, Battle, Character, Player
+from game.node_registry import invalidate_node_registry
+from game.node_service import NodeManager
+from game.views import CharacterViewSet
+
+BENCH_PREFIX = 'bench-'
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def summarize(samples):
+    if not samples:
+        return None
+    return {
+        'count': len(samples),
+        'mean_ms': round(statistics.fmean(samples) * 1000, 1),
+        'p50_ms': round(percentile(samples, 50) * 1000, 1),
+        'p95_ms': round(percentile(samples, 95) * 1000, 1),
+        'p99_ms': round(percentile(samples, 99) * 1000, 1),
+        'max_ms': round(max(samples) * 1000, 1),
+    }
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class StageTimer:
+    """
+    以 Celery 的 task_prerun / task_postrun 訊號量測各任務耗時。eager 模式下後續階段在
+    run_battle_task 之內同步執行，因此記錄扣除子任務後的「自身耗時」，各階段加總即為總耗時
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.stages = {}    # 任務名稱 -> [自身耗時, ...]
+        self.busy = 0.0     # 最外層任務的總耗時（worker 忙碌時間）
+        self.visible = {}   # battle_id -> 玩家可見結果提交的時間
+        self.finished = {}  # battle_id -> 最後階段（確認交易）結束的時間
+        self.running = 0    # 已開始未結束的任務數
+
+    def _stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    @staticmethod
+    def _battle_id(args, kwargs):
+        return str(args[0] if args else (kwargs or {}).get('battle_id'))
+
+    def prerun(self, task_id=None, task=None, args=None, kwargs=None, **extra):
+        name = task.name.rsplit('.', 1)[-1]
+        now = time.perf_counter()
+        self._stack().append([name, now, 0.0])
+        with self.lock:
+            self.running += 1
+            if name == 'settle_battle_rewards_task':
+                # 第一階段已提交結果（eager 模式下後續階段在 run_battle_task 結束前就開始）
+                self.visible.setdefault(self._battle_id(args, kwargs), now)
+
+    def postrun(self, task_id=None, task=None, args=None, kwargs=None, **extra):
+        stack = self._stack()
+        if not stack:
+            return
+        name, started, children = stack.pop()
+        now = time.perf_counter()
+        elapsed = now - started
+        if stack:
+            stack[-1][2] += elapsed
+        with self.lock:
+            self.running -= 1
+            self.stages.setdefault(name, []).append(elapsed - children)
+            if not stack:
+                self.busy += elapsed
+            if name == 'run_battle_task':
+                self.visible.setdefault(self._battle_id(args, kwargs), now)
+            elif name == 'confirm_battle_tx_task':
+                self.finished.setdefault(self._battle_id(args, kwargs), now)
+
+    def record(self, name, elapsed):
+        with self.lock:
+            self.stages.setdefault(name, []).append(elapsed)
+
+    def reset(self):
+        with self.lock:
+            self.stages = {}
+            self.busy = 0.0
+            self.visible = {}
+            self.finished = {}
+
+
+class QueryCounter:
+    """計算所有執行緒（包含向節點發請求的執行緒池）送出的 SQL 查詢數"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        with self.lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+    def attach(self, connection, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+
+class Command(BaseCommand):
+    help = (
+        '端到端戰鬥吞吐量基準測試：啟動 N 個本機 AI 節點（stub LLM），以固定速率呼叫 '
+        'CharacterViewSet.battle → run_battle_task，回報吞吐量、各階段延遲分位數、'
+        '每場 DB 查詢數與 worker 使用率（JSON 輸出，可跨 commit 追蹤）'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--battles', type=int, default=50, help='量測的戰鬥數')
+        parser.add_argument('--warmup', type=int, default=5, help='不計入結果的暖身戰鬥數')
+        parser.add_argument('--rate', type=float, default=0, help='每秒發起的戰鬥數（0 表示一次全部送出）')
+        parser.add_argument('--celery', choices=['worker', 'eager'], default='worker',
+                            help='worker：行程內 Celery worker（memory broker、執行緒池）；'
+                                 'eager：在 API 請求內同步執行整條流程（只能單一 worker）')
+        parser.add_argument('--workers', type=int, default=4, help='Celery worker 執行緒數')
+        parser.add_argument('--nodes', type=int, default=3, help='啟動的本機 AI 節點數（0 表示只測本地回退）')
+        parser.add_argument('--node-concurrency', type=int, default=5, help='每個節點的 MAX_CONCURRENT_REQUESTS')
+        parser.add_argument('--llm-latency', type=float, default=0.2, help='stub LLM 平均延遲（秒）')
+        parser.add_argument('--llm-latency-dist', default='lognormal',
+                            choices=['fixed', 'uniform', 'exponential', 'lognormal'])
+        parser.add_argument('--llm-error-rate', type=float, default=0.0)
+        parser.add_argument('--llm-malformed-rate', type=float, default=0.0)
+        parser.add_argument('--timeout', type=float, default=300, help='等待所有戰鬥完成的秒數上限')
+        parser.add_argument('--ai-node-dir', default=str(settings.BASE_DIR.parent / 'ai_node'),
+                            help='ai_node 目錄（啟動其中的 main.py）')
+        parser.add_argument('--output', help='結果寫入的 JSON 檔；副檔名為 .jsonl 時附加一行，方便跨 commit 比較')
+        parser.add_argument('--label', default='', help='寫入結果的標籤')
+
+    def handle(self, *args, **options):
+        if not getattr(settings, 'BENCHMARK', False):
+            raise CommandError('此命令會建立與刪除資料，請以 --settings=backend.settings_benchmark 執行')
+        if options['celery'] == 'eager' and options['workers'] != 1:
+            # Celery 以行程全域旗標防止任務內等待結果，多執行緒同時跑 eager 任務會互相干擾
+            self.stdout.write('eager 模式只支援單一 worker，改用 --workers 1')
+            options['workers'] = 1
+
+        call_command('migrate', verbosity=0)
+        processes = []
+        timer = StageTimer()
+        queries = QueryCounter()
+        original_consensus = NodeManager.generate_battle_with_consensus_sync
+
+        def timed_consensus(manager, *args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return original_consensus(manager, *args, **kwargs)
+            finally:
+                timer.record('node_consensus', time.perf_counter() - started)
+
+        try:
+            nodes = self.start_nodes(options, processes)
+            player, characters = self.prepare_data()
+            NodeManager.generate_battle_with_consensus_sync = timed_consensus
+            task_prerun.connect(timer.prerun, weak=False)
+            task_postrun.connect(timer.postrun, weak=False)
+            connection_created.connect(queries.attach, weak=False)
+            for conn in connections.all():
+                queries.attach(conn)
+
+            with self.celery(options['celery'], options['workers']):
+                if options['warmup']:
+                    self.drive(options['warmup'], 0, player, characters, timer, options['timeout'])
+                timer.reset()
+                queries.count = 0
+                run = self.drive(options['battles'], options['rate'], player, characters, timer, options['timeout'])
+        finally:
+            NodeManager.generate_battle_with_consensus_sync = original_consensus
+            task_prerun.disconnect(timer.prerun)
+            task_postrun.disconnect(timer.postrun)
+            connection_created.disconnect(queries.attach)
+            for conn in connections.all():
+                if queries in conn.execute_wrappers:
+                    conn.execute_wrappers.remove(queries)
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                process.wait(timeout=10)
+            AINode.objects.filter(name__startswith=BENCH_PREFIX).delete()
+            invalidate_node_registry()
+
+        completed = run['completed']
+        duration = run['duration']
+        report = {
+            'label': options['label'],
+            'commit': self.git_commit(),
+            'timestamp': datetime.now(dt_timezone.utc).isoformat(timespec='seconds'),
+            'config': {
+                'battles': options['battles'],
+                'rate': options['rate'],
+                'celery': options['celery'],
+                'workers': options['workers'],
+                'nodes': len(nodes),
+                'node_concurrency': options['node_concurrency'],
+                'llm_latency': options['llm_latency'],
+                'llm_latency_dist': options['llm_latency_dist'],
+                'llm_error_rate': options['llm_error_rate'],
+                'llm_malformed_rate': options['llm_malformed_rate'],
+                'database': connection.vendor,
+            },
+            'results': {
+                'completed': completed,
+                'errors': run['errors'],
+                'duration_s': round(duration, 3),
+                'battles_per_sec': round(completed / duration, 3) if duration else 0.0,
+                # 從排定發起到玩家可見結果提交（第一階段完成）
+                'end_to_end': summarize(run['latencies']),
+                'api_request': summarize(run['request_times']),
+                'stages': {name: summarize(samples) for name, samples in sorted(timer.stages.items())},
+                'db_queries_per_battle': round(queries.count / completed, 1) if completed else None,
+                'worker_utilization': round(timer.busy / (options['workers'] * run['drained']), 3)
+                if run['drained'] else None,
+            },
+        }
+
+        self.stdout.write(json.dumps(report, indent=2, ensure_ascii=False))
+        if options['output']:
+            self.write_report(options['output'], report)
+        results = report['results']
+        self.stdout.write(self.style.SUCCESS(
+            f"{completed} 場完成、{run['errors']} 場失敗，{results['battles_per_sec']} 場/秒，"
+            f"端到端 p95 {results['end_to_end']['p95_ms'] if completed else '-'}ms，"
+            f"每場 {results['db_queries_per_battle']} 次查詢，worker 使用率 {results['worker_utilization']}"
+        ))
+
+    @contextmanager
+    def celery(self, mode, workers):
+        """eager：任務在呼叫端同步執行；worker：啟動行程內 worker，消費所有戰鬥階段的隊列"""
+        # 設定以 CELERY_ 命名空間從 Django settings 載入，帶前綴的鍵優先於 task_always_eager
+        app.conf.CELERY_TASK_ALWAYS_EAGER = mode == 'eager'
+        if mode == 'eager':
+            yield
+            return
+        from celery.contrib.testing.worker import start_worker
+
+        queues = sorted({route['queue'] for route in settings.CELERY_TASK_ROUTES.values()} | {'celery'})
+        with start_worker(app, pool='threads', concurrency=workers, perform_ping_check=False,
+                          loglevel='WARNING', queues=queues, shutdown_timeout=30):
+            yield
+
+    def start_nodes(self, options, processes):
+        """以 stub LLM 啟動 ai_node/main.py 子行程並登記為在線節點"""
+        AINode.objects.filter(name__startswith=BENCH_PREFIX).delete()
+        if not options['nodes']:
+            invalidate_node_registry()
+            return []
+        main_py = os.path.join(options['ai_node_dir'], 'main.py')
+        if not os.path.exists(main_py):
+            raise CommandError(f'找不到 AI 節點程式: {main_py}')
+
+        log_dir = tempfile.mkdtemp(prefix='benchmark-nodes-')
+        urls = []
+        for i in range(options['nodes']):
+            port = free_port()
+            env = dict(
+                os.environ,
+                NODE_NAME=f'{BENCH_PREFIX}node-{i}',
+                NODE_PORT=str(port),
+                AGGREGATOR_URL='',  # 由本命令直接寫入 AINode，不向聚合器註冊
+                LOG_DIR=log_dir,
+                MAX_CONCURRENT_REQUESTS=str(options['node_concurrency']),
+                LLM_BACKEND='stub',
+                LLM_STUB_LATENCY=str(options['llm_latency']),
+                LLM_STUB_LATENCY_DIST=options['llm_latency_dist'],
+                LLM_STUB_ERROR_RATE=str(options['llm_error_rate']),
+                LLM_STUB_MALFORMED_RATE=str(options['llm_malformed_rate']),
+                LLM_STUB_SEED=str(i),
+            )
+            processes.append(subprocess.Popen(
+                [sys.executable, 'main.py'], cwd=options['ai_node_dir'], env=env,
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            ))
+            urls.append(f'http://127.0.0.1:{port}')
+
+        deadline = time.time() + 30
+        for url, process in zip(urls, processes):
+            while True:
+                try:
+                    if requests.get(f'{url}/health', timeout=1).status_code == 200:
+                        break
+                except requests.RequestException:
+                    pass
+                if process.poll() is not None or time.time() > deadline:
+                    raise CommandError(f'AI 節點 {url} 無法啟動（日誌: {log_dir}）')
+                time.sleep(0.1)
+
+        nodes = [
+            AINode.objects.create(
+                name=f'{BENCH_PREFIX}node-{i}', url=url, status='online', last_heartbeat=timezone.now(),
+                max_concurrent_requests=options['node_concurrency'],
+            )
+            for i, url in enumerate(urls)
+        ]
+        invalidate_node_registry()
+        self.stdout.write(f"已啟動 {len(nodes)} 個 AI 節點（stub LLM，日誌: {log_dir}）")
+        return nodes
+
+    def prepare_data(self, count=8):
+        """一位體力無上限的測試玩家與數個角色，戰鬥在角色之間輪流配對"""
+        user, _ = User.objects.get_or_create(username=f'{BENCH_PREFIX}player')
+        player, _ = Player.objects.get_or_create(user=user)
+        Player.objects.filter(pk=player.pk).update(energy=10 ** 9, max_energy=10 ** 9)
+        player.refresh_from_db()
+        characters = list(Character.objects.filter(player=player).order_by('name')[:count])
+        for i in range(len(characters), count):
+            characters.append(Character.objects.create(
+                player=player, name=f'Bench {i}', prompt='benchmark fighter',
+                strength=80 + i * 7 % 40, agility=70 + i * 11 % 40, luck=60 + i * 13 % 40,
+                skill_description='benchmark skill',
+            ))
+        return player, characters
+
+    def drive(self, total, rate, player, characters, timer, timeout):
+        """
+        依排定時間呼叫戰鬥 API：rate > 0 時第 i 場排定在 i / rate 秒發起，延遲從排定時間起算，
+        worker 跟不上時排隊的時間也會反映在端到端延遲中。回傳前等待所有戰鬥與後續階段完成
+        """
+        view = CharacterViewSet.as_view({'post': 'battle'})
+        factory = APIRequestFactory()
+        scheduled, request_times = {}, []
+        errors = 0
+        started = time.perf_counter()
+
+        for i in range(total):
+            at = started + i / rate if rate > 0 else time.perf_counter()
+            wait = at - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            request_started = time.perf_counter()
+            request = factory.post('/api/characters/battle/', {
+                'player_character': str(characters[i % len(characters)].id),
+                'opponent_character': str(characters[(i + 1) % len(characters)].id),
+            }, format='json')
+            force_authenticate(request, user=player.user)
+            response = view(request)
+            request_times.append(time.perf_counter() - request_started)
+            if status.is_success(response.status_code):
+                scheduled[str(response.data['battle_id'])] = at
+            else:
+                errors += 1
+
+        deadline = time.perf_counter() + timeout
+        while time.perf_counter() < deadline and not all(battle_id in timer.visible for battle_id in scheduled):
+            time.sleep(0.05)
+        finished = max((timer.visible.get(battle_id, 0) for battle_id in scheduled), default=started)
+        # 等後續階段（發獎、IPFS、送交易、確認）也跑完，才計入 worker 使用率與查詢數
+        while time.perf_counter() < deadline and (
+                timer.running or not all(battle_id in timer.finished for battle_id in scheduled)):
+            time.sleep(0.05)
+        drained = max((timer.finished.get(battle_id, 0) for battle_id in scheduled), default=finished) - started
+
+        statuses = dict(Battle.objects.filter(id__in=list(scheduled)).values_list('id', 'status'))
+        done = [battle_id for battle_id in scheduled
+                if battle_id in timer.visible and statuses.get(uuid.UUID(battle_id)) == 'COMPLETED']
+        return {
+            'completed': len(done),
+            'errors': errors + len(scheduled) - len(done),
+            'duration': finished - started,
+            'drained': drained,
+            'latencies': [timer.visible[battle_id] - scheduled[battle_id] for battle_id in done],
+            'request_times': request_times,
+        }
+
+    @staticmethod
+    def git_commit():
+        try:
+            return subprocess.run(
+                ['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR,
+                capture_output=True, text=True, timeout=5,
+            ).stdout.strip() or None
+        except (OSError, subprocess.SubprocessError):
+            return None
+
+    @staticmethod
+    def write_report(path, report):
+        if path.endswith('.jsonl'):
+            with open(path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(report, ensure_ascii=False) + '\n')
+        else:
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=2, ensure_ascii=False)
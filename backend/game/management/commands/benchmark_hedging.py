@@ -0,0 +1,126 @@
+import json
+import random
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import requests
+from django.core.management.base import BaseCommand
+
+from game.node_service import HedgedDispatcher
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+class Command(BaseCommand):
+    help = '以本機假節點（注入延遲）比較開啟 / 關閉對沖請求時的共識延遲分佈'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rounds', type=int, default=200, help='每種模式執行的共識輪數')
+        parser.add_argument('--nodes', type=int, default=3, help='每輪投票的主節點數')
+        parser.add_argument('--spares', type=int, default=2, help='可用於對沖的備用節點數')
+        parser.add_argument('--base-latency', type=float, default=0.1, help='節點一般延遲（秒）')
+        parser.add_argument('--slow-rate', type=float, default=0.1, help='單次請求變慢的機率')
+        parser.add_argument('--slow-latency', type=float, default=2.0, help='變慢時的延遲（秒）')
+        parser.add_argument('--max-hedges', type=int, default=1, help='每輪最多送出的對沖請求數')
+        parser.add_argument('--warmup', type=int, default=30, help='量測各節點 p90 的暖身請求數')
+        parser.add_argument('--seed', type=int, default=42, help='延遲注入的隨機種子')
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        rng_lock = threading.Lock()
+
+        def injected_latency():
+            with rng_lock:
+                latency = options['base_latency'] * rng.lognormvariate(0, 0.25)
+                if rng.random() < options['slow_rate']:
+                    latency = options['slow_latency']
+            return latency
+
+        servers = [self.start_fake_node(injected_latency) for _ in range(options['nodes'] + options['spares'])]
+        nodes = [
+            SimpleNamespace(name=f'fake-{i}', url=f'http://127.0.0.1:{server.server_address[1]}', p90=0.0)
+            for i, server in enumerate(servers)
+        ]
+        session = requests.Session()
+
+        def request_fn(node):
+            try:
+                response = session.post(f'{node.url}/generate_battle', json={'battle_id': 'bench'}, timeout=30)
+                return response.json() if response.status_code == 200 else None
+            except Exception:
+                return None
+
+        def has_quorum(votes, planned):
+            return len(votes) > planned // 2
+
+        try:
+            # 暖身：量測各節點近期的 p90 延遲作為對沖門檻
+            for node in nodes:
+                samples = []
+                for _ in range(options['warmup']):
+                    start = time.time()
+                    request_fn(node)
+                    samples.append(time.time() - start)
+                node.p90 = percentile(samples, 90)
+            self.stdout.write('各節點 p90: ' + ', '.join(f'{n.name}={n.p90 * 1000:.0f}ms' for n in nodes))
+
+            report = {}
+            for label, max_hedges in (('no_hedging', 0), ('hedging', options['max_hedges'])):
+                latencies = []
+                hedges = 0
+                for _ in range(options['rounds']):
+                    primaries = rng.sample(nodes, options['nodes'])
+                    spares = [n for n in nodes if n not in primaries]
+                    dispatcher = HedgedDispatcher(
+                        request_fn=request_fn,
+                        hedge_delay_fn=lambda node: node.p90,
+                        max_hedges=max_hedges,
+                        quorum_fn=has_quorum,
+                    )
+                    start = time.time()
+                    dispatcher.run(primaries, spares)
+                    latencies.append(time.time() - start)
+                    hedges += dispatcher.stats['hedges_sent']
+                report[label] = {
+                    'p50_ms': round(statistics.median(latencies) * 1000, 1),
+                    'p95_ms': round(percentile(latencies, 95) * 1000, 1),
+                    'p99_ms': round(percentile(latencies, 99) * 1000, 1),
+                    'max_ms': round(max(latencies) * 1000, 1),
+                    'extra_requests_pct': round(hedges / (options['rounds'] * options['nodes']) * 100, 1),
+                }
+        finally:
+            for server in servers:
+                server.shutdown()
+
+        self.stdout.write(json.dumps(report, indent=2))
+        speedup = report['no_hedging']['p99_ms'] / max(report['hedging']['p99_ms'], 0.001)
+        self.stdout.write(self.style.SUCCESS(f'p99 改善: {speedup:.1f}x'))
+
+    @staticmethod
+    def start_fake_node(latency_fn):
+        class FakeNodeHandler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                self.rfile.read(length)
+                time.sleep(latency_fn())
+                body = json.dumps({'winner': 'fighter1', 'battle_log': [], 'battle_description': ''}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), FakeNodeHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
@@ -1,8 +1,10 @@
 from django.core.management.base import BaseCommand
 from game.tasks import check_node_health
 from game.models import AINode
+from game.node_service import NodeHealthChecker
 from django.utils import timezone
 from datetime import timedelta
+import time
 
 
 class Command(BaseCommand):
@@ -19,6 +21,11 @@ class Command(BaseCommand):
             action='store_true',
             help='只顯示節點狀態，不執行檢查',
         )
+        parser.add_argument(
+            '--probe',
+            action='store_true',
+            help='主動呼叫各節點的 /health（共用連線池並行探測）',
+        )
 
     def handle(self, *args, **options):
         if options['force_offline']:
@@ -42,10 +49,28 @@ class Command(BaseCommand):
         
         self.stdout.write(f'\n✅ 健康檢查完成: {result}')
         
+        if options['probe']:
+            self.probe_nodes()
+        
         # 顯示檢查後的狀態
         self.stdout.write('\n📊 檢查後節點狀態:')
         self.show_node_status()
 
+    def probe_nodes(self):
+        nodes = list(AINode.objects.all().order_by('name'))
+        if not nodes:
+            return
+        
+        self.stdout.write(f'\n📡 探測 {len(nodes)} 個節點的 /health...')
+        start = time.time()
+        results = NodeHealthChecker.probe_nodes(nodes)
+        for node, is_healthy in zip(nodes, results):
+            icon = '🟢' if is_healthy else '🔴'
+            self.stdout.write(f'  {icon} {node.name} ({node.url})')
+        self.stdout.write(
+            f'✅ 探測完成: {sum(results)}/{len(nodes)} 個節點回應正常，耗時 {time.time() - start:.2f}秒'
+        )
+
     def show_node_status(self):
         nodes = AINode.objects.all().order_by('name')
         
@@ -0,0 +1,179 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Sum
+from django.utils import timezone
+
+from game.models import BattleResultBlob, BattleVotingRecord
+
+# 結果內容先於引用它的投票寫入（見 NodeManager.save_voting_records），
+# 建立未滿此時間的內容即使尚無投票引用也不回收
+GC_GRACE = timedelta(hours=1)
+
+
+class Command(BaseCommand):
+    help = '把投票記錄中的內嵌戰鬥結果搬移為內容定址儲存，封存舊的結果內容，並回收無人引用的內容'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--report',
+            action='store_true',
+            help='只統計目前的儲存量與去重後可節省的空間',
+        )
+        parser.add_argument(
+            '--migrate',
+            action='store_true',
+            help='把舊格式（battle_result 內嵌 JSON）的投票記錄搬移到共用結果內容',
+        )
+        parser.add_argument(
+            '--archive-days',
+            type=int,
+            default=None,
+            help='把建立超過 N 天的結果內容壓縮封存',
+        )
+        parser.add_argument(
+            '--gc',
+            action='store_true',
+            help='刪除沒有任何投票記錄引用的結果內容（重跑略過的重複票、搬移失敗等留下的）',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='每批處理的記錄數（預設 500）',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='只顯示將處理的數量，不寫入資料庫',
+        )
+
+    def handle(self, *args, **options):
+        if not (options['migrate'] or options['archive_days'] is not None or options['gc']):
+            options['report'] = True
+
+        if options['report']:
+            self.report()
+        if options['migrate']:
+            self.migrate_inline(options['batch_size'], options['dry_run'])
+        if options['gc']:
+            # 先回收再封存，不浪費時間壓縮即將刪除的內容
+            self.collect_garbage(options['batch_size'], options['dry_run'])
+        if options['archive_days'] is not None:
+            self.archive(options['archive_days'], options['batch_size'], options['dry_run'])
+
+    def report(self):
+        self.stdout.write('📊 戰鬥結果儲存統計')
+        total_votes = BattleVotingRecord.objects.count()
+        inline = BattleVotingRecord.objects.filter(result_blob__isnull=True, battle_result__isnull=False)
+
+        inline_count = 0
+        inline_bytes = 0
+        distinct = {}
+        for result in inline.values_list('battle_result', flat=True).iterator(chunk_size=1000):
+            blob = BattleResultBlob.for_result(result)
+            inline_count += 1
+            inline_bytes += blob.size_bytes
+            distinct[blob.hash] = blob.size_bytes
+        deduped_bytes = sum(distinct.values())
+
+        blobs = BattleResultBlob.objects.all()
+        hot_bytes = blobs.filter(archived_at__isnull=True).aggregate(size=Sum('size_bytes'))['size'] or 0
+        archived = blobs.filter(archived_at__isnull=False)
+        archived_bytes = sum(len(data or b'') for data in archived.values_list('compressed', flat=True))
+
+        self.stdout.write(f'  投票記錄: {total_votes}，引用共用結果: {total_votes - inline_count}')
+        self.stdout.write(f'  舊格式內嵌結果: {inline_count} 筆，共 {inline_bytes / 1024:.1f} KB')
+        if inline_count:
+            saved = inline_bytes - deduped_bytes
+            self.stdout.write(
+                f'  去重後: {len(distinct)} 份不同結果，{deduped_bytes / 1024:.1f} KB'
+                f'（可節省 {saved / 1024:.1f} KB，{saved / inline_bytes:.0%}）'
+            )
+        self.stdout.write(
+            f'  共用結果內容: {blobs.count()} 份，未封存 {hot_bytes / 1024:.1f} KB，'
+            f'已封存 {archived.count()} 份（壓縮後 {archived_bytes / 1024:.1f} KB）'
+        )
+        orphans = self.orphans()
+        self.stdout.write(
+            f'  無投票引用的結果內容: {orphans.count()} 份，'
+            f'{(orphans.aggregate(size=Sum("size_bytes"))["size"] or 0) / 1024:.1f} KB（--gc 可回收）'
+        )
+
+    def orphans(self):
+        return BattleResultBlob.objects.filter(
+            votes__isnull=True, created_at__lt=timezone.now() - GC_GRACE
+        )
+
+    def migrate_inline(self, batch_size, dry_run):
+        queryset = BattleVotingRecord.objects.filter(
+            result_blob__isnull=True, battle_result__isnull=False
+        ).order_by('id')
+        pending = queryset.count()
+        if dry_run:
+            self.stdout.write(f'🔍 將搬移 {pending} 筆舊格式投票記錄')
+            return
+
+        moved = 0
+        while True:
+            # 每批搬移後這些記錄就不再符合條件，因此每次都取最前面一批
+            records = list(queryset.only('id', 'battle_result')[:batch_size])
+            if not records:
+                break
+            blobs = {}
+            for record in records:
+                blob = BattleResultBlob.for_result(record.battle_result)
+                blobs.setdefault(blob.hash, blob)
+                record.result_blob_id = blob.hash
+                record.battle_result = None
+            with transaction.atomic():
+                BattleResultBlob.objects.bulk_create(list(blobs.values()), ignore_conflicts=True)
+                BattleVotingRecord.objects.bulk_update(records, ['result_blob', 'battle_result'])
+            moved += len(records)
+            self.stdout.write(f'  已搬移 {moved}/{pending}')
+
+        self.stdout.write(self.style.SUCCESS(f'✅ 搬移完成，共 {moved} 筆投票記錄'))
+
+    def collect_garbage(self, batch_size, dry_run):
+        pending = self.orphans().count()
+        if dry_run:
+            self.stdout.write(f'🔍 將刪除 {pending} 份無投票引用的結果內容')
+            return
+
+        deleted = 0
+        while True:
+            hashes = list(self.orphans().order_by('hash').values_list('hash', flat=True)[:batch_size])
+            if not hashes:
+                break
+            # 刪除時再確認一次沒有引用，期間新寫入的投票引用的內容會保留
+            count, _ = BattleResultBlob.objects.filter(hash__in=hashes, votes__isnull=True).delete()
+            deleted += count
+
+        self.stdout.write(self.style.SUCCESS(f'✅ 回收完成，共刪除 {deleted} 份結果內容'))
+
+    def archive(self, days, batch_size, dry_run):
+        cutoff = timezone.now() - timedelta(days=days)
+        queryset = BattleResultBlob.objects.filter(
+            archived_at__isnull=True, payload__isnull=False, created_at__lt=cutoff
+        ).order_by('hash')
+        pending = queryset.count()
+        if dry_run:
+            self.stdout.write(f'🔍 將封存 {pending} 份建立超過 {days} 天的結果內容')
+            return
+
+        archived = 0
+        saved = 0
+        while True:
+            blobs = list(queryset[:batch_size])
+            if not blobs:
+                break
+            for blob in blobs:
+                blob.archive()
+                saved += blob.size_bytes - len(blob.compressed or b'')
+            BattleResultBlob.objects.bulk_update(blobs, ['payload', 'compressed', 'archived_at'])
+            archived += len(blobs)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'✅ 封存完成，共 {archived} 份，約節省 {saved / 1024:.1f} KB'
+        ))
@@ -0,0 +1,167 @@
+import json
+import statistics
+import time
+import uuid
+
+from django.core.management.base import BaseCommand, CommandError
+
+from game.battle_engine import INITIAL_HP, battle_seed, matchup_payload, simulate_battle
+from game.battle_prompt import render_prompt
+from game.models import Character
+
+
+def legacy_prompt(player, opponent, engine_result):
+    """改版前 run_battle_task 送往節點的完整提示詞（作為比較基準）"""
+    fixed_log = json.dumps([
+        {
+            'round': i + 1,
+            'attacker': entry['attacker'],
+            'defender': entry['defender'],
+            'action': entry['action'],
+            'damage': entry['damage'],
+            'remaining_hp': entry['remaining_hp'],
+        }
+        for i, entry in enumerate(engine_result['battle_log'])
+    ], ensure_ascii=False)
+
+    return f"""
+                        一場史詩般的對決即將展開！
+
+                        **你的任務是為一場已經決定好數值的戰鬥撰寫敘事。**
+
+                        第一步：請你自行想像一個極具創意、天馬行空的戰鬥地點。
+
+                        第二步：基於這個地點，為下方「固定戰鬥日誌」的每一個回合撰寫精彩的描述。請讓敘事具有電影感（環境描寫、音效感、鏡頭語言），巧妙融入場景對戰局的影響（例如地形、高度差、天氣、機關）。
+
+                        **戰鬥員資料：**
+
+                        角色1：
+                        ID：{player.id}
+                        名稱：{player.name}
+                        描述：{player.prompt}
+                        特殊能力：{player.skill_description}
+
+                        角色2：
+                        ID：{opponent.id}
+                        名稱：{opponent.name}
+                        描述：{opponent.prompt}
+                        特殊能力：{opponent.skill_description}
+
+                        **固定戰鬥日誌（數值已由系統決定，不可修改）：**
+                        初始血量：{INITIAL_HP}
+                        {fixed_log}
+
+                        **重要規則：**
+                        1. battle_log 必須與固定戰鬥日誌一一對應，回合數、順序完全相同。
+                        2. 每個回合的 attacker、defender、damage、remaining_hp 必須原樣照抄。
+                        3. action 可改寫為具體的招式名稱；damage 為 0 代表攻擊被閃避。
+                        4. description 請生動描寫該回合，可以使用擬聲詞，並使用角色名稱（{player.name}、{opponent.name}）。
+                        5. 要運用到角色的特殊能力，且至少有一次「招牌技能」的戲劇性演出。
+                        6. winner 必須填入：{engine_result['winner']}
+                        7. battle_description 請總結整場戰鬥。
+                        """
+
+
+def estimate_tokens(text: str) -> int:
+    """粗估輸入 token 數：中日韓文字約 1 字 1 token，其餘約 4 字元 1 token"""
+    cjk = sum(1 for ch in text if ord(ch) > 0x2E80)
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def request_bytes(payload: dict) -> int:
+    # 與 requests 的 json= 相同的序列化方式（ensure_ascii）
+    return len(json.dumps(payload).encode('utf-8'))
+
+
+class Command(BaseCommand):
+    help = '比較完整提示詞與精簡對戰參數（matchup）每場戰鬥的請求大小、輸入 token 與延遲'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--battles', type=int, default=20, help='抽樣的對戰數')
+        parser.add_argument('--nodes', type=int, default=3, help='每場戰鬥送出請求的節點數')
+        parser.add_argument(
+            '--live',
+            action='store_true',
+            help='實際呼叫 Gemini，量測真實輸入 token 與生成延遲（需 GEMINI_API_KEY，會產生費用）',
+        )
+        parser.add_argument('--model', default='gemini-2.0-flash', help='--live 使用的模型')
+
+    def handle(self, *args, **options):
+        characters = list(Character.objects.order_by('?')[:options['battles'] * 2])
+        if len(characters) < 2:
+            raise CommandError('至少需要兩個角色才能抽樣對戰')
+
+        samples = []
+        for i in range(options['battles']):
+            player = characters[(2 * i) % len(characters)]
+            opponent = characters[(2 * i + 1) % len(characters)]
+            if player.id == opponent.id:
+                continue
+            engine_result = simulate_battle(player, opponent, battle_seed(uuid.uuid4()))
+            matchup = matchup_payload(player, opponent, engine_result)
+            old_prompt = legacy_prompt(player, opponent, engine_result)
+            fields = {'battle_id': str(uuid.uuid4()), 'seed': 1, 'priority': 'casual', 'max_wait': 5}
+            samples.append({
+                'legacy_prompt': old_prompt,
+                'prompt': render_prompt(matchup),
+                'legacy_bytes': request_bytes({**fields, 'prompt': old_prompt}),
+                'bytes': request_bytes({**fields, 'matchup': matchup}),
+            })
+
+        legacy_bytes = statistics.mean(s['legacy_bytes'] for s in samples)
+        new_bytes = statistics.mean(s['bytes'] for s in samples)
+        legacy_tokens = statistics.mean(estimate_tokens(s['legacy_prompt']) for s in samples)
+        new_tokens = statistics.mean(estimate_tokens(s['prompt']) for s in samples)
+        nodes = options['nodes']
+
+        self.stdout.write(f'📦 抽樣 {len(samples)} 場戰鬥（每場送往 {nodes} 個節點）')
+        self.stdout.write(f"{'':<22}{'完整提示詞':>12}{'matchup':>12}{'減少':>8}")
+        self.row('單一請求大小 (bytes)', legacy_bytes, new_bytes)
+        self.row('每場請求總量 (bytes)', legacy_bytes * nodes, new_bytes * nodes)
+        self.row('提示詞長度 (字元)',
+                 statistics.mean(len(s['legacy_prompt']) for s in samples),
+                 statistics.mean(len(s['prompt']) for s in samples))
+        self.row('輸入 token（估計）', legacy_tokens, new_tokens)
+
+        if options['live']:
+            self.live(samples[:5], options['model'])
+        else:
+            self.stdout.write('（加上 --live 以實際呼叫 Gemini 量測真實 token 與端到端延遲）')
+
+    def row(self, label, legacy, new):
+        saved = 1 - new / legacy if legacy else 0
+        self.stdout.write(f'{label:<22}{legacy:>12.0f}{new:>12.0f}{saved:>8.0%}')
+
+    def live(self, samples, model):
+        import os
+        from google import genai
+        from game.tasks import BattleResult
+
+        api_key = os.getenv('GEMINI_API_KEY')
+        if not api_key:
+            raise CommandError('--live 需要設定 GEMINI_API_KEY')
+        client = genai.Client(api_key=api_key)
+
+        results = {'legacy_prompt': ([], []), 'prompt': ([], [])}
+        for sample in samples:
+            # 交錯呼叫兩種提示詞，避免時段差異影響比較
+            for key, (tokens, latencies) in results.items():
+                started = time.perf_counter()
+                response = client.models.generate_content(
+                    model=model,
+                    contents=sample[key],
+                    config={
+                        'response_mime_type': 'application/json',
+                        'response_schema': BattleResult,
+                    },
+                )
+                latencies.append(time.perf_counter() - started)
+                tokens.append(response.usage_metadata.prompt_token_count or 0)
+
+        (legacy_tokens, legacy_latency), (tokens, latency) = results['legacy_prompt'], results['prompt']
+        self.stdout.write(f'🔴 Gemini 實測（{len(samples)} 場）')
+        self.row('輸入 token（實測）', statistics.mean(legacy_tokens), statistics.mean(tokens))
+        self.stdout.write(
+            f"{'生成延遲 p50 (秒)':<22}{statistics.median(legacy_latency):>12.2f}"
+            f"{statistics.median(latency):>12.2f}"
+        )
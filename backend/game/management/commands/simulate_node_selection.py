@@ -0,0 +1,229 @@
+import hashlib
+import heapq
+import json
+import random
+import statistics
+from types import SimpleNamespace
+
+from django.core.management.base import BaseCommand
+
+from game.battle_engine import battle_seed
+from game.node_selection import InFlightTracker, node_score, select_nodes
+
+# 節點規格：(數量, 最大並發, 平均延遲秒數, 權重)
+FLEETS = {
+    # 少數大容量快節點 + 多數小容量慢節點，權重皆為預設值
+    'skewed': [(2, 10, 2.0, 1), (8, 2, 6.0, 1)],
+    # 同上，但管理員曾把小節點的權重調高（權重與實際容量不符）
+    'stale_weights': [(2, 10, 2.0, 1), (8, 2, 6.0, 3)],
+    # 對照組：同質節點
+    'uniform': [(10, 4, 3.0, 1)],
+}
+
+
+def legacy_select(nodes, num_nodes, battle_id, tracker=None):
+    """原本的選擇方式：以 battle_id 為種子，依靜態權重加權隨機抽取（改用獨立亂數源以免干擾模擬）"""
+    rng = random.Random(int(hashlib.md5(str(battle_id).encode()).hexdigest(), 16))
+    candidates = list(nodes)
+    selected = []
+    for _ in range(min(num_nodes, len(candidates))):
+        node = rng.choices(candidates, weights=[n.weight for n in candidates])[0]
+        selected.append(node)
+        candidates.remove(node)
+    return selected
+
+
+def p2c_select(nodes, num_nodes, battle_id, tracker=None):
+    """前一版的選擇方式：每次依權重抽兩個候選，取 node_score 較高者（二選一）"""
+    rng = random.Random(battle_seed(battle_id))
+    pool = sorted(nodes, key=lambda node: str(node.id))
+    scores = {node.id: node_score(node, tracker) for node in pool}
+
+    def pick(candidates):
+        return rng.choices(candidates, weights=[max(node.weight, 1e-3) for node in candidates])[0]
+
+    selected = []
+    while pool and len(selected) < num_nodes:
+        first = pick(pool)
+        rest = [node for node in pool if node is not first]
+        choice = first
+        if rest:
+            second = pick(rest)
+            choice = second if scores[second.id] > scores[first.id] else first
+        selected.append(choice)
+        pool.remove(choice)
+    return selected
+
+
+class SimClockTracker(InFlightTracker):
+    """以模擬時間取代牆上時間的在途請求追蹤器"""
+
+    def __init__(self, clock):
+        super().__init__()
+        self.clock = clock
+
+    def now(self):
+        return self.clock['now']
+
+
+SELECTORS = {
+    'weighted': legacy_select,
+    'p2c': p2c_select,
+    'hrw': select_nodes,
+}
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+class Command(BaseCommand):
+    help = '離散事件模擬：比較加權隨機、二選一與加權 rendezvous 調度在不均質節點群上的吞吐量、拒絕率與節點異動時的重新分配比例'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fleet', choices=list(FLEETS) + ['all'], default='all', help='節點群組態')
+        parser.add_argument('--rate', type=float, default=1.5, help='每秒到達的戰鬥數')
+        parser.add_argument('--duration', type=float, default=600, help='模擬秒數')
+        parser.add_argument('--votes', type=int, default=3, help='每場戰鬥的投票節點數')
+        parser.add_argument('--heartbeat', type=float, default=10, help='調度器看到的節點狀態更新間隔（秒）')
+        parser.add_argument('--workers', type=int, default=4, help='各自只知道自身在途請求的 worker 行程數')
+        parser.add_argument('--seed', type=int, default=7, help='模擬亂數種子')
+        parser.add_argument('--json', action='store_true', help='以 JSON 輸出結果')
+
+    def handle(self, *args, **options):
+        fleets = list(FLEETS) if options['fleet'] == 'all' else [options['fleet']]
+        report = {}
+        for fleet in fleets:
+            report[fleet] = {}
+            for name, selector in SELECTORS.items():
+                report[fleet][name] = self.simulate(FLEETS[fleet], selector, options)
+                report[fleet][name]['moved_rate'] = self.churn(FLEETS[fleet], selector, options)
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+
+        header = (f"{'fleet':<14}{'selector':<10}{'battles/s':>10}{'reject%':>9}{'failed%':>9}"
+                  f"{'p50(s)':>8}{'p99(s)':>8}{'moved%':>8}")
+        self.stdout.write(header)
+        self.stdout.write('-' * len(header))
+        for fleet, results in report.items():
+            for name, r in results.items():
+                self.stdout.write(
+                    f"{fleet:<14}{name:<10}{r['throughput']:>10.3f}{r['rejection_rate'] * 100:>9.1f}"
+                    f"{r['failed_rate'] * 100:>9.1f}{r['p50_latency']:>8.2f}{r['p99_latency']:>8.2f}"
+                    f"{r['moved_rate'] * 100:>8.1f}"
+                )
+
+    def churn(self, spec, selector, options, battles=2000):
+        """
+        一個節點離線時，原本沒選到該節點、卻被換了節點的戰鬥比例。
+        這些戰鬥重試時會落到新節點，無法命中節點端的結果快取。
+        節點皆為閒置，只看分配本身的穩定性。
+        """
+        nodes = []
+        for count, capacity, latency, weight in spec:
+            for _ in range(count):
+                nodes.append(SimpleNamespace(
+                    id=f'node-{len(nodes):03d}', weight=weight, max_concurrent_requests=capacity,
+                    current_requests=0, last_heartbeat=0.0, avg_response_time=latency,
+                ))
+        removed = nodes[len(nodes) // 2]
+        remaining = [node for node in nodes if node is not removed]
+        tracker = InFlightTracker()
+        moved = unaffected = 0
+        for i in range(battles):
+            before = {node.id for node in selector(nodes, options['votes'], f'battle-{i}', tracker=tracker)}
+            if removed.id in before:
+                continue
+            unaffected += 1
+            after = {node.id for node in selector(remaining, options['votes'], f'battle-{i}', tracker=tracker)}
+            moved += before != after
+        return moved / unaffected if unaffected else 0.0
+
+    def simulate(self, spec, selector, options):
+        rng = random.Random(options['seed'])
+        nodes = []
+        for count, capacity, latency, weight in spec:
+            for _ in range(count):
+                nodes.append(SimpleNamespace(
+                    id=f'node-{len(nodes):03d}', weight=weight, max_concurrent_requests=capacity,
+                    base_latency=latency, in_flight=0, completed=0, total_latency=0.0,
+                ))
+
+        def snapshot(now):
+            # 調度器看到的是心跳時的狀態，而非即時狀態
+            return [SimpleNamespace(
+                id=n.id, weight=n.weight, max_concurrent_requests=n.max_concurrent_requests,
+                current_requests=n.in_flight, last_heartbeat=now,
+                avg_response_time=n.total_latency / n.completed if n.completed else 0.0,
+                real=n,
+            ) for n in nodes]
+
+        majority = options['votes'] // 2 + 1
+        events = []
+        seq = 0
+        t = 0.0
+        battle_index = 0
+        while t < options['duration']:
+            t += rng.expovariate(options['rate'])
+            heapq.heappush(events, (t, seq, 'arrive', battle_index))
+            seq += 1
+            battle_index += 1
+
+        view = snapshot(0.0)
+        clock = {'now': 0.0}
+        trackers = [SimClockTracker(clock) for _ in range(options['workers'])]
+        next_refresh = options['heartbeat']
+        battles = {}
+        dispatched = rejected = 0
+
+        while events:
+            now, _, kind, payload = heapq.heappop(events)
+            clock['now'] = now
+            while now >= next_refresh:
+                view = snapshot(next_refresh)
+                next_refresh += options['heartbeat']
+
+            if kind == 'arrive':
+                battle = {'start': now, 'ok': 0, 'failed': 0, 'done_at': None}
+                battles[payload] = battle
+                tracker = trackers[payload % len(trackers)]
+                for chosen in selector(view, options['votes'], f'battle-{payload}', tracker=tracker):
+                    node = chosen.real
+                    dispatched += 1
+                    if node.in_flight >= node.max_concurrent_requests:
+                        # 節點滿載，回應 503
+                        rejected += 1
+                        battle['failed'] += 1
+                        continue
+                    node.in_flight += 1
+                    service = node.base_latency * rng.lognormvariate(0, 0.3)
+                    token = tracker.start(node.id, at=now)
+                    heapq.heappush(events, (now + service, seq, 'finish', (payload, node, service, tracker, token)))
+                    seq += 1
+            else:
+                battle_id, node, service, tracker, token = payload
+                tracker.finish(node.id, token)
+                node.in_flight -= 1
+                node.completed += 1
+                node.total_latency += service
+                battle = battles[battle_id]
+                battle['ok'] += 1
+                if battle['ok'] == majority:
+                    battle['done_at'] = now
+
+        latencies = [b['done_at'] - b['start'] for b in battles.values() if b['done_at'] is not None]
+        total = len(battles) or 1
+        return {
+            'battles': len(battles),
+            'throughput': len(latencies) / options['duration'],
+            'rejection_rate': rejected / dispatched if dispatched else 0.0,
+            'failed_rate': 1 - len(latencies) / total,
+            'p50_latency': statistics.median(latencies) if latencies else 0.0,
+            'p99_latency': percentile(latencies, 99),
+        }
@@ -0,0 +1,23 @@
+from django.db import migrations, models
+
+
+def mark_existing_battles_settled(apps, schema_editor):
+    # 舊流程在生成結果時已同步發放獎勵
+    Battle = apps.get_model('game', 'Battle')
+    Battle.objects.filter(status='COMPLETED').update(rewards_settled=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0015_battle_onchain_fields'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='battle',
+            name='rewards_settled',
+            field=models.BooleanField(default=False, verbose_name='獎勵是否已發放'),
+        ),
+        migrations.RunPython(mark_existing_battles_settled, migrations.RunPython.noop),
+    ]
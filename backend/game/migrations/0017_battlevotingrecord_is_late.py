@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0016_battle_rewards_settled'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='battlevotingrecord',
+            name='is_late',
+            field=models.BooleanField(default=False, verbose_name='是否為達成共識後的遲到票'),
+        ),
+    ]
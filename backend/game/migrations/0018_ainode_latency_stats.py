@@ -0,0 +1,23 @@
+# Generated by Django 5.0.2 on 2026-10-18 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0017_battlevotingrecord_is_late'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ainode',
+            name='ewma_response_time',
+            field=models.FloatField(default=0.0, verbose_name='近期響應時間(EWMA,秒)'),
+        ),
+        migrations.AddField(
+            model_name='ainode',
+            name='latency_histogram',
+            field=models.JSONField(blank=True, default=list, verbose_name='響應時間分佈'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.0.2 on 2026-10-18 10:14
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0018_ainode_latency_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BattleResultBlob',
+            fields=[
+                ('hash', models.CharField(max_length=64, primary_key=True, serialize=False, verbose_name='結果雜湊(sha256)')),
+                ('payload', models.JSONField(blank=True, null=True, verbose_name='結果內容')),
+                ('compressed', models.BinaryField(blank=True, null=True, verbose_name='封存的壓縮內容')),
+                ('size_bytes', models.PositiveIntegerField(default=0, verbose_name='標準化JSON大小(bytes)')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('archived_at', models.DateTimeField(blank=True, null=True, verbose_name='封存時間')),
+            ],
+            options={
+                'verbose_name': '戰鬥結果內容',
+                'verbose_name_plural': '戰鬥結果內容',
+            },
+        ),
+        migrations.AlterField(
+            model_name='battlevotingrecord',
+            name='battle_result',
+            field=models.JSONField(blank=True, null=True, verbose_name='節點返回的戰鬥結果(舊格式)'),
+        ),
+        migrations.AddField(
+            model_name='battlevotingrecord',
+            name='result_blob',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='votes', to='game.battleresultblob', verbose_name='節點返回的戰鬥結果'),
+        ),
+    ]
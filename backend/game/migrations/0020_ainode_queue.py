@@ -0,0 +1,23 @@
+# Generated by Django 5.0.2 on 2026-10-18 10:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0019_battle_result_blobs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ainode',
+            name='queue_eta',
+            field=models.FloatField(default=0.0, verbose_name='預估排隊時間(秒)'),
+        ),
+        migrations.AddField(
+            model_name='ainode',
+            name='queued_requests',
+            field=models.PositiveIntegerField(default=0, verbose_name='排隊請求數'),
+        ),
+    ]
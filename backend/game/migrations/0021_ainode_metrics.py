@@ -0,0 +1,18 @@
+# Generated by Django 5.0.2 on 2026-10-18 10:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0020_ainode_queue'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ainode',
+            name='metrics',
+            field=models.JSONField(blank=True, default=dict, verbose_name='節點指標'),
+        ),
+    ]
@@ -1,4 +1,7 @@
+import hashlib
+import json
 import uuid
+import zlib
 from django.db import models
 from django.contrib.auth.models import User
 from django.utils import timezone
@@ -171,6 +174,7 @@ class Battle(models.Model):
     battle_log = models.JSONField(default=dict)
     created_at = models.DateTimeField(auto_now_add=True)
     status = models.CharField(max_length=10, choices=BATTLE_STATUS_CHOICES, default='PENDING')
+    rewards_settled = models.BooleanField(default=False, verbose_name='獎勵是否已發放')
 
     # 鏈上存證欄位
     onchain_status = models.CharField(max_length=16, null=True, blank=True, db_index=True)
@@ -392,15 +396,15 @@ class ScheduledBattle(models.Model):
     def calculate_odds(self):
         """動態計算賠率"""
         if self.fighter1_bets_amount == 0 and self.fighter2_bets_amount == 0:
-            # 沒有下注時，根據排名計算基礎賠率
-            rank_diff = abs(self.fighter1.current_rank - self.fighter2.current_rank)
-            if self.fighter1.current_rank < self.fighter2.current_rank:
-                # fighter1排名更高（數字更小）
-                self.fighter1_odds = max(1.2, 2.0 - (rank_diff * 0.1))
-                self.fighter2_odds = min(5.0, 2.0 + (rank_diff * 0.1))
-            else:
-                self.fighter1_odds = min(5.0, 2.0 + (rank_diff * 0.1))
-                self.fighter2_odds = max(1.2, 2.0 - (rank_diff * 0.1))
+            # 沒有下注時，以戰鬥模擬的勝率計算開盤賠率
+            from .win_probability import price_matchups
+            from .battle_engine import battle_seed
+            priced = price_matchups(
+                [(self.fighter1.character, self.fighter2.character)],
+                seed=battle_seed(self.id)
+            )[0]
+            self.fighter1_odds = priced['fighter1_odds']
+            self.fighter2_odds = priced['fighter2_odds']
         else:
             # 根據下注金額動態調整賠率
             from decimal import Decimal
@@ -559,11 +563,17 @@ class AINode(models.Model):
     total_requests = models.PositiveIntegerField(default=0, verbose_name='總請求數')
     successful_requests = models.PositiveIntegerField(default=0, verbose_name='成功請求數')
     avg_response_time = models.FloatField(default=0.0, verbose_name='平均響應時間(秒)')
+    ewma_response_time = models.FloatField(default=0.0, verbose_name='近期響應時間(EWMA,秒)')
+    latency_histogram = models.JSONField(default=list, blank=True, verbose_name='響應時間分佈')
+    # 由 /metrics 抓取的節點端指標（見 node_metrics.py）
+    metrics = models.JSONField(default=dict, blank=True, verbose_name='節點指標')
     
     # 負載均衡權重
     weight = models.PositiveIntegerField(default=1, verbose_name='權重')
     max_concurrent_requests = models.PositiveIntegerField(default=5, verbose_name='最大並發請求數')
     current_requests = models.PositiveIntegerField(default=0, verbose_name='當前請求數')
+    queued_requests = models.PositiveIntegerField(default=0, verbose_name='排隊請求數')
+    queue_eta = models.FloatField(default=0.0, verbose_name='預估排隊時間(秒)')
     
     # 時間戳
     created_at = models.DateTimeField(auto_now_add=True)
@@ -591,25 +601,39 @@ class AINode(models.Model):
                 self.current_requests < self.max_concurrent_requests)
     
     def update_heartbeat(self):
-        """更新心跳時間"""
+        """更新心跳時間，回傳狀態是否因此改變（離線 → 在線）"""
         self.last_heartbeat = timezone.now()
-        if self.status == 'offline':
+        update_fields = ['last_heartbeat']
+        status_changed = self.status == 'offline'
+        if status_changed:
             self.status = 'online'
-        self.save(update_fields=['last_heartbeat', 'status'])
+            update_fields.append('status')
+        self.save(update_fields=update_fields)
+        return status_changed
     
     def record_request(self, success=True, response_time=0.0):
-        """記錄請求統計"""
-        self.total_requests += 1
-        if success:
-            self.successful_requests += 1
-        
-        # 更新平均響應時間
-        if self.total_requests == 1:
-            self.avg_response_time = response_time
-        else:
-            self.avg_response_time = ((self.avg_response_time * (self.total_requests - 1)) + response_time) / self.total_requests
-        
-        self.save(update_fields=['total_requests', 'successful_requests', 'avg_response_time'])
+        """記錄請求統計：先寫入行程內緩衝，由 node_stats 以行鎖批次寫回；同時更新熔斷器"""
+        from .node_stats import recorder
+        from .node_breaker import breakers
+        recorder.record(self.pk, success, response_time)
+        breakers.record(self.pk, success)
+    
+    def latency_percentile(self, q):
+        """近期響應時間的第 q 百分位（秒），尚無樣本時為 None"""
+        from .node_stats import latency_percentile
+        return latency_percentile(self.latency_histogram, q)
+    
+    @property
+    def latency_p50(self):
+        return self.latency_percentile(50)
+    
+    @property
+    def latency_p95(self):
+        return self.latency_percentile(95)
+    
+    @property
+    def latency_p99(self):
+        return self.latency_percentile(99)
     
     def __str__(self):
         return f"{self.name} ({self.status})"
@@ -620,6 +644,52 @@ class AINode(models.Model):
         ordering = ['-created_at']
 
 
+class BattleResultBlob(models.Model):
+    """
+    內容定址的節點戰鬥結果：以標準化 JSON 的 sha256 為主鍵，相同結果只存一份。
+    冷資料可封存為 zlib 壓縮內容（payload 清空、compressed 保存）。
+    """
+    hash = models.CharField(max_length=64, primary_key=True, verbose_name='結果雜湊(sha256)')
+    payload = models.JSONField(null=True, blank=True, verbose_name='結果內容')
+    compressed = models.BinaryField(null=True, blank=True, verbose_name='封存的壓縮內容')
+    size_bytes = models.PositiveIntegerField(default=0, verbose_name='標準化JSON大小(bytes)')
+    created_at = models.DateTimeField(auto_now_add=True)
+    archived_at = models.DateTimeField(null=True, blank=True, verbose_name='封存時間')
+    
+    @staticmethod
+    def canonical_json(result) -> bytes:
+        """標準化序列化：鍵排序、無多餘空白，確保相同內容得到相同雜湊"""
+        return json.dumps(result, sort_keys=True, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+    
+    @classmethod
+    def for_result(cls, result):
+        """建立（尚未寫入的）結果物件，主鍵即內容雜湊"""
+        data = cls.canonical_json(result)
+        return cls(hash=hashlib.sha256(data).hexdigest(), payload=result, size_bytes=len(data))
+    
+    def get_payload(self):
+        if self.payload is not None:
+            return self.payload
+        if self.compressed:
+            return json.loads(zlib.decompress(bytes(self.compressed)).decode('utf-8'))
+        return None
+    
+    def archive(self):
+        """把內容壓縮封存，釋放 JSON 欄位（呼叫端負責儲存）"""
+        if self.payload is None:
+            return
+        self.compressed = zlib.compress(self.canonical_json(self.payload), 9)
+        self.payload = None
+        self.archived_at = timezone.now()
+    
+    def __str__(self):
+        return f"{self.hash[:12]} ({self.size_bytes} bytes)"
+    
+    class Meta:
+        verbose_name = '戰鬥結果內容'
+        verbose_name_plural = '戰鬥結果內容'
+
+
 class BattleVotingRecord(models.Model):
     """戰鬥結果投票記錄"""
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -628,15 +698,28 @@ class BattleVotingRecord(models.Model):
     
     # 投票結果
     voted_winner_id = models.CharField(max_length=100, verbose_name='投票的獲勝者ID')
-    battle_result = models.JSONField(verbose_name='節點返回的戰鬥結果')
+    # 新紀錄只引用內容定址的結果；battle_result 保留給尚未搬移的舊紀錄
+    result_blob = models.ForeignKey(
+        BattleResultBlob, on_delete=models.PROTECT, null=True, blank=True,
+        related_name='votes', verbose_name='節點返回的戰鬥結果'
+    )
+    battle_result = models.JSONField(null=True, blank=True, verbose_name='節點返回的戰鬥結果(舊格式)')
     response_time = models.FloatField(verbose_name='響應時間(秒)')
     
     # 狀態
     is_valid = models.BooleanField(default=True, verbose_name='投票是否有效')
+    is_late = models.BooleanField(default=False, verbose_name='是否為達成共識後的遲到票')
     error_message = models.TextField(null=True, blank=True, verbose_name='錯誤信息')
     
     created_at = models.DateTimeField(auto_now_add=True)
     
+    @property
+    def result(self):
+        """節點返回的戰鬥結果（不論存於結果庫或舊欄位）"""
+        if self.result_blob_id:
+            return self.result_blob.get_payload()
+        return self.battle_result
+    
     def __str__(self):
         return f"{self.node.name} votes for {self.voted_winner_id} in battle {self.battle.id}"
     
@@ -0,0 +1,187 @@
+# 節點熔斷器：連續失敗達門檻即熔斷（open），冷卻後放行單一探測請求（half-open），
+# 探測成功恢復（closed）、失敗則冷卻時間加倍。狀態存於 Redis 供所有 worker 共用，Redis 不可用時退回行程內狀態
+import logging
+import threading
+import time
+from typing import Dict, Iterable, List
+
+from django.conf import settings
+
+from .models import AINode
+from .node_registry import get_redis, mark_redis_down
+
+logger = logging.getLogger(__name__)
+
+FAILURES_KEY = 'ai_nodes:breaker:failures'
+COOLDOWN_KEY = 'ai_nodes:breaker:cooldown'
+OPEN_KEY = 'ai_nodes:breaker:open:{}'
+PROBE_KEY = 'ai_nodes:breaker:probe:{}'
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+STATE_LABELS = {CLOSED: '正常', OPEN: '熔斷中', HALF_OPEN: '探測中'}
+
+
+class CircuitBreakerBoard:
+    """所有節點的熔斷狀態"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local: Dict[str, dict] = {}   # Redis 不可用時的行程內狀態
+        self._cache: Dict[str, tuple] = {}  # 最近讀到的狀態 (讀取時間, 狀態)，供調度時快速查詢
+
+    @property
+    def failure_threshold(self) -> int:
+        return getattr(settings, 'AI_NODE_BREAKER_FAILURES', 5)
+
+    @property
+    def cooldown(self) -> float:
+        return getattr(settings, 'AI_NODE_BREAKER_COOLDOWN', 30)
+
+    @property
+    def max_cooldown(self) -> float:
+        return getattr(settings, 'AI_NODE_BREAKER_MAX_COOLDOWN', 300)
+
+    @property
+    def probe_ttl(self) -> float:
+        # 探測請求最多佔用的時間，逾時後其他戰鬥可再次探測
+        return getattr(settings, 'AI_NODE_BREAKER_PROBE_TTL', getattr(settings, 'AI_NODE_TIMEOUT', 30))
+
+    def _state(self, failures: int, open_until: float) -> dict:
+        if failures < self.failure_threshold:
+            state = CLOSED
+        elif open_until > time.time():
+            state = OPEN
+        else:
+            state = HALF_OPEN
+        return {'state': state, 'failures': failures, 'open_until': open_until if state == OPEN else None}
+
+    def states(self, node_ids: Iterable) -> Dict[str, dict]:
+        """批次讀取節點的熔斷狀態（Redis 上一次往返）"""
+        node_ids = [str(node_id) for node_id in node_ids]
+        if not node_ids:
+            return {}
+
+        client = get_redis()
+        result = None
+        if client is not None:
+            try:
+                pipe = client.pipeline(transaction=False)
+                pipe.hmget(FAILURES_KEY, node_ids)
+                pipe.mget([OPEN_KEY.format(node_id) for node_id in node_ids])
+                failures, opened = pipe.execute()
+                result = {
+                    node_id: self._state(int(count or 0), float(open_until or 0))
+                    for node_id, count, open_until in zip(node_ids, failures, opened)
+                }
+            except Exception as e:
+                mark_redis_down(e)
+        if result is None:
+            with self._lock:
+                result = {
+                    node_id: self._state(
+                        self._local.get(node_id, {}).get('failures', 0),
+                        self._local.get(node_id, {}).get('open_until', 0.0),
+                    )
+                    for node_id in node_ids
+                }
+
+        now = time.monotonic()
+        with self._lock:
+            for node_id, state in result.items():
+                self._cache[node_id] = (now, state['state'])
+        return result
+
+    def state(self, node_id, max_age: float = 1.0) -> str:
+        """節點目前的熔斷狀態；max_age 秒內讀過就直接使用快取"""
+        cached = self._cache.get(str(node_id))
+        if cached and time.monotonic() - cached[0] < max_age:
+            return cached[1]
+        return self.states([node_id])[str(node_id)]['state']
+
+    def acquire_probe(self, node_id) -> bool:
+        """half-open 的節點同一時間只放行一個探測請求"""
+        node_id = str(node_id)
+        ttl = max(1, int(self.probe_ttl))
+        client = get_redis()
+        if client is not None:
+            try:
+                return bool(client.set(PROBE_KEY.format(node_id), 1, nx=True, ex=ttl))
+            except Exception as e:
+                mark_redis_down(e)
+        with self._lock:
+            entry = self._local.setdefault(node_id, {})
+            if entry.get('probe_until', 0.0) > time.time():
+                return False
+            entry['probe_until'] = time.time() + ttl
+            return True
+
+    def filter_available(self, nodes: List[AINode]) -> List[AINode]:
+        """排除熔斷中的節點；half-open 的節點保留，由調度時取得探測權（acquire_probe）"""
+        states = self.states(node.id for node in nodes)
+        return [node for node in nodes if states[str(node.id)]['state'] != OPEN]
+
+    def record(self, node_id, success: bool):
+        """記錄一次節點呼叫的結果"""
+        node_id = str(node_id)
+        client = get_redis()
+        if client is not None:
+            try:
+                if success:
+                    self._close_redis(client, node_id)
+                else:
+                    self._fail_redis(client, node_id)
+                return
+            except Exception as e:
+                mark_redis_down(e)
+
+        with self._lock:
+            if success:
+                self._local.pop(node_id, None)
+                return
+            entry = self._local.setdefault(node_id, {})
+            entry['failures'] = entry.get('failures', 0) + 1
+            if entry['failures'] >= self.failure_threshold and entry.get('open_until', 0.0) <= time.time():
+                cooldown = self._next_cooldown(entry['failures'], entry.get('cooldown'))
+                entry['cooldown'] = cooldown
+                entry['open_until'] = time.time() + cooldown
+                entry.pop('probe_until', None)
+                logger.warning(f"Circuit breaker opened for node {node_id} for {cooldown:.0f}s")
+
+    def _next_cooldown(self, failures: int, previous) -> float:
+        # 剛達門檻用基本冷卻時間，half-open 探測再失敗時加倍
+        if failures == self.failure_threshold or not previous:
+            return self.cooldown
+        return min(self.max_cooldown, float(previous) * 2)
+
+    def _close_redis(self, client, node_id: str):
+        pipe = client.pipeline(transaction=False)
+        pipe.hdel(FAILURES_KEY, node_id)
+        pipe.hdel(COOLDOWN_KEY, node_id)
+        pipe.delete(OPEN_KEY.format(node_id), PROBE_KEY.format(node_id))
+        pipe.execute()
+
+    def _fail_redis(self, client, node_id: str):
+        failures = client.hincrby(FAILURES_KEY, node_id, 1)
+        if failures < self.failure_threshold:
+            return
+        cooldown = self._next_cooldown(failures, client.hget(COOLDOWN_KEY, node_id))
+        # NX：已熔斷時其他進行中的請求失敗不會延長冷卻
+        if client.set(OPEN_KEY.format(node_id), time.time() + cooldown, nx=True, ex=max(1, int(cooldown))):
+            pipe = client.pipeline(transaction=False)
+            pipe.hset(COOLDOWN_KEY, node_id, cooldown)
+            pipe.delete(PROBE_KEY.format(node_id))
+            pipe.execute()
+            logger.warning(f"Circuit breaker opened for node {node_id} for {cooldown:.0f}s")
+
+    def reset(self, node_ids: Iterable):
+        """手動恢復節點（後台操作）"""
+        for node_id in node_ids:
+            self.record(node_id, success=True)
+            with self._lock:
+                self._cache.pop(str(node_id), None)
+
+
+breakers = CircuitBreakerBoard()
@@ -0,0 +1,134 @@
+# 節點心跳寫入合併：心跳先寫入 Redis hash，由定期任務批次寫回 AINode，避免每次心跳都寫資料庫
+import json
+import logging
+import time
+from datetime import datetime, timezone as dt_timezone
+from typing import Optional
+
+from django.conf import settings
+from django.db import transaction
+
+from .models import AINode
+from .node_registry import get_redis, mark_redis_down, registry, invalidate_node_registry
+
+logger = logging.getLogger(__name__)
+
+HEARTBEATS_KEY = 'ai_nodes:heartbeats'
+DIRTY_KEY = 'ai_nodes:heartbeats:dirty'
+# 心跳可附帶的負載欄位（節點回報才更新）
+LOAD_FIELDS = {'current_requests': int, 'queued_requests': int, 'queue_eta': float}
+
+
+def load_fields(data) -> dict:
+    """從心跳內容取出節點回報的負載欄位"""
+    return {
+        field: cast(data[field])
+        for field, cast in LOAD_FIELDS.items()
+        if data.get(field) is not None
+    }
+
+
+def buffer_heartbeat(node_id: str, load: Optional[dict] = None) -> Optional[datetime]:
+    """
+    已在線節點的心跳寫入 Redis，回傳心跳時間；無法緩衝時回傳 None，呼叫端改走資料庫。
+    未知或離線的節點一律回傳 None，由資料庫路徑處理 404 與重新上線。
+    """
+    if not registry.is_online(node_id):
+        return None
+    client = get_redis()
+    if client is None:
+        return None
+
+    now = time.time()
+    beat = {'ts': now, **(load or {})}
+    try:
+        pipe = client.pipeline(transaction=False)
+        pipe.hset(HEARTBEATS_KEY, str(node_id), json.dumps(beat))
+        pipe.sadd(DIRTY_KEY, str(node_id))
+        pipe.execute()
+    except Exception as e:
+        mark_redis_down(e)
+        return None
+    return datetime.fromtimestamp(now, tz=dt_timezone.utc)
+
+
+def flush_heartbeats() -> int:
+    """
+    把 Redis 中累積的心跳批次寫回 AINode，回傳寫入的節點數。
+    Redis 錯誤只停用 Redis；資料庫錯誤會在放回待寫集合後拋出，健康檢查因此不會在心跳未寫回時判定節點離線。
+    """
+    client = get_redis()
+    if client is None:
+        return 0
+
+    # 有連線代表 redis 套件已安裝
+    from redis import RedisError
+
+    batch_size = getattr(settings, 'AI_NODE_HEARTBEAT_FLUSH_BATCH', 1000)
+    flushed = 0
+    revived = 0
+    try:
+        while True:
+            try:
+                # SPOP 原子地取出一批，flush 期間的新心跳留待下一輪
+                node_ids = [
+                    node_id.decode() if isinstance(node_id, bytes) else node_id
+                    for node_id in (client.spop(DIRTY_KEY, batch_size) or [])
+                ]
+                if not node_ids:
+                    break
+                beats = client.hmget(HEARTBEATS_KEY, node_ids)
+            except RedisError as e:
+                mark_redis_down(e)
+                break
+
+            try:
+                updates, batch_revived = _write_heartbeats(node_ids, beats)
+            except Exception:
+                # 資料庫寫入失敗：已取出的節點放回待寫集合，下一輪重試，
+                # 否則這些節點的心跳遺失，健康檢查會把在線節點誤判為離線
+                _restore_dirty(client, node_ids)
+                raise
+            flushed += updates
+            revived += batch_revived
+    finally:
+        if revived:
+            invalidate_node_registry()
+    return flushed
+
+
+def _write_heartbeats(node_ids, beats) -> tuple:
+    """把一批心跳寫回 AINode，回傳 (寫入的節點數, 恢復在線的節點數)"""
+    # 依回報的欄位分組，每組一次 bulk_update（未回報的欄位保留資料庫中的值）
+    groups = {}
+    for node_id, raw in zip(node_ids, beats):
+        if not raw:
+            continue
+        beat = json.loads(raw)
+        node = AINode(id=node_id, last_heartbeat=datetime.fromtimestamp(beat['ts'], tz=dt_timezone.utc))
+        fields = tuple(field for field in LOAD_FIELDS if field in beat)
+        for field in fields:
+            setattr(node, field, beat[field])
+        groups.setdefault(fields, []).append(node)
+    updates = [node for nodes in groups.values() for node in nodes]
+    if not updates:
+        return 0, 0
+
+    with transaction.atomic():
+        for fields, nodes in groups.items():
+            AINode.objects.bulk_update(nodes, ['last_heartbeat', *fields], batch_size=500)
+        # 與 update_heartbeat 相同：收到心跳的離線節點恢復在線
+        revived = AINode.objects.filter(
+            id__in=[node.id for node in updates], status='offline'
+        ).update(status='online')
+    return len(updates), revived
+
+
+def _restore_dirty(client, node_ids):
+    from redis import RedisError
+
+    try:
+        client.sadd(DIRTY_KEY, *node_ids)
+    except RedisError as e:
+        mark_redis_down(e)
+        logger.error(f"無法將 {len(node_ids)} 個節點放回心跳待寫集合，這些心跳將遺失: {e}")
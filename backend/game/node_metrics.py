@@ -0,0 +1,216 @@
+# 節點指標抓取：定期讀取各 AI 節點的 /metrics（Prometheus 文字格式），
+# 以兩次抓取之間的差值計算近期的 LLM 延遲、Gemini 錯誤率、拒絕數等，存入 AINode.metrics 供選節點與後台使用
+import logging
+import math
+import re
+import time
+from typing import Dict, List, Optional, Tuple
+
+from django.conf import settings
+
+from .http_client import get_executor, get_session
+from .models import AINode
+
+logger = logging.getLogger(__name__)
+
+_LABEL_RE = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+# 累計值中保留的計數器（名稱 -> 依哪個標籤分組，None 表示加總）
+COUNTERS = {
+    'ai_node_requests_total': 'outcome',
+    'ai_node_rejections_total': None,
+    'ai_node_gemini_errors_total': None,
+    'ai_node_generation_attempts_total': None,
+    'ai_node_repairs_total': None,
+}
+HISTOGRAMS = ('ai_node_llm_seconds', 'ai_node_queue_seconds', 'ai_node_battle_rounds')
+
+
+def parse_metrics(text: str) -> Dict[str, List[Tuple[Dict[str, str], float]]]:
+    """解析 Prometheus 文字格式，回傳 {指標名稱: [(標籤, 值), ...]}"""
+    samples = {}
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        try:
+            series, value = line.rsplit(' ', 1)
+            if '{' in series:
+                name, labels = series.split('{', 1)
+                labels = dict(_LABEL_RE.findall(labels))
+            else:
+                name, labels = series, {}
+            samples.setdefault(name, []).append((labels, float(value)))
+        except ValueError:
+            continue
+    return samples
+
+
+def extract_totals(samples: Dict) -> Dict:
+    """從解析結果取出計算近期指標需要的累計值"""
+    totals = {}
+    for name, group_by in COUNTERS.items():
+        series = samples.get(name, [])
+        if group_by:
+            grouped = {}
+            for labels, value in series:
+                key = labels.get(group_by, '')
+                grouped[key] = grouped.get(key, 0) + value
+            totals[name] = grouped
+        else:
+            totals[name] = sum(value for _, value in series)
+    for name in HISTOGRAMS:
+        buckets = {}
+        for labels, value in samples.get(f'{name}_bucket', []):
+            le = labels.get('le')
+            if le is not None:
+                buckets[le] = buckets.get(le, 0) + value
+        totals[name] = {
+            # 上界以字串保存（'+Inf' 無法存進 JSON）
+            'buckets': sorted(([le, count] for le, count in buckets.items()), key=lambda b: _bound(b[0])),
+            'sum': sum(value for _, value in samples.get(f'{name}_sum', [])),
+            'count': sum(value for _, value in samples.get(f'{name}_count', [])),
+        }
+    return totals
+
+
+def _bound(le: str) -> float:
+    return math.inf if le == '+Inf' else float(le)
+
+
+def _delta(current, previous):
+    # 節點重啟後計數器歸零，此時以目前的累計值作為差值
+    if previous is None or current < previous:
+        return current
+    return current - previous
+
+
+def histogram_quantile(buckets: List, q: float) -> Optional[float]:
+    """由累計分桶 [[上界, 累計數], ...] 估計第 q 分位數（桶內線性內插）"""
+    if not buckets or buckets[-1][1] <= 0:
+        return None
+    target = buckets[-1][1] * q
+    lower_bound, lower_count = 0.0, 0
+    for le, count in buckets:
+        bound = _bound(le)
+        if count >= target:
+            if math.isinf(bound):
+                return lower_bound
+            if count == lower_count:
+                return bound
+            return lower_bound + (bound - lower_bound) * (target - lower_count) / (count - lower_count)
+        lower_bound, lower_count = bound, count
+    return lower_bound
+
+
+def summarize(totals: Dict, previous: Optional[Dict], interval: Optional[float]) -> Dict:
+    """以兩次抓取的累計值差計算近期（這段抓取間隔內）的指標"""
+    previous = previous or {}
+
+    def counter(name):
+        return _delta(totals.get(name, 0), previous.get(name))
+
+    outcomes = totals.get('ai_node_requests_total', {})
+    previous_outcomes = previous.get('ai_node_requests_total', {})
+    requests = {key: _delta(value, previous_outcomes.get(key)) for key, value in outcomes.items()}
+
+    def histogram(name):
+        current = totals.get(name, {})
+        before = previous.get(name) or {}
+        before_buckets = dict((bound, count) for bound, count in before.get('buckets', []))
+        reset = current.get('count', 0) < before.get('count', 0)
+        buckets = [
+            [bound, count if reset else count - before_buckets.get(bound, 0)]
+            for bound, count in current.get('buckets', [])
+        ]
+        count = _delta(current.get('count', 0), None if reset else before.get('count'))
+        total = _delta(current.get('sum', 0.0), None if reset else before.get('sum'))
+        return buckets, count, total
+
+    llm_buckets, llm_count, _ = histogram('ai_node_llm_seconds')
+    queue_buckets, _, _ = histogram('ai_node_queue_seconds')
+    _, rounds_count, rounds_sum = histogram('ai_node_battle_rounds')
+    attempts = counter('ai_node_generation_attempts_total')
+    gemini_errors = counter('ai_node_gemini_errors_total')
+    ok = requests.get('ok', 0)
+
+    return {
+        'interval': interval,
+        'requests': sum(requests.values()),
+        'ok': ok,
+        'errors': requests.get('error', 0),
+        'busy': requests.get('busy', 0),
+        'rejections': counter('ai_node_rejections_total'),
+        'attempts': attempts,
+        'gemini_errors': gemini_errors,
+        'gemini_error_rate': gemini_errors / attempts if attempts else 0.0,
+        'repairs': counter('ai_node_repairs_total'),
+        'llm_calls': llm_count,
+        'llm_p50': histogram_quantile(llm_buckets, 0.5),
+        'llm_p95': histogram_quantile(llm_buckets, 0.95),
+        'queue_p95': histogram_quantile(queue_buckets, 0.95),
+        'avg_rounds': rounds_sum / rounds_count if rounds_count else None,
+    }
+
+
+def health_factor(node, now: Optional[float] = None) -> float:
+    """
+    依最近一次抓取的指標調整選節點分數的係數（0.1 ~ 1）：
+    Gemini 錯誤與拒絕越多，分數越低；指標過期或樣本不足時不調整
+    """
+    data = getattr(node, 'metrics', None) or {}
+    window = data.get('window') or {}
+    scraped_at = data.get('scraped_at')
+    max_age = getattr(settings, 'AI_NODE_METRICS_MAX_AGE', 120)
+    min_samples = getattr(settings, 'AI_NODE_METRICS_MIN_SAMPLES', 5)
+    if not scraped_at or (now or time.time()) - scraped_at > max_age:
+        return 1.0
+    attempts = window.get('attempts', 0)
+    requests = window.get('requests', 0)
+    penalty = 0.0
+    if attempts >= min_samples:
+        penalty += window.get('gemini_error_rate', 0.0)
+    if requests >= min_samples:
+        penalty += window.get('rejections', 0) / requests
+    return max(0.1, 1.0 - penalty)
+
+
+def fetch_metrics(node: AINode) -> Optional[str]:
+    headers = {'Authorization': f'Bearer {node.api_key}'} if node.api_key else {}
+    timeout = getattr(settings, 'AI_NODE_METRICS_TIMEOUT', 3)
+    try:
+        response = get_session().get(f'{node.url}/metrics', headers=headers, timeout=timeout)
+    except Exception as e:
+        logger.info(f"Metrics scrape failed for node {node.name}: {e}")
+        return None
+    if response.status_code != 200:
+        # 舊版節點沒有 /metrics
+        return None
+    return response.text
+
+
+def scrape_nodes() -> int:
+    """並行抓取所有在線節點的指標並寫回資料庫，回傳更新的節點數"""
+    nodes = list(AINode.objects.filter(status='online').only('id', 'name', 'url', 'api_key', 'metrics'))
+    if not nodes:
+        return 0
+
+    texts = list(get_executor().map(fetch_metrics, nodes))
+    now = time.time()
+    updated = []
+    for node, text in zip(nodes, texts):
+        if text is None:
+            continue
+        previous = node.metrics or {}
+        totals = extract_totals(parse_metrics(text))
+        interval = now - previous['scraped_at'] if previous.get('scraped_at') else None
+        node.metrics = {
+            'scraped_at': now,
+            'totals': totals,
+            'window': summarize(totals, previous.get('totals'), interval),
+        }
+        updated.append(node)
+
+    if updated:
+        AINode.objects.bulk_update(updated, ['metrics'])
+    return len(updated)
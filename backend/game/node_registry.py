@@ -0,0 +1,154 @@
+# AI 節點註冊表快取：Redis 中的版本化快照 + 各行程內的短期快照，選節點時不必查資料庫
+import copy
+import json
+import logging
+import math
+import threading
+import time
+from datetime import timedelta
+from typing import List
+
+from django.conf import settings
+from django.utils import timezone
+
+from .models import AINode
+
+logger = logging.getLogger(__name__)
+
+REGISTRY_KEY = 'ai_nodes:registry'
+VERSION_KEY = 'ai_nodes:registry:version'
+
+_redis_lock = threading.Lock()
+_redis_state = {'client': None, 'down_until': 0.0}
+
+
+def get_redis():
+    """共用的 Redis 連線；未設定或暫時連不上時回傳 None，呼叫端改走資料庫"""
+    if time.monotonic() < _redis_state['down_until']:
+        return None
+    with _redis_lock:
+        if _redis_state['client'] is None:
+            url = getattr(settings, 'REDIS_URL', None) or getattr(settings, 'CELERY_BROKER_URL', None)
+            if not url or not url.startswith(('redis://', 'rediss://', 'unix://')):
+                return None
+            try:
+                import redis
+            except ImportError:
+                return None
+            timeout = getattr(settings, 'REDIS_SOCKET_TIMEOUT', 0.5)
+            _redis_state['client'] = redis.Redis.from_url(
+                url, socket_timeout=timeout, socket_connect_timeout=timeout
+            )
+        return _redis_state['client']
+
+
+def mark_redis_down(error: Exception):
+    """Redis 失敗後一段時間內不再嘗試，避免每次呼叫都卡在連線逾時"""
+    retry_after = getattr(settings, 'REDIS_RETRY_INTERVAL', 10)
+    _redis_state['down_until'] = time.monotonic() + retry_after
+    logger.warning(f"Redis unavailable, falling back to database for {retry_after}s: {error}")
+
+
+def _encode_node(node: AINode) -> dict:
+    return {field.attname: field.value_to_string(node) for field in AINode._meta.concrete_fields}
+
+
+def _decode_node(data: dict) -> AINode:
+    fields = AINode._meta.concrete_fields
+    names = [field.attname for field in fields]
+    values = [field.to_python(data.get(field.attname)) for field in fields]
+    return AINode.from_db('default', names, values)
+
+
+class NodeRegistry:
+    """
+    可用節點的快取。
+    - 行程內快照在 local_ttl 內直接使用，完全不需網路往返；
+    - 過期後以一次 MGET 比對 Redis 中的版本號，版本相同就沿用 Redis 快照；
+    - 註冊、狀態變更、健康檢查與後台編輯會遞增版本號，其他行程最遲在 local_ttl 後看到變更；
+    - 任何快照最多使用 max_staleness 秒（節點心跳時間、負載等會在這段時間內更新）。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._snapshot = None  # (版本號, 快照建立時間, 本行程載入時間, 節點列表)
+
+    @property
+    def local_ttl(self) -> float:
+        return getattr(settings, 'AI_NODE_REGISTRY_LOCAL_TTL', 2)
+
+    @property
+    def max_staleness(self) -> float:
+        return getattr(settings, 'AI_NODE_REGISTRY_MAX_STALENESS', 30)
+
+    def _load_from_db(self) -> List[AINode]:
+        return list(AINode.objects.filter(status='online').exclude(last_heartbeat__isnull=True))
+
+    def _store(self, version, built_at: float, nodes: List[AINode]) -> List[AINode]:
+        with self._lock:
+            self._snapshot = (version, built_at, time.monotonic(), nodes)
+        return nodes
+
+    def _nodes(self) -> List[AINode]:
+        snapshot = self._snapshot
+        if snapshot and time.monotonic() - snapshot[2] < self.local_ttl:
+            return snapshot[3]
+
+        client = get_redis()
+        if client is not None:
+            try:
+                version, blob = client.mget(VERSION_KEY, REGISTRY_KEY)
+                version = int(version or 0)
+                if blob:
+                    data = json.loads(blob)
+                    if data['version'] == version and time.time() - data['built_at'] < self.max_staleness:
+                        if snapshot and snapshot[:2] == (version, data['built_at']):
+                            # 與本行程快照相同，省去反序列化
+                            return self._store(version, data['built_at'], snapshot[3])
+                        nodes = [_decode_node(item) for item in data['nodes']]
+                        return self._store(version, data['built_at'], nodes)
+
+                nodes = self._load_from_db()
+                built_at = time.time()
+                payload = {
+                    'version': version,
+                    'built_at': built_at,
+                    'nodes': [_encode_node(node) for node in nodes],
+                }
+                client.set(REGISTRY_KEY, json.dumps(payload), ex=max(1, math.ceil(self.max_staleness)))
+                return self._store(version, built_at, nodes)
+            except Exception as e:
+                mark_redis_down(e)
+
+        return self._store(None, time.time(), self._load_from_db())
+
+    def available_nodes(self) -> List[AINode]:
+        """在線且 5 分鐘內有心跳的節點，依權重與平均響應時間排序（回傳副本，可安全修改）"""
+        cutoff = timezone.now() - timedelta(minutes=5)
+        nodes = [node for node in self._nodes() if node.last_heartbeat and node.last_heartbeat >= cutoff]
+        nodes.sort(key=lambda node: (-node.weight, node.avg_response_time))
+        return [copy.copy(node) for node in nodes]
+
+    def is_online(self, node_id) -> bool:
+        """節點是否在快照中且狀態為在線"""
+        node_id = str(node_id)
+        return any(str(node.id) == node_id for node in self._nodes())
+
+    def invalidate(self):
+        """節點成員或狀態變更時呼叫：清除本行程快照並遞增 Redis 版本號"""
+        with self._lock:
+            self._snapshot = None
+        client = get_redis()
+        if client is None:
+            return
+        try:
+            client.incr(VERSION_KEY)
+        except Exception as e:
+            mark_redis_down(e)
+
+
+registry = NodeRegistry()
+
+
+def invalidate_node_registry():
+    registry.invalidate()
@@ -0,0 +1,132 @@
+# 節點調度：以加權 rendezvous（HRW）雜湊為每場戰鬥選出投票節點，滿載節點降為候補；
+# 對沖備援則依剩餘容量與延遲評分排序
+import hashlib
+import heapq
+import math
+import threading
+import time
+from collections import defaultdict
+from typing import List, Optional, Sequence
+
+from .node_metrics import health_factor
+
+# 尚無延遲紀錄的節點以此估計（秒）
+DEFAULT_LATENCY = 10.0
+# 延遲下限，避免極快節點的分數失控
+LATENCY_FLOOR = 0.5
+
+
+class InFlightTracker:
+    """
+    記錄本行程已送出、尚未完成的節點請求。
+    節點回報的 current_requests 只到上次心跳為止，之後由本行程送出的請求需另外計入，
+    否則兩次心跳之間所有戰鬥都會湧向同一個「看起來有空」的節點。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._started = defaultdict(list)
+
+    def now(self) -> float:
+        return time.time()
+
+    def start(self, node_id, at: Optional[float] = None) -> float:
+        at = time.time() if at is None else at
+        with self._lock:
+            self._started[str(node_id)].append(at)
+        return at
+
+    def finish(self, node_id, started_at: float):
+        with self._lock:
+            started = self._started.get(str(node_id))
+            if started and started_at in started:
+                started.remove(started_at)
+
+    def pending_since(self, node_id, since) -> int:
+        """在 since（心跳時間）之後送出、仍未完成的請求數"""
+        since = _as_timestamp(since)
+        with self._lock:
+            return sum(1 for at in self._started.get(str(node_id), ()) if at > since)
+
+
+def _as_timestamp(value) -> float:
+    if value is None:
+        return 0.0
+    return value.timestamp() if hasattr(value, 'timestamp') else float(value)
+
+
+# 行程內共用的追蹤器
+in_flight = InFlightTracker()
+
+
+def estimated_load(node, tracker: Optional[InFlightTracker] = None, now: Optional[float] = None) -> float:
+    """
+    估計節點目前的請求數：
+    心跳回報值（執行中 + 排隊中）依距上次心跳的時間按預期延遲衰減（那些請求多半已完成），
+    再加上心跳之後本行程送出的請求。排隊中的節點剩餘容量為負，會被其他節點優先取代。
+    """
+    tracker = tracker or in_flight
+    heartbeat = getattr(node, 'last_heartbeat', None)
+    reported = node.current_requests + getattr(node, 'queued_requests', 0)
+    if heartbeat is not None and reported:
+        now = tracker.now() if now is None else now
+        age = max(0.0, now - _as_timestamp(heartbeat))
+        reported *= math.exp(-age / max(LATENCY_FLOOR, expected_latency(node)))
+    return reported + tracker.pending_since(node.id, heartbeat)
+
+
+def expected_latency(node) -> float:
+    """節點的預期響應時間：優先使用近期 EWMA，其次為累計平均"""
+    return getattr(node, 'ewma_response_time', 0) or node.avg_response_time or DEFAULT_LATENCY
+
+
+def node_score(node, tracker: Optional[InFlightTracker] = None) -> float:
+    """
+    分數越高越適合接新請求：剩餘並發數 ÷ 預期延遲（即每秒還能多消化的請求數），有空位時再乘上權重。
+    滿載節點分數為負，不會被完全排除，只在其他節點更擁擠時才選到超載較少的那個。
+    節點端指標顯示 Gemini 錯誤或拒絕偏多時，依 health_factor 降低分數。
+    """
+    spare = node.max_concurrent_requests - estimated_load(node, tracker)
+    if spare > 0:
+        spare *= node.weight
+    score = spare / max(LATENCY_FLOOR, expected_latency(node))
+    factor = health_factor(node)
+    return score * factor if score > 0 else score / factor
+
+
+def rendezvous_score(battle_id, node) -> float:
+    """
+    加權 HRW 分數 weight / -ln(u)，u 為 (battle_id, node.id) 雜湊到 (0, 1) 的值。
+    取分數最高的 k 個節點時，每個節點被選中的機率與權重成正比。
+    權重只用後台設定的靜態容量（權重 × 最大並發），不含延遲 EWMA 或節點端健康指標：
+    這兩者每次請求或指標抓取都會變，重試的戰鬥會因此換到別的節點而錯過結果快取。
+    即時的負載與健康只在 select_nodes 區分有空／滿載節點與排序滿載候補時使用。
+    """
+    digest = hashlib.blake2b(f'{battle_id}:{node.id}'.encode(), digest_size=8).digest()
+    u = (int.from_bytes(digest, 'big') + 0.5) / 2 ** 64
+    capacity = max(node.weight, 1e-3) * max(node.max_concurrent_requests, 1)
+    return capacity / -math.log(u)
+
+
+def select_nodes(nodes: Sequence, num_nodes: int, battle_id,
+                 tracker: Optional[InFlightTracker] = None) -> List:
+    """
+    選出 num_nodes 個投票節點：尚有剩餘容量的節點中取 HRW 分數最高的幾個。
+    只有在有空節點不足時，才由滿載節點補上，補上的順序是超載最少者優先。
+    結果只由 battle_id 與節點狀態決定，不使用任何亂數狀態。
+    節點加入或離開時，只有選中該節點的戰鬥會改變分配。
+    同一場戰鬥重試時會回到相同節點，能命中節點端的結果快取。
+    """
+    scores = {node.id: node_score(node, tracker) for node in nodes}
+    ready = [node for node in nodes if scores[node.id] > 0]
+    selected = heapq.nlargest(num_nodes, ready, key=lambda node: (rendezvous_score(battle_id, node), str(node.id)))
+    if len(selected) < num_nodes:
+        saturated = [node for node in nodes if scores[node.id] <= 0]
+        selected += heapq.nlargest(num_nodes - len(selected), saturated,
+                                   key=lambda node: (scores[node.id], str(node.id)))
+    return selected
+
+
+def rank_spares(nodes: Sequence, tracker: Optional[InFlightTracker] = None) -> List:
+    """對沖用的備援節點，依分數由高到低排列"""
+    return sorted(nodes, key=lambda node: node_score(node, tracker), reverse=True)
@@ -1,20 +1,381 @@
 # 節點管理服務
 import asyncio
 import aiohttp
+import json
+import os
+import queue
+import threading
 import time
-import random
-import hashlib
-import requests
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from typing import List, Dict, Optional, Tuple
 from django.conf import settings
-from django.utils import timezone
-from .models import AINode, Battle, BattleVotingRecord
+from django.db import DatabaseError, IntegrityError, transaction
+from .models import AINode, Battle, BattleVotingRecord, BattleResultBlob
+from .node_selection import select_nodes, rank_spares, node_score, in_flight
+from .node_registry import registry, invalidate_node_registry
+from .node_breaker import breakers, CLOSED, HALF_OPEN
+from .node_stats import recorder as stats_recorder, histogram_samples
+from .battle_verifier import repair_result, verify_result
+from .battle_engine import battle_seed
+from .http_client import get_session, get_executor, get_aiohttp_session, close_aiohttp_session, node_timeouts
 from collections import Counter
 import logging
 
 logger = logging.getLogger(__name__)
 
 
+class HedgedDispatcher:
+    """
+    並行向節點發送請求並收集投票。
+    每個主節點佔一個投票席位；主節點超過對沖門檻仍未回應、或已回應失敗時，
+    把同一請求送往備用節點，席位以先到的結果為準，另一份結果記為遲到票。
+    """
+    
+    def __init__(self, request_fn, record_fn=None, hedge_delay_fn=None, max_hedges: int = 0,
+                 timeout: float = 35, quorum_fn=None, executor=None):
+        self.request_fn = request_fn            # request_fn(node) -> 結果或 None（失敗）
+        self.record_fn = record_fn              # record_fn(node, 結果, is_late) -> 投票
+        self.hedge_delay_fn = hedge_delay_fn    # hedge_delay_fn(node) -> 秒數
+        self.max_hedges = max_hedges if hedge_delay_fn else 0
+        self.timeout = timeout
+        self.quorum_fn = quorum_fn              # quorum_fn(已計入的投票, 計畫票數) -> bool
+        self.executor = executor                # 預設使用行程共用的執行緒池
+        self.stats = {}
+    
+    def run(self, primaries: List, spares: Optional[List] = None) -> List:
+        """
+        回傳各席位先到的投票（不含遲到票）。
+        stats['total_latency'] 為最後一個請求（含遲到票）結束的時間，
+        落後節點在回傳後才結束時由完成回呼補上，因此 run 回傳時可能仍為 None。
+        """
+        slots = list(primaries)
+        spares = list(spares or [])
+        planned = len(slots)
+        if not planned:
+            return []
+        
+        claim_lock = threading.Lock()
+        claims = {}             # 席位 -> 先到結果的投票 Future（取得席位後才建立投票）
+        quorum_reached = threading.Event()
+        start_time = time.time()
+        
+        def task(node, slot):
+            outcome = self.request_fn(node)
+            if outcome is None:
+                return None
+            with claim_lock:
+                is_late = quorum_reached.is_set() or slot in claims
+                if not is_late:
+                    claim = claims[slot] = Future()
+            try:
+                vote = self.record_fn(node, outcome, is_late) if self.record_fn else outcome
+            except Exception as e:
+                if not is_late:
+                    claim.set_exception(e)
+                raise
+            if not is_late:
+                claim.set_result(vote)
+            return vote, is_late
+        
+        votes = []
+        future_slot = {}
+        slot_requests = [0] * planned
+        hedge_at = {}
+        hedged_slots = set()
+        done_slots = set()
+        hedges_sent = 0
+        quorum_time = None
+        remaining = [0]
+        returned = [False]
+        last_done = [start_time]
+        remaining_lock = threading.Lock()
+        
+        def report_total_latency(finished_at):
+            self.stats['total_latency'] = finished_at - start_time
+            logger.info(f"All node requests finished in {self.stats['total_latency']:.2f}s")
+        
+        def on_done(_future):
+            # 最後一個請求（含遲到票）結束時記錄總耗時；run 尚未回傳時由 run 填入
+            with remaining_lock:
+                remaining[0] -= 1
+                last_done[0] = time.time()
+                finished = remaining[0] == 0 and returned[0]
+            if finished:
+                report_total_latency(last_done[0])
+        
+        executor = self.executor or get_executor()
+        
+        def submit(node, slot):
+            with remaining_lock:
+                remaining[0] += 1
+            future = executor.submit(task, node, slot)
+            future_slot[future] = slot
+            slot_requests[slot] += 1
+            future.add_done_callback(on_done)
+            return future
+        
+        def give_up_hedge(slot):
+            hedged_slots.add(slot)
+            if slot_requests[slot] == 0:
+                done_slots.add(slot)
+        
+        deadline = start_time + self.timeout
+        try:
+            pending = set()
+            for slot, node in enumerate(slots):
+                pending.add(submit(node, slot))
+                if self.max_hedges:
+                    hedge_at[slot] = start_time + self.hedge_delay_fn(node)
+            
+            while pending and len(done_slots) < planned:
+                now = time.time()
+                if now >= deadline:
+                    print(f"⚠️ 等待節點逾時，已收到 {len(votes)} 票")
+                    break
+                wake_at = min([deadline] + [
+                    t for slot, t in hedge_at.items()
+                    if slot not in hedged_slots and slot not in done_slots
+                ])
+                done, pending = wait(pending, timeout=max(0, wake_at - now), return_when=FIRST_COMPLETED)
+                
+                for future in done:
+                    slot = future_slot[future]
+                    slot_requests[slot] -= 1
+                    try:
+                        outcome = future.result()
+                    except Exception as e:
+                        print(f"❌ 節點請求執行異常: {e}")
+                        outcome = None
+                    
+                    if outcome is not None:
+                        vote, is_late = outcome
+                        if not is_late:
+                            done_slots.add(slot)
+                            votes.append(vote)
+                    elif slot not in done_slots and slot_requests[slot] == 0:
+                        # 席位上的請求全部失敗：有額度就立即對沖，否則放棄此席位
+                        if slot in hedged_slots or not self.max_hedges:
+                            done_slots.add(slot)
+                        else:
+                            hedge_at[slot] = 0
+                
+                if self.quorum_fn and self.quorum_fn(votes, planned):
+                    quorum_time = time.time() - start_time
+                    break
+                
+                # 送出到期的對沖請求
+                now = time.time()
+                for slot, t in sorted(hedge_at.items(), key=lambda item: item[1]):
+                    if slot in hedged_slots or slot in done_slots or t > now:
+                        continue
+                    if hedges_sent >= self.max_hedges or not spares:
+                        give_up_hedge(slot)
+                        continue
+                    spare = spares.pop(0)
+                    hedged_slots.add(slot)
+                    hedges_sent += 1
+                    print(f"🔀 席位 {slot} 的節點 {getattr(slots[slot], 'name', slot)} 未及時回應，對沖至 {getattr(spare, 'name', spare)}")
+                    pending.add(submit(spare, slot))
+        finally:
+            # 不等待落後節點；之後到達的結果以遲到票記錄，尚未開始的請求直接取消
+            with claim_lock:
+                quorum_reached.set()
+                unprocessed = {slot: claim for slot, claim in claims.items() if slot not in done_slots}
+            for future in future_slot:
+                future.cancel()
+        
+        # 在停止收票前已取得席位、但尚未被上面迴圈處理的投票仍計入（只剩建立投票記錄，不會等待節點）
+        for slot, claim in sorted(unprocessed.items()):
+            try:
+                votes.append(claim.result(timeout=max(1.0, deadline - time.time())))
+                done_slots.add(slot)
+            except Exception as e:
+                print(f"❌ 席位 {slot} 的投票記錄失敗: {e}")
+        
+        collect_time = time.time() - start_time
+        if quorum_time is not None:
+            print(f"⏱️  達到法定多數，quorum 耗時: {quorum_time:.2f}秒，收到 {len(votes)}/{planned} 個有效投票")
+        else:
+            print(f"⏱️  並行調用完成，總耗時: {collect_time:.2f}秒，收到 {len(votes)} 個有效投票")
+        self.stats.update({
+            'planned_votes': planned,
+            'received_votes': len(votes),
+            'hedges_sent': hedges_sent,
+            'quorum_latency': quorum_time,
+            'collect_latency': collect_time,
+            'total_latency': None,
+        })
+        with remaining_lock:
+            returned[0] = True
+            finished = remaining[0] == 0
+        if finished:
+            report_total_latency(last_done[0])
+        return votes
+
+
+class NodeRequestError(Exception):
+    """節點回應錯誤（HTTP 狀態碼非 200，或批次中該場戰鬥失敗）"""
+
+    def __init__(self, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class NodeBusyError(NodeRequestError):
+    """節點忙碌：排隊已滿或預估等待超過 max_wait（不計入節點失敗，改由備援節點處理）"""
+
+
+def node_error(status_code: int, text: str) -> NodeRequestError:
+    error_class = NodeBusyError if status_code == 503 else NodeRequestError
+    return error_class(f"HTTP {status_code}: {text}", status_code=status_code)
+
+
+# 不支援精簡對戰參數（matchup）的舊版節點，改送完整提示詞（行程內記憶）
+matchup_unsupported = set()
+
+
+class BatchDispatcher:
+    """
+    合併同一行程內發往同一節點的戰鬥請求。
+    在 window 秒內到達、目標相同的請求以一次 /generate_battles 送出，節點依完成順序以 NDJSON 串流回傳，
+    每收到一行就交付對應的請求；只有一筆或節點不支援批次端點時改用 /generate_battle。
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._senders = None
+        self._unsupported = set()
+    
+    @property
+    def window(self) -> float:
+        return getattr(settings, 'AI_NODE_BATCH_WINDOW', 0.02)
+    
+    @property
+    def max_batch(self) -> int:
+        return getattr(settings, 'AI_NODE_BATCH_MAX_SIZE', 16)
+    
+    def _ensure_started(self) -> queue.Queue:
+        # prefork 之後子行程沒有父行程的執行緒，偵測到 pid 變動就重建
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._queue = queue.Queue()
+                # 送出批次使用獨立的執行緒池：共用池的執行緒可能正等待這些結果。
+                # 大小與共用池相同，每個等待中的呼叫端都能同時有一個送出執行緒，不另設並發上限
+                self._senders = ThreadPoolExecutor(
+                    max_workers=getattr(settings, 'AI_NODE_MAX_WORKERS', 32),
+                    thread_name_prefix='node-batch',
+                )
+                threading.Thread(target=self._collect, args=(self._queue,), daemon=True).start()
+            return self._queue
+    
+    def submit(self, node: AINode, payload: Dict, headers: Dict, timeout: float) -> Future:
+        """排入一場戰鬥請求，回傳的 Future 完成時為節點結果，失敗時拋出例外"""
+        future = Future()
+        self._ensure_started().put((node, payload, headers, timeout, future))
+        return future
+    
+    def _collect(self, pending: queue.Queue):
+        while True:
+            batch = [pending.get()]
+            deadline = time.monotonic() + self.window
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(pending.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            
+            groups = {}
+            for item in batch:
+                groups.setdefault(item[0].id, []).append(item)
+            for items in groups.values():
+                for i in range(0, len(items), self.max_batch):
+                    self._senders.submit(self._send, items[i:i + self.max_batch])
+    
+    def _send(self, items: List[tuple]):
+        items = [item for item in items if item[4].set_running_or_notify_cancel()]
+        if not items:
+            return
+        node = items[0][0]
+        if len(items) == 1 or node.id in self._unsupported:
+            self._send_each(items)
+            return
+        
+        connect_timeout, _ = node_timeouts()
+        try:
+            response = get_session().post(
+                f"{node.url}/generate_battles",
+                json={'battles': [item[1] for item in items]},
+                headers=items[0][2],
+                timeout=(connect_timeout, max(item[3] for item in items)),
+                stream=True,
+            )
+            with response:
+                if response.status_code in (404, 405):
+                    # 舊版節點沒有批次端點，之後一律單筆送出
+                    logger.info(f"Node {node.name} has no batch endpoint, sending requests individually")
+                    self._unsupported.add(node.id)
+                    self._send_each(items)
+                    return
+                if response.status_code != 200:
+                    raise node_error(response.status_code, response.text)
+                
+                for line in response.iter_lines():
+                    if not line:
+                        continue
+                    data = json.loads(line)
+                    if not isinstance(data.get('index'), int) or not 0 <= data['index'] < len(items):
+                        raise NodeRequestError(f"Malformed batch response line: {line[:200]!r}")
+                    future = items[data['index']][4]
+                    if future.done():
+                        continue
+                    if data.get('status') == 'ok':
+                        future.set_result(data['result'])
+                    elif data.get('status') == 'busy':
+                        future.set_exception(NodeBusyError(data.get('error', 'Node busy')))
+                    else:
+                        future.set_exception(NodeRequestError(data.get('error', 'Unknown error')))
+        except Exception as e:
+            for item in items:
+                if not item[4].done():
+                    item[4].set_exception(e)
+        
+        for item in items:
+            if not item[4].done():
+                item[4].set_exception(NodeRequestError('Batch response ended without this battle'))
+    
+    def _send_each(self, items: List[tuple]):
+        """逐筆送出：第一筆在目前的送出執行緒上直接送，其餘交給其他送出執行緒並行"""
+        for item in items[1:]:
+            self._senders.submit(self._send_single, item)
+        self._send_single(items[0])
+    
+    def _send_single(self, item: tuple):
+        node, payload, headers, timeout, future = item
+        connect_timeout, _ = node_timeouts()
+        try:
+            response = get_session().post(
+                f"{node.url}/generate_battle",
+                json=payload,
+                headers=headers,
+                timeout=(connect_timeout, timeout)
+            )
+            if response.status_code == 200:
+                future.set_result(response.json())
+            else:
+                future.set_exception(node_error(response.status_code, response.text))
+        except Exception as e:
+            future.set_exception(e)
+
+
+batcher = BatchDispatcher()
+
+
 class NodeManager:
     """AI節點管理器 - 負載均衡、健康檢查、投票管理"""
     
@@ -22,80 +383,116 @@ class NodeManager:
         self.timeout = getattr(settings, 'AI_NODE_TIMEOUT', 30)
         self.max_retries = getattr(settings, 'AI_NODE_MAX_RETRIES', 3)
         self.min_consensus_nodes = getattr(settings, 'MIN_CONSENSUS_NODES', 3)
+        # 領先者取得計畫票數的嚴格多數時即結束等待，不等最慢的節點
+        self.early_quorum = getattr(settings, 'AI_NODE_EARLY_QUORUM', True)
+        self.last_consensus_stats = {}
+        # 對沖請求：每場戰鬥最多額外送出的備援請求數
+        self.max_hedges = getattr(settings, 'AI_NODE_MAX_HEDGES', 1)
+        self.hedge_min_delay = getattr(settings, 'AI_NODE_HEDGE_MIN_DELAY', 1.0)
+        self.hedge_p90_factor = getattr(settings, 'AI_NODE_HEDGE_P90_FACTOR', 1.5)
+        self.hedge_min_samples = getattr(settings, 'AI_NODE_HEDGE_MIN_SAMPLES', 20)
+        # 自適應逾時：依節點近期 p99 延遲放寬倍數，介於最小逾時與 AI_NODE_TIMEOUT 之間
+        self.timeout_p99_factor = getattr(settings, 'AI_NODE_TIMEOUT_P99_FACTOR', 2.0)
+        self.min_timeout = getattr(settings, 'AI_NODE_MIN_TIMEOUT', 5)
+        self.timeout_min_samples = getattr(settings, 'AI_NODE_TIMEOUT_MIN_SAMPLES', 50)
+        # 投票記錄預設在共識決定後以 bulk_create 一次寫入；開啟後改為每票到達即寫入
+        self.durable_votes = getattr(settings, 'AI_NODE_DURABLE_VOTES', False)
+        # 同一行程內發往同一節點的請求合併為一次批次請求（/generate_battles）。
+        # 每個請求都要先等待合併窗口（AI_NODE_BATCH_WINDOW），只在同一節點請求密集時才值得開啟
+        self.batching = getattr(settings, 'AI_NODE_BATCHING', False)
+        # 節點滿載時請求最多排隊的秒數，超過即回 503 改送備援節點
+        self.queue_max_wait = getattr(settings, 'AI_NODE_QUEUE_MAX_WAIT', 5)
     
     def get_available_nodes(self) -> List[AINode]:
-        """獲取所有可用的節點"""
-        return list(AINode.objects.filter(
-            status='online'
-        ).exclude(
-            last_heartbeat__isnull=True
-        ).filter(
-            last_heartbeat__gte=timezone.now() - timezone.timedelta(minutes=5)
-        ).order_by('-weight', 'avg_response_time'))
+        """獲取所有可用的節點（讀取註冊表快取，不需查資料庫；排除熔斷中的節點）"""
+        return breakers.filter_available(registry.available_nodes())
     
-    def select_nodes_for_battle(self, battle_id: str, num_nodes: Optional[int] = None) -> List[AINode]:
+    def select_nodes_for_battle(self, battle_id: str, num_nodes: Optional[int] = None,
+                                available_nodes: Optional[List[AINode]] = None) -> List[AINode]:
         """為戰鬥選擇節點 - 使用確定性選擇確保一致性"""
-        available_nodes = self.get_available_nodes()
+        if available_nodes is None:
+            available_nodes = self.get_available_nodes()
         
         if not available_nodes:
             return []
         
-        # 確定性選擇：基於battle_id的hash確保相同戰鬥總是選到相同節點
-        random.seed(int(hashlib.md5(str(battle_id).encode()).hexdigest(), 16))
-        
         # 選擇節點數量：預設為可用節點數的一半（最少3個，最多所有可用節點）
         if num_nodes is None:
             num_nodes = max(self.min_consensus_nodes, min(len(available_nodes), len(available_nodes) // 2 + 1))
         
-        # 加權隨機選擇
-        selected = []
-        candidates = available_nodes.copy()
-        
-        for _ in range(min(num_nodes, len(candidates))):
-            weights = [node.weight for node in candidates]
-            node = random.choices(candidates, weights=weights)[0]
-            selected.append(node)
-            candidates.remove(node)
+        # 加權 rendezvous 雜湊：同一場戰鬥固定落在相同節點，滿載節點才被其他節點取代
+        selected = select_nodes(available_nodes, num_nodes, battle_id)
         
-        logger.info(f"Selected {len(selected)} nodes for battle {battle_id}: {[n.name for n in selected]}")
+        logger.info(
+            f"Selected {len(selected)} nodes for battle {battle_id}: "
+            f"{[(n.name, round(node_score(n), 3)) for n in selected]}"
+        )
         return selected
     
+    def apply_breakers(self, selected: List[AINode], spares: List[AINode]) -> Tuple[List[AINode], List[AINode]]:
+        """探測中（half-open）的節點須取得探測權才參與本場戰鬥，否則以備援遞補；備援只用狀態正常的節點"""
+        spares = [node for node in spares if breakers.state(node.id) == CLOSED]
+        kept = []
+        for node in selected:
+            state = breakers.state(node.id)
+            if state == CLOSED or (state == HALF_OPEN and breakers.acquire_probe(node.id)):
+                kept.append(node)
+            elif spares:
+                kept.append(spares.pop(0))
+        return kept, spares
+    
+    def node_timeout(self, node: AINode) -> float:
+        """單一節點的讀取逾時：樣本足夠時取 p99 的倍數，否則使用 AI_NODE_TIMEOUT"""
+        p99 = node.latency_percentile(99)
+        if p99 is None or histogram_samples(node.latency_histogram) < self.timeout_min_samples:
+            return float(self.timeout)
+        return max(float(self.min_timeout), min(p99 * self.timeout_p99_factor, float(self.timeout)))
+    
     async def call_node_generate_battle(self, node: AINode, battle_prompt: str, 
-                                      battle_id: str, seed: Optional[int] = None) -> Tuple[bool, Dict, float]:
+                                      battle_id: str, seed: Optional[int] = None,
+                                      priority: str = 'casual') -> Tuple[bool, Dict, float]:
         """呼叫節點生成戰鬥結果"""
-        start_time = time.time()
+        start_time = in_flight.start(node.id)
         
         try:
             payload = {
                 "battle_id": battle_id,
                 "prompt": battle_prompt,
-                "seed": seed or random.randint(1, 1000000)
+                "seed": battle_seed(battle_id) if seed is None else seed,
+                "priority": priority,
+                "max_wait": self.queue_max_wait
             }
             
             headers = {}
             if node.api_key:
                 headers['Authorization'] = f'Bearer {node.api_key}'
             
-            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout)) as session:
-                async with session.post(
-                    f"{node.url}/generate_battle",
-                    json=payload,
-                    headers=headers
-                ) as response:
-                    response_time = time.time() - start_time
-                    
-                    if response.status == 200:
-                        result = await response.json()
-                        # 使用 sync_to_async 來處理數據庫操作
-                        from asgiref.sync import sync_to_async
-                        await sync_to_async(node.record_request)(success=True, response_time=response_time)
-                        return True, result, response_time
-                    else:
-                        error_text = await response.text()
-                        logger.error(f"Node {node.name} returned {response.status}: {error_text}")
-                        from asgiref.sync import sync_to_async
-                        await sync_to_async(node.record_request)(success=False, response_time=response_time)
-                        return False, {"error": f"HTTP {response.status}: {error_text}"}, response_time
+            session = get_aiohttp_session()
+            async with session.post(
+                f"{node.url}/generate_battle",
+                json=payload,
+                headers=headers,
+                timeout=aiohttp.ClientTimeout(total=self.node_timeout(node))
+            ) as response:
+                response_time = time.time() - start_time
+                
+                if response.status == 200:
+                    result = await response.json()
+                    # 使用 sync_to_async 來處理數據庫操作
+                    from asgiref.sync import sync_to_async
+                    await sync_to_async(node.record_request)(success=True, response_time=response_time)
+                    return True, result, response_time
+                elif response.status == 503:
+                    # 節點忙碌不算失敗，由對沖改送備援節點
+                    error_text = await response.text()
+                    logger.info(f"Node {node.name} busy: {error_text}")
+                    return False, {"error": f"HTTP 503: {error_text}"}, response_time
+                else:
+                    error_text = await response.text()
+                    logger.error(f"Node {node.name} returned {response.status}: {error_text}")
+                    from asgiref.sync import sync_to_async
+                    await sync_to_async(node.record_request)(success=False, response_time=response_time)
+                    return False, {"error": f"HTTP {response.status}: {error_text}"}, response_time
                         
         except asyncio.TimeoutError:
             response_time = time.time() - start_time
@@ -110,37 +507,68 @@ class NodeManager:
             from asgiref.sync import sync_to_async
             await sync_to_async(node.record_request)(success=False, response_time=response_time)
             return False, {"error": str(e)}, response_time
+        
+        finally:
+            in_flight.finish(node.id, start_time)
     
     async def collect_battle_votes(self, battle: Battle, battle_prompt: str, 
-                                 selected_nodes: List[AINode]) -> List[BattleVotingRecord]:
-        """收集所有節點的戰鬥結果投票"""
+                                 selected_nodes: List[AINode],
+                                 spare_nodes: Optional[List[AINode]] = None,
+                                 priority: str = 'casual') -> List[BattleVotingRecord]:
+        """收集所有節點的戰鬥結果投票（回傳尚未寫入資料庫的投票記錄）"""
         battle_id = str(battle.id)
-        seed = random.randint(1, 1000000)  # 所有節點使用相同seed以獲得一致性
+        # 所有節點、每一輪重試都使用同一場戰鬥的引擎種子，節點端結果快取以 (battle_id, seed) 命中
+        seed = battle_seed(battle_id)
+        spares = list(spare_nodes or [])
+        hedge_budget = [self.max_hedges]
+        
+        async def hedged_call(node):
+            """主節點超過對沖門檻未回應（或已失敗）時，同一請求再送往備用節點，取先成功者"""
+            primary = asyncio.ensure_future(self.call_node_generate_battle(node, battle_prompt, battle_id, seed, priority))
+            done, _ = await asyncio.wait({primary}, timeout=self.hedge_delay(node))
+            if (done and primary.result()[0]) or hedge_budget[0] <= 0 or not spares:
+                return node, await primary
+            
+            hedge_budget[0] -= 1
+            spare = spares.pop(0)
+            logger.info(f"Hedging node {node.name} to spare {spare.name} for battle {battle_id}")
+            hedge = asyncio.ensure_future(self.call_node_generate_battle(spare, battle_prompt, battle_id, seed, priority))
+            contenders = {primary: node, hedge: spare}
+            pending = set(contenders)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.result()[0]:
+                        for other in pending:
+                            other.cancel()
+                        return contenders[task], task.result()
+            return node, primary.result()
         
         # 並行呼叫所有節點
         tasks = []
         for node in selected_nodes:
-            task = self.call_node_generate_battle(node, battle_prompt, battle_id, seed)
-            tasks.append((node, task))
+            tasks.append((node, hedged_call(node)))
         
         # 等待所有結果
         voting_records = []
         results = await asyncio.gather(*[task for _, task in tasks], return_exceptions=True)
         
-        # 使用 sync_to_async 來處理數據庫操作
+        # 投票先留在記憶體，由呼叫端在決策後一次寫入（持久模式下每票立即寫入）
         from asgiref.sync import sync_to_async
         
-        @sync_to_async
-        def create_voting_record(battle, node, voted_winner_id, battle_result, response_time, is_valid, error_message=None):
-            return BattleVotingRecord.objects.create(
+        async def create_voting_record(battle, node, voted_winner_id, battle_result, response_time, is_valid, error_message=None):
+            record = BattleVotingRecord(
                 battle=battle,
                 node=node,
                 voted_winner_id=voted_winner_id,
-                battle_result=battle_result,
+                result_blob=BattleResultBlob.for_result(battle_result),
                 response_time=response_time,
                 is_valid=is_valid,
                 error_message=error_message
             )
+            if self.durable_votes:
+                await sync_to_async(self.save_voting_records)([record])
+            return record
         
         for (node, _), result in zip(tasks, results):
             if isinstance(result, Exception):
@@ -155,7 +583,8 @@ class NodeManager:
                     error_message=str(result)
                 )
             else:
-                success, battle_result, response_time = result
+                # 席位可能由對沖的備用節點取得
+                node, (success, battle_result, response_time) = result
                 
                 if success and 'winner' in battle_result:
                     voting_record = await create_voting_record(
@@ -182,12 +611,67 @@ class NodeManager:
         logger.info(f"Collected {len(voting_records)} votes for battle {battle_id}")
         return voting_records
     
+    def save_voting_records(self, voting_records: List[BattleVotingRecord]) -> int:
+        """
+        寫入投票記錄，回傳實際寫入的票數。
+        重跑同一場戰鬥時已存在的 (battle, node) 投票略過並記錄數量；
+        整批寫入失敗（例如與並行重跑同時寫入而違反唯一約束）時逐筆寫入，單筆失敗不影響其他票。
+        """
+        if not voting_records:
+            return 0
+        # 先寫入內容定址的結果，相同內容只存一份
+        blobs = {record.result_blob_id: record.result_blob for record in voting_records if record.result_blob_id}
+        if blobs:
+            BattleResultBlob.objects.bulk_create(list(blobs.values()), ignore_conflicts=True)
+        
+        existing = set(BattleVotingRecord.objects.filter(
+            battle_id__in={record.battle_id for record in voting_records}
+        ).values_list('battle_id', 'node_id'))
+        new_records = []
+        for record in voting_records:
+            key = (record.battle_id, record.node_id)
+            if key not in existing:
+                existing.add(key)
+                new_records.append(record)
+        skipped = len(voting_records) - len(new_records)
+        if skipped:
+            logger.warning(f"Skipped {skipped} duplicate votes already recorded for the same battle and node")
+        if not new_records:
+            return 0
+        
+        try:
+            with transaction.atomic():
+                BattleVotingRecord.objects.bulk_create(new_records)
+            return len(new_records)
+        except DatabaseError as e:
+            logger.error(f"Bulk insert of {len(new_records)} votes failed, saving one by one: {e}")
+        
+        saved = 0
+        for record in new_records:
+            try:
+                with transaction.atomic():
+                    record.save(force_insert=True)
+                saved += 1
+            except IntegrityError:
+                logger.warning(f"Vote from node {record.node_id} for battle {record.battle_id} already recorded, skipped")
+            except DatabaseError as record_error:
+                logger.error(f"Failed to save vote from node {record.node_id}: {record_error}")
+        return saved
+    
     def determine_consensus_result(self, voting_records: List[BattleVotingRecord], 
-                                 player_id: str, opponent_id: str) -> Optional[Dict]:
-        """多數決投票確定最終戰鬥結果"""
+                                 player_id: str, opponent_id: str,
+                                 planned_votes: Optional[int] = None) -> Optional[Dict]:
+        """
+        多數決投票確定最終戰鬥結果。
+        指定 planned_votes 時（提前結束的法定多數模式），勝者需取得計畫票數的嚴格多數。
+        """
         valid_votes = [record for record in voting_records if record.is_valid]
         
-        if len(valid_votes) < self.min_consensus_nodes:
+        if planned_votes is not None:
+            if planned_votes < self.min_consensus_nodes:
+                logger.warning(f"Not enough planned votes: {planned_votes} < {self.min_consensus_nodes}")
+                return None
+        elif len(valid_votes) < self.min_consensus_nodes:
             logger.warning(f"Not enough valid votes: {len(valid_votes)} < {self.min_consensus_nodes}")
             return None
         
@@ -198,7 +682,7 @@ class NodeManager:
         for record in valid_votes:
             winner_id = record.voted_winner_id
             winner_votes[winner_id] += 1
-            battle_results[winner_id] = record.battle_result
+            battle_results[winner_id] = record.result
         
         # 確保只有有效的獲勝者ID被考慮
         valid_winner_ids = {str(player_id), str(opponent_id)}
@@ -213,137 +697,230 @@ class NodeManager:
         max_votes = filtered_votes[consensus_winner]
         
         # 檢查是否達到共識（超過半數）
-        if max_votes <= len(valid_votes) // 2:
-            logger.warning(f"No consensus reached. Winner {consensus_winner} got {max_votes}/{len(valid_votes)} votes")
+        total_votes = planned_votes if planned_votes is not None else len(valid_votes)
+        if max_votes <= total_votes // 2:
+            logger.warning(f"No consensus reached. Winner {consensus_winner} got {max_votes}/{total_votes} votes")
             # 如果沒有明確共識，回退到本地生成
             return None
         
         # 選擇獲勝者對應的戰鬥結果
         consensus_result = battle_results[consensus_winner]
         
-        logger.info(f"Consensus reached: {consensus_winner} with {max_votes}/{len(valid_votes)} votes")
+        logger.info(f"Consensus reached: {consensus_winner} with {max_votes}/{total_votes} votes")
         return consensus_result
     
-    def generate_battle_with_consensus_sync(self, battle: Battle, battle_prompt: str) -> Optional[Dict]:
-        """同步版本的分散式共識生成戰鬥結果 - 用於 Celery 任務"""
-        import requests
-        import json
-        
-        selected_nodes = self.select_nodes_for_battle(str(battle.id))
+    def check_vote_result(self, node: AINode, result: Dict, matchup: Optional[Dict]) -> Dict:
+        """
+        以固定戰鬥日誌檢查節點結果，不一致時就地修補，避免一張壞票浪費一輪共識。
+        新版節點回應前已自行驗證修補（valid / repairs 旗標），這裡主要處理舊版節點
+        """
+        valid = result.pop('valid', None)
+        repairs = result.pop('repairs', None)
+        if valid is False:
+            print(f"🔧 節點 {node.name} 已在本機修補結果: {', '.join(repairs or [])}")
+        if matchup is None:
+            return result
+        
+        issues = verify_result(result, matchup)
+        if issues:
+            print(f"🔧 節點 {node.name} 的結果與固定戰鬥日誌不一致（{', '.join(issues)}），由聚合器修補")
+            return repair_result(result, matchup)
+        return result
+    
+    def request_battle(self, node: AINode, payload: Dict, headers: Dict) -> Dict:
+        """送出一場戰鬥請求並回傳節點結果；開啟批次合併時經由 BatchDispatcher 與同節點的其他請求一起送出"""
+        connect_timeout, _ = node_timeouts()
+        timeout = self.node_timeout(node)
+        if self.batching:
+            return batcher.submit(node, payload, headers, timeout).result(timeout=connect_timeout + timeout)
+        
+        response = get_session().post(
+            f"{node.url}/generate_battle",
+            json=payload,
+            headers=headers,
+            timeout=(connect_timeout, timeout)
+        )
+        if response.status_code != 200:
+            raise node_error(response.status_code, response.text)
+        return response.json()
+    
+    def hedge_delay(self, node: AINode) -> float:
+        """對沖門檻：主節點超過此時間未回應即送出備援請求（節點近期的 p90 延遲）"""
+        if breakers.state(node.id) != CLOSED:
+            # 探測中的節點不可靠，立即對沖，戰鬥不依賴它的結果
+            return 0.0
+        p90 = node.latency_percentile(90)
+        if p90 is not None and histogram_samples(node.latency_histogram) >= self.hedge_min_samples:
+            delay = p90
+        elif node.avg_response_time:
+            # 樣本不足時，以平均響應時間的倍數近似 p90
+            delay = node.avg_response_time * self.hedge_p90_factor
+        else:
+            delay = self.timeout / 3
+        return max(self.hedge_min_delay, min(delay, self.timeout))
+    
+    def generate_battle_with_consensus_sync(self, battle: Battle, battle_prompt: str,
+                                            priority: str = 'casual',
+                                            matchup: Optional[Dict] = None) -> Optional[Dict]:
+        """
+        同步版本的分散式共識生成戰鬥結果 - 用於 Celery 任務
+        priority: 'ladder' 的天梯戰鬥在節點上優先排隊
+        matchup: 精簡對戰參數，提供時節點以它在本機渲染提示詞，battle_prompt 只送給舊版節點
+        """
+        available_nodes = self.get_available_nodes()
+        selected_nodes = self.select_nodes_for_battle(str(battle.id), available_nodes=available_nodes)
         
         if not selected_nodes:
             logger.info("No available nodes, falling back to local generation")
             return None
         
-        print(f"選擇了 {len(selected_nodes)} 個節點進行投票")
+        # 未被選中的可用節點作為對沖備援
+        selected_ids = {node.id for node in selected_nodes}
+        spare_nodes = rank_spares([node for node in available_nodes if node.id not in selected_ids])
+        selected_nodes, spare_nodes = self.apply_breakers(selected_nodes, spare_nodes)
         
-        # 收集投票 - 使用並行請求
-        import concurrent.futures
-        import threading
-        import time
+        planned_votes = len(selected_nodes)
+        print(f"選擇了 {planned_votes} 個節點進行投票，備援節點 {len(spare_nodes)} 個")
         
-        voting_records = []
         battle_id = str(battle.id)
-        seed = random.randint(1, 1000000)
+        # 與固定戰鬥日誌相同的引擎種子：重跑同一場戰鬥時請求不變，可命中節點端結果快取
+        seed = matchup['seed'] if matchup is not None else battle_seed(battle_id)
+        valid_winner_ids = {str(battle.character1.id), str(battle.character2.id)}
         
         def call_single_node(node):
-            """調用單個節點的函數"""
+            """調用單個節點的函數，成功時回傳 (結果, 響應時間)"""
+            started = in_flight.start(node.id)
+            start_time = time.time()
             try:
                 payload = {
-                    "prompt": battle_prompt,
                     "battle_id": battle_id,
-                    "seed": seed
+                    "seed": seed,
+                    "priority": priority,
+                    "max_wait": self.queue_max_wait
                 }
+                if matchup is not None and node.id not in matchup_unsupported:
+                    payload["matchup"] = matchup
+                else:
+                    payload["prompt"] = battle_prompt
                 
                 headers = {'Content-Type': 'application/json'}
                 if node.api_key:
                     headers['Authorization'] = f'Bearer {node.api_key}'
                 
-                start_time = time.time()
-                response = requests.post(
-                    f"{node.url}/generate_battle",
-                    json=payload,
-                    headers=headers,
-                    timeout=30
-                )
+                try:
+                    result = self.request_battle(node, payload, headers)
+                except NodeRequestError as e:
+                    if e.status_code != 422 or "matchup" not in payload:
+                        raise
+                    # 舊版節點不認得 matchup（或不支援此版本）：改送完整提示詞並記住
+                    print(f"節點 {node.name} 不支援精簡對戰參數，改送完整提示詞")
+                    matchup_unsupported.add(node.id)
+                    del payload["matchup"]
+                    payload["prompt"] = battle_prompt
+                    result = self.request_battle(node, payload, headers)
                 response_time = time.time() - start_time
                 
-                print(f"節點 {node.name} 響應狀態: {response.status_code}")
-                
-                if response.status_code == 200:
-                    result = response.json()
-                    if 'winner' in result:
-                        # 創建投票記錄
-                        voting_record = BattleVotingRecord.objects.create(
-                            battle=battle,
-                            node=node,
-                            voted_winner_id=str(result['winner']),
-                            battle_result=result,
-                            response_time=response_time,
-                            is_valid=True
-                        )
-                        node.record_request(success=True, response_time=response_time)
-                        print(f"✅ 節點 {node.name} 投票成功，選擇勝者: {result['winner']} ({response_time:.2f}秒)")
-                        return voting_record
-                    else:
-                        print(f"❌ 節點 {node.name} 返回無效結果")
-                        node.record_request(success=False, response_time=response_time)
-                        return None
+                if 'winner' in result:
+                    node.record_request(success=True, response_time=response_time)
+                    return self.check_vote_result(node, result, matchup), response_time
                 else:
-                    print(f"❌ 節點 {node.name} 返回錯誤: {response.status_code}")
-                    print(response.text)
+                    print(f"❌ 節點 {node.name} 返回無效結果")
                     node.record_request(success=False, response_time=response_time)
                     return None
                     
+            except NodeBusyError as e:
+                # 忙碌不計入節點統計與熔斷器；席位由對沖改送備援節點
+                print(f"⏳ 節點 {node.name} 忙碌，改由備援節點處理: {e}")
+                return None
+            except NodeRequestError as e:
+                print(f"❌ 節點 {node.name} 返回錯誤: {e}")
+                node.record_request(success=False, response_time=time.time() - start_time)
+                return None
             except Exception as e:
                 print(f"❌ 調用節點 {node.name} 失敗: {e}")
-                node.record_request(success=False, response_time=30.0)
+                node.record_request(success=False, response_time=self.node_timeout(node))
                 return None
+            finally:
+                in_flight.finish(node.id, started)
         
-        # 並行調用所有節點
-        print(f"🚀 並行調用 {len(selected_nodes)} 個節點...")
-        start_time = time.time()
+        def record_vote(node, outcome, is_late):
+            """建立投票記錄（先留在記憶體）；席位已被先到的結果佔用或已達成共識時記為遲到票"""
+            result, response_time = outcome
+            voting_record = BattleVotingRecord(
+                battle=battle,
+                node=node,
+                voted_winner_id=str(result['winner']),
+                result_blob=BattleResultBlob.for_result(result),
+                response_time=response_time,
+                is_valid=True,
+                is_late=is_late
+            )
+            if is_late or self.durable_votes:
+                # 遲到票不在決策路徑上，直接寫入；持久模式下每票到達即寫入
+                self.save_voting_records([voting_record])
+            if is_late:
+                print(f"⌛ 節點 {node.name} 遲到投票，選擇勝者: {result['winner']} ({response_time:.2f}秒)")
+            else:
+                print(f"✅ 節點 {node.name} 投票成功，選擇勝者: {result['winner']} ({response_time:.2f}秒)")
+            return voting_record
         
-        with concurrent.futures.ThreadPoolExecutor(max_workers=len(selected_nodes)) as executor:
-            # 提交所有任務
-            future_to_node = {executor.submit(call_single_node, node): node for node in selected_nodes}
-            
-            # 收集結果
-            for future in concurrent.futures.as_completed(future_to_node, timeout=35):
-                node = future_to_node[future]
-                try:
-                    result = future.result()
-                    if result:
-                        voting_records.append(result)
-                except Exception as e:
-                    print(f"❌ 節點 {node.name} 執行異常: {e}")
+        def has_quorum(votes, planned):
+            # 法定多數：領先者取得計畫票數的嚴格多數即可提前結束
+            if not self.early_quorum:
+                return False
+            winner_votes = Counter(v.voted_winner_id for v in votes if v.voted_winner_id in valid_winner_ids)
+            return bool(winner_votes) and max(winner_votes.values()) > planned // 2
         
-        total_time = time.time() - start_time
-        print(f"⏱️  並行調用完成，總耗時: {total_time:.2f}秒，收到 {len(voting_records)} 個有效投票")
+        # 並行調用所有節點
+        print(f"🚀 並行調用 {planned_votes} 個節點...")
+        dispatcher = HedgedDispatcher(
+            request_fn=call_single_node,
+            record_fn=record_vote,
+            hedge_delay_fn=self.hedge_delay,
+            max_hedges=self.max_hedges,
+            timeout=self.timeout + 5,
+            quorum_fn=has_quorum,
+        )
+        voting_records = dispatcher.run(selected_nodes, spare_nodes)
+        self.last_consensus_stats = dispatcher.stats
+        # 節點統計在行程內緩衝，到期才批次寫回
+        stats_recorder.flush_if_due()
         
-        # 確定共識結果
+        # 確定共識結果：提前結束時以計畫票數為分母，否則與非同步版本相同，以有效票數為分母
         if voting_records:
             consensus_result = self.determine_consensus_result(
                 voting_records, 
                 str(battle.character1.id), 
-                str(battle.character2.id)
+                str(battle.character2.id),
+                planned_votes=planned_votes if self.early_quorum else None
             )
+            # 決策完成後一次寫入計入的投票
+            if not self.durable_votes:
+                self.save_voting_records(voting_records)
             print(f"共識投票完成，共 {len(voting_records)} 票")
             return consensus_result
         else:
             print("沒有收到有效投票，使用本地生成")
             return None
     
-    async def generate_battle_with_consensus(self, battle: Battle, battle_prompt: str) -> Optional[Dict]:
+    async def generate_battle_with_consensus(self, battle: Battle, battle_prompt: str,
+                                             priority: str = 'casual') -> Optional[Dict]:
         """使用分散式共識生成戰鬥結果"""
-        selected_nodes = self.select_nodes_for_battle(str(battle.id))
+        from asgiref.sync import sync_to_async
+        available_nodes = await sync_to_async(self.get_available_nodes)()
+        selected_nodes = self.select_nodes_for_battle(str(battle.id), available_nodes=available_nodes)
         
         if not selected_nodes:
             logger.info("No available nodes, falling back to local generation")
             return None
         
+        selected_ids = {node.id for node in selected_nodes}
+        spare_nodes = rank_spares([node for node in available_nodes if node.id not in selected_ids])
+        selected_nodes, spare_nodes = await sync_to_async(self.apply_breakers)(selected_nodes, spare_nodes)
+        
         # 收集投票
-        voting_records = await self.collect_battle_votes(battle, battle_prompt, selected_nodes)
+        voting_records = await self.collect_battle_votes(battle, battle_prompt, selected_nodes, spare_nodes, priority)
+        await sync_to_async(stats_recorder.flush_if_due)()
         
         # 確定共識結果
         consensus_result = self.determine_consensus_result(
@@ -351,6 +928,8 @@ class NodeManager:
             str(battle.character1.id), 
             str(battle.character2.id)
         )
+        if not self.durable_votes:
+            await sync_to_async(self.save_voting_records)(voting_records)
         
         return consensus_result
 
@@ -362,30 +941,38 @@ class NodeHealthChecker:
     async def check_node_health(node: AINode) -> bool:
         """檢查單個節點健康狀態"""
         try:
-            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10)) as session:
-                headers = {}
-                if node.api_key:
-                    headers['Authorization'] = f'Bearer {node.api_key}'
-                
-                async with session.get(f"{node.url}/health", headers=headers) as response:
-                    if response.status == 200:
-                        from asgiref.sync import sync_to_async
-                        await sync_to_async(node.update_heartbeat)()
-                        return True
-                    else:
-                        logger.warning(f"Node {node.name} health check failed: {response.status}")
-                        from asgiref.sync import sync_to_async
-                        node.status = 'error'
-                        await sync_to_async(node.save)()
-                        return False
-                        
+            session = get_aiohttp_session()
+            headers = {}
+            if node.api_key:
+                headers['Authorization'] = f'Bearer {node.api_key}'
+            
+            timeout = aiohttp.ClientTimeout(total=getattr(settings, 'AI_NODE_HEALTH_TIMEOUT', 10))
+            async with session.get(f"{node.url}/health", headers=headers, timeout=timeout) as response:
+                if response.status == 200:
+                    from asgiref.sync import sync_to_async
+                    if await sync_to_async(node.update_heartbeat)():
+                        await sync_to_async(invalidate_node_registry)()
+                    return True
+                else:
+                    logger.warning(f"Node {node.name} health check failed: {response.status}")
+                    await NodeHealthChecker._set_status(node, 'error')
+                    return False
+                    
         except Exception as e:
             logger.error(f"Health check failed for node {node.name}: {str(e)}")
-            from asgiref.sync import sync_to_async
-            node.status = 'offline'
-            await sync_to_async(node.save)()
+            await NodeHealthChecker._set_status(node, 'offline')
             return False
     
+    @staticmethod
+    async def _set_status(node: AINode, new_status: str):
+        """更新節點狀態；狀態有變動時使註冊表快取失效"""
+        from asgiref.sync import sync_to_async
+        changed = node.status != new_status
+        node.status = new_status
+        await sync_to_async(node.save)(update_fields=['status'])
+        if changed:
+            await sync_to_async(invalidate_node_registry)()
+    
     @staticmethod
     async def check_all_nodes():
         """檢查所有節點的健康狀態"""
@@ -399,4 +986,19 @@ class NodeHealthChecker:
         online_count = sum(1 for result in results if result is True)
         logger.info(f"Health check completed: {online_count}/{len(nodes)} nodes online")
         
-        return online_count
\ No newline at end of file
+        return online_count
+    
+    @staticmethod
+    def probe_nodes(nodes: List[AINode]) -> List[bool]:
+        """同步入口：在單一事件迴圈內並行探測多個節點，共用同一個連線池"""
+        async def run():
+            try:
+                results = await asyncio.gather(
+                    *[NodeHealthChecker.check_node_health(node) for node in nodes],
+                    return_exceptions=True
+                )
+            finally:
+                await close_aiohttp_session()
+            return [result is True for result in results]
+        
+        return asyncio.run(run())
\ No newline at end of file
@@ -0,0 +1,217 @@
+# 節點效能統計：請求結果先在行程內緩衝，定期以行鎖 + bulk_update 批次寫回，
+# 同時維護 EWMA 響應時間與分桶延遲分佈（p50 / p95 / p99）
+import atexit
+import logging
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Sequence
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+from .models import AINode
+
+logger = logging.getLogger(__name__)
+
+# 延遲分桶上界（秒），最後一桶收納所有更慢的請求
+LATENCY_BUCKETS = [0.25, 0.5, 1, 2, 3, 5, 8, 13, 21, 34, float('inf')]
+# 分佈總數超過此值時所有桶減半，讓分佈反映近期表現
+HISTOGRAM_WINDOW = 1000
+# 每個節點在緩衝中最多保留的延遲樣本數
+MAX_BUFFERED_SAMPLES = 500
+
+
+def empty_histogram() -> List[int]:
+    return [0] * len(LATENCY_BUCKETS)
+
+
+def bucket_index(latency: float) -> int:
+    for index, bound in enumerate(LATENCY_BUCKETS):
+        if latency <= bound:
+            return index
+    return len(LATENCY_BUCKETS) - 1
+
+
+def latency_percentile(histogram: Sequence[int], q: float) -> Optional[float]:
+    """由分桶分佈估計第 q 百分位延遲（桶內線性內插）；沒有樣本時回傳 None"""
+    if not histogram or len(histogram) != len(LATENCY_BUCKETS):
+        return None
+    total = sum(histogram)
+    if total <= 0:
+        return None
+
+    target = total * q / 100
+    cumulative = 0
+    for index, count in enumerate(histogram):
+        if count and cumulative + count >= target:
+            lower = LATENCY_BUCKETS[index - 1] if index > 0 else 0.0
+            upper = LATENCY_BUCKETS[index]
+            if upper == float('inf'):
+                return lower
+            return lower + (upper - lower) * (target - cumulative) / count
+        cumulative += count
+    return LATENCY_BUCKETS[-2]
+
+
+def histogram_samples(histogram: Sequence[int]) -> int:
+    return sum(histogram) if histogram else 0
+
+
+def apply_samples(node: AINode, total: int, successes: int, samples: List[float],
+                  success_time: float, failed_time: float):
+    """
+    把一批請求結果套用到節點統計（呼叫端須持有該節點的行鎖）。
+    success_time 為所有成功請求的耗時總和；samples 只保留最近的樣本，用於 EWMA 與延遲分佈
+    """
+    alpha = getattr(settings, 'AI_NODE_EWMA_ALPHA', 0.2)
+
+    # 累計平均沿用原本定義：所有請求（失敗以逾時時間計）的平均
+    previous = node.total_requests
+    node.total_requests = previous + total
+    node.successful_requests += successes
+    batch_sum = success_time + failed_time
+    node.avg_response_time = (node.avg_response_time * previous + batch_sum) / node.total_requests
+
+    # EWMA 與延遲分佈只納入成功請求，失敗由健康檢查 / 熔斷處理
+    histogram = list(node.latency_histogram or [])
+    if len(histogram) != len(LATENCY_BUCKETS):
+        histogram = empty_histogram()
+    ewma = node.ewma_response_time
+    for latency in samples:
+        ewma = latency if not ewma else alpha * latency + (1 - alpha) * ewma
+        histogram[bucket_index(latency)] += 1
+    if sum(histogram) > HISTOGRAM_WINDOW:
+        histogram = [count // 2 for count in histogram]
+    node.ewma_response_time = ewma
+    node.latency_histogram = histogram
+
+
+def _new_entry() -> dict:
+    return {'total': 0, 'successes': 0, 'samples': [], 'success_time': 0.0, 'failed_time': 0.0}
+
+
+def _merge_entry(entry: dict, newer: dict):
+    """把較新的緩衝合併進 entry（寫回失敗後放回緩衝時使用）"""
+    entry['total'] += newer['total']
+    entry['successes'] += newer['successes']
+    entry['success_time'] += newer['success_time']
+    entry['failed_time'] += newer['failed_time']
+    entry['samples'] = (entry['samples'] + newer['samples'])[-MAX_BUFFERED_SAMPLES:]
+
+
+class NodeStatsRecorder:
+    """
+    行程內的節點統計緩衝區。
+    共識流程結束時呼叫 flush_if_due；另有背景執行緒定期檢查，閒置的 worker 也會在間隔內寫回
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending: Dict[str, dict] = {}
+        self._pending_count = 0
+        self._last_flush = time.monotonic()
+        self._flusher_pid = None
+
+    @property
+    def interval(self) -> float:
+        return getattr(settings, 'AI_NODE_STATS_FLUSH_INTERVAL', 5)
+
+    def _ensure_flusher(self):
+        # prefork 之後子行程沒有父行程的執行緒，偵測到 pid 變動就重建（呼叫端持有 _lock）
+        if self._flusher_pid != os.getpid():
+            self._flusher_pid = os.getpid()
+            threading.Thread(target=self._flush_periodically, name='node-stats-flush', daemon=True).start()
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush_if_due()
+            finally:
+                close_old_connections()
+
+    def record(self, node_id, success: bool, response_time: float):
+        with self._lock:
+            self._ensure_flusher()
+            entry = self._pending.setdefault(str(node_id), _new_entry())
+            entry['total'] += 1
+            if success:
+                entry['successes'] += 1
+                entry['success_time'] += float(response_time)
+                entry['samples'].append(float(response_time))
+                if len(entry['samples']) > MAX_BUFFERED_SAMPLES:
+                    entry['samples'].pop(0)
+            else:
+                entry['failed_time'] += float(response_time)
+            self._pending_count += 1
+
+    def flush_if_due(self) -> int:
+        max_pending = getattr(settings, 'AI_NODE_STATS_MAX_PENDING', 200)
+        with self._lock:
+            due = self._pending_count and (
+                self._pending_count >= max_pending or time.monotonic() - self._last_flush >= self.interval
+            )
+        return self.flush() if due else 0
+
+    def flush(self) -> int:
+        """寫回所有緩衝中的統計，回傳更新的節點數"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._pending_count = 0
+            self._last_flush = time.monotonic()
+        if not pending:
+            return 0
+
+        count = sum(entry['total'] for entry in pending.values())
+        try:
+            with transaction.atomic():
+                # 依 id 排序上鎖，避免多個 worker 同時寫回時死結
+                nodes = list(AINode.objects.select_for_update().filter(id__in=list(pending)).order_by('id'))
+                for node in nodes:
+                    entry = pending[str(node.id)]
+                    apply_samples(node, entry['total'], entry['successes'], entry['samples'],
+                                  entry['success_time'], entry['failed_time'])
+                AINode.objects.bulk_update(nodes, [
+                    'total_requests', 'successful_requests', 'avg_response_time',
+                    'ewma_response_time', 'latency_histogram',
+                ])
+            return len(nodes)
+        except Exception as e:
+            logger.error(f"Failed to flush node stats, keeping {count} buffered results: {e}")
+            # 放回緩衝，下次寫回時與之後的結果一起寫入
+            with self._lock:
+                for node_id, entry in pending.items():
+                    newer = self._pending.get(node_id)
+                    if newer:
+                        _merge_entry(entry, newer)
+                    self._pending[node_id] = entry
+                self._pending_count += count
+            return 0
+
+
+recorder = NodeStatsRecorder()
+
+
+@atexit.register
+def _flush_on_exit():
+    try:
+        recorder.flush()
+    except Exception:
+        pass
+
+
+def node_stats(node: AINode) -> dict:
+    """節點統計的讀取介面（後台、節點列表與調度器共用）"""
+    histogram = node.latency_histogram or []
+    return {
+        'total_requests': node.total_requests,
+        'successful_requests': node.successful_requests,
+        'success_rate': node.success_rate,
+        'avg_response_time': node.avg_response_time,
+        'ewma_response_time': node.ewma_response_time,
+        'latency_samples': histogram_samples(histogram),
+        'latency_p50': latency_percentile(histogram, 50),
+        'latency_p95': latency_percentile(histogram, 95),
+        'latency_p99': latency_percentile(histogram, 99),
+    }
@@ -9,6 +9,10 @@ from django.utils.decorators import method_decorator
 from django.utils import timezone
 from .models import AINode
 from .node_service import NodeHealthChecker
+from .node_registry import invalidate_node_registry
+from .node_heartbeats import buffer_heartbeat, load_fields
+from .node_breaker import breakers
+from django.core.exceptions import ValidationError
 import asyncio
 import json
 import logging
@@ -40,6 +44,7 @@ def register_node(request):
             existing_node.max_concurrent_requests = data.get('max_concurrent_requests', existing_node.max_concurrent_requests)
             existing_node.update_heartbeat()
             existing_node.save()
+            invalidate_node_registry()
             
             logger.info(f"Updated existing node: {existing_node.name}")
             return Response({
@@ -58,6 +63,7 @@ def register_node(request):
             status='online'
         )
         node.update_heartbeat()
+        invalidate_node_registry()
         
         logger.info(f"Registered new node: {node.name}")
         return Response({
@@ -87,20 +93,33 @@ def node_heartbeat(request):
                 'error': 'node_id is required'
             }, status=status.HTTP_400_BAD_REQUEST)
         
+        # 已在線節點的心跳先寫入 Redis，由 flush_node_heartbeats 批次寫回資料庫
+        load = load_fields(data)
+        buffered_at = buffer_heartbeat(node_id, load)
+        if buffered_at is not None:
+            return Response({
+                'message': 'Heartbeat received',
+                'status': 'online',
+                'last_heartbeat': buffered_at
+            })
+        
         try:
             node = AINode.objects.get(id=node_id)
-        except AINode.DoesNotExist:
+        except (AINode.DoesNotExist, ValidationError):
             return Response({
                 'error': 'Node not found'
             }, status=status.HTTP_404_NOT_FOUND)
         
-        # 更新心跳和狀態信息
-        node.update_heartbeat()
-        
-        # 更新負載信息
-        if 'current_requests' in data:
-            node.current_requests = data['current_requests']
-            node.save(update_fields=['current_requests'])
+        # 更新心跳和負載信息（單次寫入）；只有狀態改變（重新上線）時才需要刷新註冊表快取
+        for field, value in load.items():
+            setattr(node, field, value)
+        status_changed = node.status == 'offline'
+        node.last_heartbeat = timezone.now()
+        if status_changed:
+            node.status = 'online'
+        node.save(update_fields=['last_heartbeat', 'status', *load])
+        if status_changed:
+            invalidate_node_registry()
         
         return Response({
             'message': 'Heartbeat received',
@@ -122,6 +141,7 @@ def list_nodes(request):
     """列出所有節點狀態"""
     try:
         nodes = AINode.objects.all().order_by('-last_heartbeat')
+        breaker_states = breakers.states(node.id for node in nodes)
         
         nodes_data = []
         for node in nodes:
@@ -137,8 +157,16 @@ def list_nodes(request):
                 'successful_requests': node.successful_requests,
                 'success_rate': node.success_rate,
                 'avg_response_time': node.avg_response_time,
+                'ewma_response_time': node.ewma_response_time,
+                'latency_p50': node.latency_p50,
+                'latency_p95': node.latency_p95,
+                'latency_p99': node.latency_p99,
+                'circuit_breaker': breaker_states[str(node.id)],
+                'node_metrics': (node.metrics or {}).get('window'),
                 'weight': node.weight,
                 'current_requests': node.current_requests,
+                'queued_requests': node.queued_requests,
+                'queue_eta': node.queue_eta,
                 'max_concurrent_requests': node.max_concurrent_requests,
                 'created_at': node.created_at
             })
@@ -196,6 +224,7 @@ def remove_node(request, node_id):
         node = AINode.objects.get(id=node_id)
         node_name = node.name
         node.delete()
+        invalidate_node_registry()
         
         logger.info(f"Removed node: {node_name}")
         return Response({
@@ -230,6 +259,7 @@ def update_node(request, node_id):
                 setattr(node, field, data[field])
         
         node.save()
+        invalidate_node_registry()
         
         logger.info(f"Updated node: {node.name}")
         return Response({
@@ -5,33 +5,33 @@ import random
 from typing import Dict, Any
 
 from django.db import transaction
-from google import genai
 
 from .models import Player, Character, Battle
 from .configs import LEVEL_CONFIGS
+from .llm_backend import LLMBackend, create_backend
 
 
 class GeminiService:
     """
-    負責與 Google Gemini API 進行通訊的服務。
+    負責與 LLM 進行通訊的服務（預設為 Google Gemini API，LLM_BACKEND=stub 時使用離線的假 LLM）。
     """
-    def __init__(self, api_key: str = None):
+    def __init__(self, api_key: str = None, backend: LLMBackend = None):
         self.api_key = api_key or os.getenv('GEMINI_API_KEY')
-        if not self.api_key:
+        self._backend = backend
+        if backend is None and os.getenv('LLM_BACKEND', 'gemini').lower() == 'gemini' and not self.api_key:
             raise ValueError("GEMINI_API_KEY 環境變數未設定。")
-        self._client = None
 
     @property
-    def client(self):
-        if self._client is None:
-            self._client = genai.Client(api_key=self.api_key)
-        return self._client
+    def backend(self) -> LLMBackend:
+        if self._backend is None:
+            self._backend = create_backend(api_key=self.api_key)
+        return self._backend
 
-    def _parse_gemini_response(self, response) -> Dict[str, Any]:
+    def _parse_gemini_response(self, raw_text: str) -> Dict[str, Any]:
         """
-        清理並解析 Gemini 回傳的文字為字典。
+        清理並解析 LLM 回傳的文字為字典。
         """
-        raw_text = getattr(response, "text", "")
+        raw_text = raw_text or ""
         # 移除 markdown 區塊標記
         if raw_text.startswith("```json"):
             raw_text = raw_text[len("```json"):].strip()
@@ -70,11 +70,7 @@ class GeminiService:
             注意：這是{rarity_name}稀有度角色，屬性應該在{min_val}-{max_val}範圍內
             """
         try:
-            response = self.client.models.generate_content(
-                model="gemini-2.0-flash",
-                contents=ai_prompt
-            )
-            data = self._parse_gemini_response(response)
+            data = self._parse_gemini_response(self.backend.generate_text(ai_prompt))
             return {
                 'skill_description': data.get('skill_description', f'{rarity_name}稀有度角色的專屬技能'),
                 'strength': max(min_val, min(max_val, int(data.get('strength', min_val)))),
@@ -15,13 +15,13 @@ from pydantic import BaseModel
 from typing import List
 import asyncio
 from .node_service import NodeManager
+from .battle_engine import simulate_battle, battle_seed, apply_narration, matchup_payload
+from .battle_prompt import render_prompt
+from .llm_backend import create_backend
 from web3 import Web3
 import hashlib
 import requests
 
-# 戰鬥參數
-INITIAL_HP = int(os.getenv('BATTLE_INITIAL_HP', 300))  # 預設 300，可用環境變數覆寫
-
 # 定義戰鬥結果的Pydantic模型
 class BattleLogEntry(BaseModel):
     attacker: str
@@ -188,128 +188,6 @@ REMINDER: The image must be completely text-free. No captions, labels, titles, o
         print(f"❌ 圖片生成失敗 (角色 {character_id}): {e}")
         pass
 
-def validate_battle_result(battle_result, player, opponent):
-    """驗證戰鬥結果的一致性（優先使用ID，比對不過時回退比對名稱）"""
-    try:
-        battle_log = battle_result.get('battle_log', [])
-        winner_id = str(battle_result.get('winner'))
-        
-        # 追蹤血量
-        player_hp = INITIAL_HP
-        opponent_hp = INITIAL_HP
-        
-        player_id_str = str(player.id)
-        opponent_id_str = str(opponent.id)
-        
-        for i, log in enumerate(battle_log):
-            attacker = str(log.get('attacker'))
-            defender = str(log.get('defender'))
-            damage = int(log.get('damage', 0))
-            remaining_hp = int(log.get('remaining_hp', 0))
-            
-            matched = False
-            # 先用ID比對
-            if defender == player_id_str:
-                player_hp = max(0, player_hp - damage)
-                matched = True
-                if remaining_hp != player_hp:
-                    print(f"血量不一致(ID)：回合 {i+1}，{player.name} 血量應為 {player_hp}，記錄 {remaining_hp}")
-                    return False
-            elif defender == opponent_id_str:
-                opponent_hp = max(0, opponent_hp - damage)
-                matched = True
-                if remaining_hp != opponent_hp:
-                    print(f"血量不一致(ID)：回合 {i+1}，{opponent.name} 血量應為 {opponent_hp}，記錄 {remaining_hp}")
-                    return False
-            
-            # 若ID未匹配，回退用名稱比對（兼容舊資料或模型輸出）
-            if not matched:
-                if defender == player.name:
-                    player_hp = max(0, player_hp - damage)
-                    if remaining_hp != player_hp:
-                        print(f"血量不一致(名稱)：回合 {i+1}，{player.name} 血量應為 {player_hp}，記錄 {remaining_hp}")
-                        return False
-                elif defender == opponent.name:
-                    opponent_hp = max(0, opponent_hp - damage)
-                    if remaining_hp != opponent_hp:
-                        print(f"血量不一致(名稱)：回合 {i+1}，{opponent.name} 血量應為 {opponent_hp}，記錄 {remaining_hp}")
-                        return False
-            
-            if player_hp <= 0 or opponent_hp <= 0:
-                break
-        
-        # 以血量推算勝者
-        actual_winner_id = str(player.id) if opponent_hp <= 0 else str(opponent.id)
-        if winner_id != actual_winner_id:
-            print(f"勝者不一致：記錄 {winner_id}，實際應為 {actual_winner_id}")
-            return False
-        
-        return True
-    except Exception as e:
-        print(f"驗證戰鬥結果時發生錯誤：{e}")
-        return False
-
-def fix_battle_result(battle_result, player, opponent):
-    """修正戰鬥結果的不一致性"""
-    try:
-        battle_log = battle_result.get('battle_log', [])
-        
-        # 重新計算血量 - 使用ID而不是name
-        player_hp = INITIAL_HP
-        opponent_hp = INITIAL_HP
-        
-        player_id_str = str(player.id)
-        opponent_id_str = str(opponent.id)
-        
-        print(f"修正戰鬥結果: 玩家ID={player_id_str}, 對手ID={opponent_id_str}")
-        
-        for i, log in enumerate(battle_log):
-            attacker = str(log.get('attacker'))
-            defender = str(log.get('defender'))
-            damage = log.get('damage', 0)
-            
-            # 使用ID匹配，不是name
-            if defender == player_id_str:
-                player_hp = max(0, player_hp - damage)
-                log['remaining_hp'] = player_hp
-                print(f"回合{i+1}: {player.name}被攻擊，受到{damage}傷害，剩餘HP={player_hp}")
-            elif defender == opponent_id_str:
-                opponent_hp = max(0, opponent_hp - damage)
-                log['remaining_hp'] = opponent_hp
-                print(f"回合{i+1}: {opponent.name}被攻擊，受到{damage}傷害，剩餘HP={opponent_hp}")
-        
-        # 修正勝者：血量高的那個獲勝
-        if player_hp > opponent_hp:
-            actual_winner_id = player.id
-            winner_name = player.name
-        elif opponent_hp > player_hp:
-            actual_winner_id = opponent.id
-            winner_name = opponent.name
-        else:
-            # 平局，隨機決定
-            import random
-            if random.random() > 0.5:
-                actual_winner_id = player.id
-                winner_name = player.name
-            else:
-                actual_winner_id = opponent.id
-                winner_name = opponent.name
-        
-        battle_result['winner'] = str(actual_winner_id)
-        
-        # 修正戰鬥描述
-        battle_result['battle_description'] = f"經過激烈的戰鬥，{winner_name} 最終獲得了勝利！"
-        
-        print(f"修正結果: 玩家HP={player_hp}, 對手HP={opponent_hp}, 勝者={winner_name}")
-        
-        return battle_result
-        
-    except Exception as e:
-        print(f"修正戰鬥結果時發生錯誤：{e}")
-        import traceback
-        traceback.print_exc()
-        return battle_result
-
 
 @shared_task
 def sync_ladder_rankings_task():
@@ -350,7 +228,7 @@ def sync_specific_season_rankings_task(season_id):
 
 
 @shared_task
-def run_battle_task(battle_id):
+def run_battle_task(battle_id, priority='casual'):
     try:
         # 使用 transaction.atomic 確保資料庫操作的原子性
         with transaction.atomic():
@@ -359,122 +237,17 @@ def run_battle_task(battle_id):
             player = battle.character1
             opponent = battle.character2
 
-            # 準備戰鬥場景描述 (使用結構化輸出，加入屬性權重與微量幸運)
-            # 推導屬性引導參數（作為 LLM 參考，不是硬規則）
-            p_STR, p_AGI, p_LUK = player.strength, player.agility, player.luck
-            o_STR, o_AGI, o_LUK = opponent.strength, opponent.agility, opponent.luck
-
-            def dmg_params(STR, AGI):
-                # 進一步降低係數與上限，延長回合
-                base = 0.3*STR + 0.15*AGI
-                low = max(3, int(base*0.8))
-                high = int(min(low + 12, base*0.95 + 10))
-                return low, high
-            p_low, p_high = dmg_params(p_STR, p_AGI)
-            o_low, o_high = dmg_params(o_STR, o_AGI)
-
-            def crit_rate(LUK):
-                return min(0.15, 0.005*LUK)  # 上限 15%
-            p_crit = crit_rate(p_LUK)
-            o_crit = crit_rate(o_LUK)
-
-            def dodge_suggestion(a_agi, d_agi):
-                diff = max(0, a_agi - d_agi)
-                return min(0.15, diff/180.0)  # 提升上限到 15%
-            # 我方攻擊對手 → 對手的建議閃避率
-            o_vs_p_dodge = dodge_suggestion(p_AGI, o_AGI)
-            # 對手攻擊我方 → 我方的建議閃避率
-            p_vs_o_dodge = dodge_suggestion(o_AGI, p_AGI)
-
-            luck_one_off_p = min(0.08, 0.0015*p_LUK)
-            luck_one_off_o = min(0.08, 0.0015*o_LUK)
-
-            battle_prompt = f"""
-                        一場史詩般的對決即將展開！
-
-                        **你的任務是創造一場獨一無二的戰鬥。**
-
-                        第一步：請你自行想像一個極具創意、天馬行空的戰鬥地點。
-
-                        第二步：基於這個你想像出來的地點，生成一場精彩的戰鬥過程。請讓敘事具有電影感（環境描寫、音效感、鏡頭語言），巧妙融入場景對戰局的影響（例如地形、高度差、天氣、機關）。
-
-                        **戰鬥員資料：**
-
-                        角色1：
-                        ID：{player.id}
-                        名稱：{player.name}
-                        描述：{player.prompt}
-                        力量：{player.strength}
-                        敏捷：{player.agility}
-                        幸運：{player.luck}
-                        特殊能力：{player.skill_description}
-
-                        角色2：
-                        ID：{opponent.id}
-                        名稱：{opponent.name}
-                        描述：{opponent.prompt}
-                        力量：{opponent.strength}
-                        敏捷：{opponent.agility}
-                        幸運：{opponent.luck}
-                        特殊能力：{opponent.skill_description}
-
-                        **屬性權重與隨機機制（請遵循，允許 ±10% 的自然波動）：**（敘事可以天馬行空，但數值需遵守）
-                        - 傷害建議（角色1→角色2）：每回合在 [{p_low}, {p_high}] 間，並有 0~2 的微隨機。
-                        - 傷害建議（角色2→角色1）：每回合在 [{o_low}, {o_high}] 間，並有 0~2 的微隨機。
-                        - 暴擊率建議：角色1 {p_crit:.0%}、角色2 {o_crit:.0%}，暴擊約 1.35x。
-                        - 重要上限：單次傷害不應超過初始血量的 15%（≈ {int(INITIAL_HP*0.15)}）。
-                        - 場景影響：場景因素可偶爾影響單次傷害（±10% 以內）或觸發狀態（濕滑、致盲、重力變化），請在敘事中體現。
-                        - 閃避率建議：角色1被攻時 ~{p_vs_o_dodge:.0%}，角色2被攻時 ~{o_vs_p_dodge:.0%}。
-                        - 幸運一次性意外：全場最多一次，角色1機率 {luck_one_off_p:.0%}、角色2機率 {luck_one_off_o:.0%}，可造成當次結果最高約 1.15x 偏移（可能有利或不利）。
-
-                        **先後手建議（每回合判定一次）：**
-                        - 基於敏捷，較高者約 60% 機率先手；剩餘 40% 視敘事交替。
-
-                        **重要規則：**
-                        1. 6-10 個回合的戰鬥（若過早致命，請以場景或動作安排讓戰鬥在規則內至少到第 6 回合才結束）。
-                        2. 你想像出的戰鬥地點必須對戰局產生決定性或意想不到的影響。
-                        3. 每個回合要有具體的動作和傷害值，敘事請生動、具臨場感（可以使用擬聲詞）。
-                        4. 要運用到角色的特殊能力，且至少有一次「招牌技能」的戲劇性演出（同時數值仍需合規）。
-                        5. 血量先歸零者輸，請嚴格按照血量計算決定勝負。
-                        6. 每個回合結束後，請仔細檢查剩餘血量，確保敘述與數據一致。
-                        7. 若有角色血量歸零，立即結束戰鬥，不要補多餘回合。
-
-                        **血量追蹤規則：**
-                        - 每個角色初始血量：{INITIAL_HP}
-                        - 每回合結束後，被攻擊者的剩餘血量 = 當前血量 - 受到的傷害
-                        - 如果剩餘血量 <= 0，該角色立即敗北
-                        - 最後一個血量 > 0 的角色獲勝
-
-                        **重要：ID格式要求（必須嚴格遵守）：**
-                        - winner字段必須填入獲勝者的ID：{player.id} 或 {opponent.id}
-                        - 每個回合的attacker字段必須填入攻擊者的ID：{player.id} 或 {opponent.id}
-                        - 每個回合的defender字段必須填入防守者的ID：{player.id} 或 {opponent.id}
-                        - description字段中可以使用角色名稱（{player.name}、{opponent.name}）來描述戰鬥
-                        - 每個回合的damage和remaining_hp必須是數字
-                        - 血量計算必須正確
-                        - 最後一個血量 > 0 的角色必須是winner
-                        - 如果某角色血量歸零，戰鬥立即結束
-
-                        **範例格式（請務必使用ID而不是名稱）：**
-                        {{
-                            "winner": "{player.id}",
-                            "battle_log": [
-                                {{
-                                    "attacker": "{player.id}",
-                                    "defender": "{opponent.id}",
-                                    "action": "火球術",
-                                    "damage": 15,
-                                    "remaining_hp": 85,
-                                    "description": "{player.name}施放火球術攻擊{opponent.name}"
-                                }}
-                            ]
-                        }}
-
-                        請仔細檢查你的回答，確保：
-                        1. 所有ID字段都使用角色ID，不是名稱
-                        2. 敘述與數據完全一致
-                        3. 血量計算準確無誤
-                        """
+            if battle.status == 'COMPLETED':
+                # 結果已提交（任務重送或中途失敗），直接續跑後續階段
+                print(f"Battle {battle_id} 已完成生成，續跑後續階段")
+                transaction.on_commit(lambda: start_battle_pipeline(battle_id))
+                return
+
+            # 由確定性引擎計算權威的回合數值，LLM 只負責為固定的日誌撰寫敘事
+            engine_result = simulate_battle(player, opponent, battle_seed(battle.id))
+            # 節點只收精簡的對戰參數並在本機渲染提示詞；本地回退時用同一份範本
+            matchup = matchup_payload(player, opponent, engine_result)
+            battle_prompt = render_prompt(matchup)
 
         # 嘗試使用分散式節點生成戰鬥結果
         node_manager = NodeManager()
@@ -487,7 +260,9 @@ def run_battle_task(battle_id):
                 print(f"找到 {len(available_nodes)} 個可用節點，嘗試分散式生成")
                 
                 # 使用同步版本的分散式共識
-                battle_result = node_manager.generate_battle_with_consensus_sync(battle, battle_prompt)
+                battle_result = node_manager.generate_battle_with_consensus_sync(
+                    battle, battle_prompt, priority=priority, matchup=matchup
+                )
                 
                 if battle_result:
                     print("成功從分散式節點獲得戰鬥結果")
@@ -502,261 +277,352 @@ def run_battle_task(battle_id):
             print(f"分散式節點調用失敗，使用本地生成: {e}")
             battle_result = None
         
-        # 如果分散式節點無法產生共識結果，回退到本地Gemini API
+        # 如果分散式節點無法產生共識結果，回退到本地 LLM（LLM_BACKEND 選擇 Gemini 或 stub）
         if battle_result is None:
-            print("回退到本地Gemini API生成戰鬥結果")
-            genai_client = genai.Client(api_key=os.getenv('GEMINI_API_KEY'))
-            response = genai_client.models.generate_content(
-                model="gemini-2.0-flash",
-                contents=battle_prompt,
-                config={
-                    "response_mime_type": "application/json",
-                    "response_schema": BattleResult,
-                }
-            )
-            
-            # 直接使用解析後的結果，轉換為dict格式以兼容現有邏輯
-            if response.parsed:
-                battle_result = response.parsed.model_dump()
-            else:
-                # 如果解析失敗，拋出錯誤
-                raise ValueError("Failed to parse battle result from Gemini API")
-
-        # 驗證並修正戰鬥結果
-        if not validate_battle_result(battle_result, player, opponent):
-            print("戰鬥結果不一致，正在修正...")
-            battle_result = fix_battle_result(battle_result, player, opponent)
-
-        # 更新 Battle 物件
+            print("回退到本地 LLM 生成戰鬥敘事")
+            try:
+                battle_result = create_backend().generate_json(battle_prompt, BattleResult, seed=matchup['seed'])
+                if battle_result is None:
+                    print("LLM 敘事解析失敗，使用引擎預設敘事")
+            except Exception as e:
+                # LLM 失敗不影響勝負，數值由引擎決定
+                print(f"LLM 敘事生成失敗，使用引擎預設敘事: {e}")
+
+        # 數值一律以引擎為準，只套用敘事文字
+        battle_result = apply_narration(engine_result, battle_result)
+
+        # 更新 Battle 物件：第一階段完成即提交玩家可見的結果
         battle.winner = player if str(battle_result['winner']) == str(player.id) else opponent
-        battle.battle_log = battle_result  # 將 AI 的回傳存到 battle_log
+        victory = battle.winner == player
+        # 將獎勵信息加入戰鬥日誌（實際發放由 settle_battle_rewards_task 執行）
+        battle_result['battle_rewards'] = calculate_battle_rewards(opponent, victory)
+        battle.battle_log = battle_result
         battle.status = 'COMPLETED'
         battle.save()
 
-        # 更新角色戰績和任務進度
-        from .daily_quest_service import DailyQuestService
+        # 後續階段：發放獎勵 → IPFS 存證 → 送交易 → 確認收據
+        transaction.on_commit(lambda: start_battle_pipeline(battle_id))
+
+    except Exception as e:
+        print(f"Error in run_battle_task for battle_id {battle_id}: {e}")
+        # 如果發生錯誤，更新戰鬥狀態
+        try:
+            battle = Battle.objects.get(id=battle_id)
+            battle.status = 'ERROR'
+            battle.battle_log = {'error': str(e)}
+            battle.save()
+        except Battle.DoesNotExist:
+            print(f"Battle with id {battle_id} not found when trying to log error.")
+
+
+def calculate_battle_rewards(opponent, victory):
+    """計算戰鬥獎勵（不寫入資料庫）"""
+    if victory:
+        # 戰鬥勝利獎勵
+        base_gold_reward = 500
+        base_exp_reward = 5
         
-        if battle.winner == player:
-            player.win_count += 1
-            player_user = player.player
-            
-            # 戰鬥勝利獎勵
-            base_gold_reward = 500
-            base_exp_reward = 5
-            
-            # 根據對手稀有度調整獎勵
-            rarity_multiplier = {1: 1.0, 2: 1.2, 3: 1.5, 4: 2.0, 5: 3.0}
-            multiplier = rarity_multiplier.get(opponent.rarity, 1.0)
-            
-            gold_reward = int(base_gold_reward * multiplier)
-            exp_reward = int(base_exp_reward * multiplier)
-            
-            # 發放獎勵
-            player_user.gold += gold_reward
-            player_user.exp_potion += exp_reward
-            player_user.save()
-            
-            # 將獎勵信息加入戰鬥日誌
-            battle_result['battle_rewards'] = {
-                'gold': gold_reward,
-                'exp_potion': exp_reward,
-                'rarity_bonus': multiplier,
-                'victory': True
-            }
-            
-            # 更新玩家勝利任務進度
-            DailyQuestService.update_quest_progress(
-                player.player, 'battle_win', 1
-            )
+        # 根據對手稀有度調整獎勵
+        rarity_multiplier = {1: 1.0, 2: 1.2, 3: 1.5, 4: 2.0, 5: 3.0}
+        multiplier = rarity_multiplier.get(opponent.rarity, 1.0)
+        
+        return {
+            'gold': int(base_gold_reward * multiplier),
+            'exp_potion': int(base_exp_reward * multiplier),
+            'rarity_bonus': multiplier,
+            'victory': True
+        }
+    
+    # 失敗也給少量安慰獎勵
+    return {
+        'gold': 100,
+        'exp_potion': 0,
+        'rarity_bonus': 1.0,
+        'victory': False
+    }
+
+
+def start_battle_pipeline(battle_id):
+    """串接戰鬥後續階段，每個階段皆可重複執行並路由到各自的隊列"""
+    from celery import chain
+    battle_id = str(battle_id)
+    return chain(
+        settle_battle_rewards_task.si(battle_id),
+        pin_battle_result_task.si(battle_id),
+        submit_battle_tx_task.si(battle_id),
+        confirm_battle_tx_task.si(battle_id),
+    ).apply_async()
+
+
+@shared_task
+def settle_battle_rewards_task(battle_id):
+    """階段二：更新戰績並發放獎勵（以 rewards_settled 確保只發放一次）"""
+    from django.db.models import F
+    from .models import Player
+    from .daily_quest_service import DailyQuestService
+    
+    with transaction.atomic():
+        claimed = Battle.objects.filter(
+            id=battle_id, status='COMPLETED', rewards_settled=False
+        ).update(rewards_settled=True)
+        if not claimed:
+            print(f"[Settle] battle_id={battle_id} 已結算或尚未完成，略過")
+            return False
+        
+        battle = Battle.objects.select_related('character1__player', 'winner').get(id=battle_id)
+        player = battle.character1
+        rewards = battle.battle_log.get('battle_rewards') or calculate_battle_rewards(
+            battle.character2, battle.winner_id == player.id
+        )
+        
+        if rewards['victory']:
+            Character.objects.filter(id=player.id).update(win_count=F('win_count') + 1)
         else:
-            player.loss_count += 1
-            # 失敗也給少量安慰獎勵
-            player_user = player.player
-            consolation_gold = 100
-            player_user.gold += consolation_gold
-            player_user.save()
-            
-            # 將獎勵信息加入戰鬥日誌
-            battle_result['battle_rewards'] = {
-                'gold': consolation_gold,
-                'exp_potion': 0,
-                'rarity_bonus': 1.0,
-                'victory': False
-            }
+            Character.objects.filter(id=player.id).update(loss_count=F('loss_count') + 1)
         
-        # 更新戰鬥日誌包含獎勵信息
-        battle.battle_log = battle_result
-        battle.save()
+        Player.objects.filter(id=player.player_id).update(
+            gold=F('gold') + rewards['gold'],
+            exp_potion=F('exp_potion') + rewards['exp_potion']
+        )
         
-        player.save()
-        opponent.save()
+        if rewards['victory']:
+            # 更新玩家勝利任務進度
+            DailyQuestService.update_quest_progress(player.player, 'battle_win', 1)
+    
+    print(f"[Settle] battle_id={battle_id} 獎勵已發放: {rewards}")
+    return True
 
-        # ===== 上鏈存證（IPFS + 合約事件）=====
-        try:
-            print("==================== On-Chain Attestation Start ====================")
-            # 準備 JSON（確保可序列化）
-            result_json = json.dumps(battle_result, ensure_ascii=False).encode('utf-8')
-            # 計算 keccak256（與鏈上習慣對齊）
-            result_hash_hex = Web3.keccak(result_json).hex()
-            print(f"[OnChain] battle_id={battle.id}")
-            print(f"[OnChain] result_json_size={len(result_json)} bytes")
-            print(f"[OnChain] result_hash={result_hash_hex}")
-
-            # 上傳到 IPFS（沿用 Pinata 設定）
-            ipfs_cid = None
-            pinata_api_key = os.getenv('PINATA_API_KEY')
-            pinata_secret_key = os.getenv('PINATA_SECRET_KEY')
-            if pinata_api_key and pinata_secret_key:
-                print("[OnChain] Pinata 配置存在，開始上傳 JSON 到 IPFS...")
-                url = "https://api.pinata.cloud/pinning/pinJSONToIPFS"
-                headers = {
-                    "pinata_api_key": pinata_api_key,
-                    "pinata_secret_api_key": pinata_secret_key,
-                    "Content-Type": "application/json"
-                }
-                payload = {
-                    "pinataContent": battle_result,
-                    "pinataMetadata": {"name": f"battle_{battle.id}.json"}
-                }
-                resp = requests.post(url, json=payload, headers=headers, timeout=30)
-                if resp.status_code == 200:
-                    ipfs_cid = resp.json().get('IpfsHash')
-                    print(f"[OnChain] IPFS 上傳成功: cid={ipfs_cid} gateway=https://gateway.pinata.cloud/ipfs/{ipfs_cid}")
-                else:
-                    print(f"[OnChain] IPFS 上傳失敗: status={resp.status_code} body={resp.text}")
-            
-            # 先寫入 DB 狀態為 pending/sent 之前的準備
-            battle.onchain_status = 'pending'
-            battle.result_hash = result_hash_hex
-            if ipfs_cid:
-                battle.ipfs_cid = ipfs_cid
-            battle.save(update_fields=['onchain_status','result_hash','ipfs_cid'])
-            print(f"[OnChain] DB 更新: status=pending, result_hash/ ipfs_cid 已寫入")
-
-            # 送交易（僅骨架，合約位址/ABI/PK 由環境變數提供）
-            registry_address = os.getenv('BATTLE_REGISTRY_ADDRESS')
-            rpc_url = os.getenv('RPC_URL', 'https://rpc.sepolia.mantle.xyz')
-            private_key = os.getenv('WALLET_PRIVATE_KEY')
-            chain_id = int(os.getenv('CHAIN_ID', '5003'))
-            # 讀取合約 ABI：優先使用環境變數字串，否則讀取檔案（預設 onchain/artifacts/BattleRegistry.abi.json）
-            registry_abi = os.getenv('BATTLE_REGISTRY_ABI_JSON')
-            if not registry_abi:
-                abi_path = os.getenv('BATTLE_REGISTRY_ABI_PATH', os.path.join(os.path.dirname(__file__), 'contracts', 'BattleRegistry.abi.json'))
-                try:
-                    with open(abi_path, 'r', encoding='utf-8') as f:
-                        registry_abi = f.read()
-                    print(f"[OnChain] 從檔案載入 ABI: {abi_path}")
-                except Exception:
-                    registry_abi = None
-                    print("[OnChain] 無法載入 ABI 檔案，且未提供環境變數 BATTLE_REGISTRY_ABI_JSON")
-
-            if registry_address and private_key and registry_abi:
-                print(f"[OnChain] 開始送出交易 -> registry={registry_address}, rpc={rpc_url}, chain_id={chain_id}")
-                w3 = Web3(Web3.HTTPProvider(rpc_url))
-                account = w3.eth.account.from_key(private_key)
-                abi_obj = json.loads(registry_abi) if isinstance(registry_abi, str) else registry_abi
-                contract = w3.eth.contract(address=Web3.to_checksum_address(registry_address), abi=abi_obj)
-
-                # 對應參數：battleId(bytes32), fighter1, fighter2, winner, resultHash(bytes32), ipfsCid
-                battle_id_bytes32 = Web3.keccak(text=str(battle.id))
-                f1_addr = (battle.character1.player.wallet_address or '0x0000000000000000000000000000000000000000')
-                f2_addr = (battle.character2.player.wallet_address or '0x0000000000000000000000000000000000000000')
-                winner_addr = (battle.winner.player.wallet_address if battle.winner and battle.winner.player.wallet_address else '0x0000000000000000000000000000000000000000')
-                print(f"[OnChain] 參數: f1={f1_addr}, f2={f2_addr}, winner={winner_addr}")
-
-                # 將 result_hash_hex 轉 bytes32（使用 web3 轉換，避免型別不匹配）
-                result_hash_bytes32 = Web3.to_bytes(hexstr=result_hash_hex)
-                try:
-                    # 確認長度 32 bytes
-                    if len(result_hash_bytes32) != 32:
-                        raise ValueError(f"result_hash_bytes32 長度錯誤: {len(result_hash_bytes32)}")
-                except Exception as _e:
-                    print(f"[OnChain] result_hash 轉換檢查失敗: {_e}")
-
-                nonce = w3.eth.get_transaction_count(account.address)
-                call = contract.functions.recordBattle(
-                    battle_id_bytes32,
-                    Web3.to_checksum_address(f1_addr) if f1_addr.startswith('0x') else '0x0000000000000000000000000000000000000000',
-                    Web3.to_checksum_address(f2_addr) if f2_addr.startswith('0x') else '0x0000000000000000000000000000000000000000',
-                    Web3.to_checksum_address(winner_addr) if winner_addr.startswith('0x') else '0x0000000000000000000000000000000000000000',
-                    result_hash_bytes32,
-                    ipfs_cid or ''
-                )
 
-                # 估算 gas 並加 buffer
-                try:
-                    gas_estimate = call.estimate_gas({'from': account.address})
-                    print(f"[OnChain] Gas 估算: {gas_estimate}")
-                except Exception as ge:
-                    print(f"[OnChain] Gas 估算失敗，改用預設: {ge}")
-                    gas_estimate = 2_000_000
-
-                # Mantle/OP 鏈建議帶 EIP-1559 欄位
-                base_gas_price = w3.eth.gas_price
-                max_fee = int(base_gas_price * 2)
-                max_priority = int(base_gas_price * 0.5)
-
-                tx = call.build_transaction({
-                    'chainId': chain_id,
-                    'from': account.address,
-                    'gas': int(gas_estimate * 1.2),
-                    'maxFeePerGas': max_fee,
-                    'maxPriorityFeePerGas': max_priority,
-                    'nonce': nonce,
-                })
-                print(f"[OnChain] 構建交易完成: from={account.address}, nonce={nonce}, gas={tx.get('gas')}, maxFeePerGas={tx.get('maxFeePerGas')}, maxPriorityFeePerGas={tx.get('maxPriorityFeePerGas')}")
-
-                signed = w3.eth.account.sign_transaction(tx, private_key)
-                # web3.py v6 使用 raw_transaction；v5 為 rawTransaction
-                raw_tx = getattr(signed, 'raw_transaction', None) or getattr(signed, 'rawTransaction')
-                tx_hash = w3.eth.send_raw_transaction(raw_tx)
-                print(f"[OnChain] 交易已發送: tx_hash={tx_hash.hex()}")
-                battle.onchain_status = 'sent'
-                battle.onchain_tx_hash = tx_hash.hex()
-                battle.onchain_contract = registry_address
-                battle.save(update_fields=['onchain_status','onchain_tx_hash','onchain_contract'])
-                print(f"[OnChain] DB 更新: status=sent, tx={tx_hash.hex()}")
-
-                # 等待確認（縮短等待避免阻塞過久，可改為後續任務輪詢）
-                receipt = w3.eth.wait_for_transaction_receipt(tx_hash, timeout=60)
-                if receipt and receipt.status == 1:
-                    print(f"[OnChain] 交易確認成功: block={receipt.blockNumber}")
-                    battle.onchain_status = 'confirmed'
-                    battle.onchain_block_number = receipt.blockNumber
-                    try:
-                        block = w3.eth.get_block(receipt.blockNumber)
-                        from django.utils import timezone
-                        battle.onchain_timestamp = timezone.datetime.fromtimestamp(block.timestamp, tz=timezone.get_current_timezone())
-                    except Exception:
-                        pass
-                    battle.save(update_fields=['onchain_status','onchain_block_number','onchain_timestamp'])
-                else:
-                    print("[OnChain] 交易確認失敗或逾時，標記 failed")
-                    battle.onchain_status = 'failed'
-                    battle.save(update_fields=['onchain_status'])
+@shared_task
+def pin_battle_result_task(battle_id):
+    """階段三：計算結果雜湊並上傳 IPFS（已有 CID 時略過上傳）"""
+    battle = Battle.objects.get(id=battle_id)
+    if battle.status != 'COMPLETED':
+        return False
+    
+    try:
+        print("==================== On-Chain Attestation Start ====================")
+        battle_result = battle.battle_log
+        # 準備 JSON（確保可序列化）
+        result_json = json.dumps(battle_result, ensure_ascii=False).encode('utf-8')
+        # 計算 keccak256（與鏈上習慣對齊）
+        result_hash_hex = Web3.keccak(result_json).hex()
+        print(f"[OnChain] battle_id={battle.id}")
+        print(f"[OnChain] result_json_size={len(result_json)} bytes")
+        print(f"[OnChain] result_hash={result_hash_hex}")
+
+        # 上傳到 IPFS（沿用 Pinata 設定）
+        ipfs_cid = battle.ipfs_cid
+        pinata_api_key = os.getenv('PINATA_API_KEY')
+        pinata_secret_key = os.getenv('PINATA_SECRET_KEY')
+        if ipfs_cid:
+            print(f"[OnChain] 已有 IPFS CID，略過上傳: cid={ipfs_cid}")
+        elif pinata_api_key and pinata_secret_key:
+            print("[OnChain] Pinata 配置存在，開始上傳 JSON 到 IPFS...")
+            url = "https://api.pinata.cloud/pinning/pinJSONToIPFS"
+            headers = {
+                "pinata_api_key": pinata_api_key,
+                "pinata_secret_api_key": pinata_secret_key,
+                "Content-Type": "application/json"
+            }
+            payload = {
+                "pinataContent": battle_result,
+                "pinataMetadata": {"name": f"battle_{battle.id}.json"}
+            }
+            resp = requests.post(url, json=payload, headers=headers, timeout=30)
+            if resp.status_code == 200:
+                ipfs_cid = resp.json().get('IpfsHash')
+                print(f"[OnChain] IPFS 上傳成功: cid={ipfs_cid} gateway=https://gateway.pinata.cloud/ipfs/{ipfs_cid}")
             else:
-                # 未配置合約/金鑰，標記可後續補寫
-                print("[OnChain] 未配置 registry_address / private_key / abi，跳過送交易，狀態 pending")
-                battle.onchain_status = 'pending'
-                battle.onchain_error = 'Registry or keys not configured'
-                battle.save(update_fields=['onchain_status','onchain_error'])
+                print(f"[OnChain] IPFS 上傳失敗: status={resp.status_code} body={resp.text}")
+        
+        # 先寫入 DB 狀態為 pending/sent 之前的準備
+        update_fields = ['result_hash', 'ipfs_cid']
+        if not battle.onchain_status:
+            battle.onchain_status = 'pending'
+            update_fields.append('onchain_status')
+        battle.result_hash = result_hash_hex
+        battle.ipfs_cid = ipfs_cid
+        battle.save(update_fields=update_fields)
+        print(f"[OnChain] DB 更新: status={battle.onchain_status}, result_hash/ ipfs_cid 已寫入")
+        return True
+    except Exception as e:
+        print(f"[OnChain] 發生例外: {e}")
+        battle.onchain_status = 'failed'
+        battle.onchain_error = str(e)
+        battle.save(update_fields=['onchain_status','onchain_error'])
+        return False
+
+
+def get_battle_registry():
+    """讀取合約設定，回傳 (w3, contract, account, registry_address, private_key, chain_id)；未配置時回傳 None"""
+    # 送交易（僅骨架，合約位址/ABI/PK 由環境變數提供）
+    registry_address = os.getenv('BATTLE_REGISTRY_ADDRESS')
+    rpc_url = os.getenv('RPC_URL', 'https://rpc.sepolia.mantle.xyz')
+    private_key = os.getenv('WALLET_PRIVATE_KEY')
+    chain_id = int(os.getenv('CHAIN_ID', '5003'))
+    # 讀取合約 ABI：優先使用環境變數字串，否則讀取檔案（預設 onchain/artifacts/BattleRegistry.abi.json）
+    registry_abi = os.getenv('BATTLE_REGISTRY_ABI_JSON')
+    if not registry_abi:
+        abi_path = os.getenv('BATTLE_REGISTRY_ABI_PATH', os.path.join(os.path.dirname(__file__), 'contracts', 'BattleRegistry.abi.json'))
+        try:
+            with open(abi_path, 'r', encoding='utf-8') as f:
+                registry_abi = f.read()
+            print(f"[OnChain] 從檔案載入 ABI: {abi_path}")
+        except Exception:
+            registry_abi = None
+            print("[OnChain] 無法載入 ABI 檔案，且未提供環境變數 BATTLE_REGISTRY_ABI_JSON")
+
+    if not (registry_address and private_key and registry_abi):
+        return None
+
+    w3 = Web3(Web3.HTTPProvider(rpc_url))
+    account = w3.eth.account.from_key(private_key)
+    abi_obj = json.loads(registry_abi) if isinstance(registry_abi, str) else registry_abi
+    contract = w3.eth.contract(address=Web3.to_checksum_address(registry_address), abi=abi_obj)
+    print(f"[OnChain] 合約設定 -> registry={registry_address}, rpc={rpc_url}, chain_id={chain_id}")
+    return w3, contract, account, registry_address, private_key, chain_id
+
+
+@shared_task
+def submit_battle_tx_task(battle_id):
+    """階段四：送出 recordBattle 交易（已有 tx_hash 時略過，避免重複上鏈）"""
+    battle = Battle.objects.select_related(
+        'character1__player', 'character2__player', 'winner__player'
+    ).get(id=battle_id)
+    if battle.onchain_tx_hash or battle.onchain_status == 'confirmed':
+        print(f"[OnChain] battle_id={battle_id} 交易已送出，略過: tx={battle.onchain_tx_hash}")
+        return battle.onchain_tx_hash
+    if not battle.result_hash:
+        print(f"[OnChain] battle_id={battle_id} 尚未計算 result_hash，略過送交易")
+        return None
+
+    try:
+        registry = get_battle_registry()
+        if registry is None:
+            # 未配置合約/金鑰，標記可後續補寫
+            print("[OnChain] 未配置 registry_address / private_key / abi，跳過送交易，狀態 pending")
+            battle.onchain_status = 'pending'
+            battle.onchain_error = 'Registry or keys not configured'
+            battle.save(update_fields=['onchain_status','onchain_error'])
             print("==================== On-Chain Attestation End ======================")
-        except Exception as e:
-            print(f"[OnChain] 發生例外: {e}")
+            return None
+
+        w3, contract, account, registry_address, private_key, chain_id = registry
+
+        # 對應參數：battleId(bytes32), fighter1, fighter2, winner, resultHash(bytes32), ipfsCid
+        battle_id_bytes32 = Web3.keccak(text=str(battle.id))
+        f1_addr = (battle.character1.player.wallet_address or '0x0000000000000000000000000000000000000000')
+        f2_addr = (battle.character2.player.wallet_address or '0x0000000000000000000000000000000000000000')
+        winner_addr = (battle.winner.player.wallet_address if battle.winner and battle.winner.player.wallet_address else '0x0000000000000000000000000000000000000000')
+        print(f"[OnChain] 參數: f1={f1_addr}, f2={f2_addr}, winner={winner_addr}")
+
+        # 將 result_hash 轉 bytes32（使用 web3 轉換，避免型別不匹配）
+        result_hash_bytes32 = Web3.to_bytes(hexstr=battle.result_hash)
+        try:
+            # 確認長度 32 bytes
+            if len(result_hash_bytes32) != 32:
+                raise ValueError(f"result_hash_bytes32 長度錯誤: {len(result_hash_bytes32)}")
+        except Exception as _e:
+            print(f"[OnChain] result_hash 轉換檢查失敗: {_e}")
+
+        nonce = w3.eth.get_transaction_count(account.address)
+        call = contract.functions.recordBattle(
+            battle_id_bytes32,
+            Web3.to_checksum_address(f1_addr) if f1_addr.startswith('0x') else '0x0000000000000000000000000000000000000000',
+            Web3.to_checksum_address(f2_addr) if f2_addr.startswith('0x') else '0x0000000000000000000000000000000000000000',
+            Web3.to_checksum_address(winner_addr) if winner_addr.startswith('0x') else '0x0000000000000000000000000000000000000000',
+            result_hash_bytes32,
+            battle.ipfs_cid or ''
+        )
+
+        # 估算 gas 並加 buffer
+        try:
+            gas_estimate = call.estimate_gas({'from': account.address})
+            print(f"[OnChain] Gas 估算: {gas_estimate}")
+        except Exception as ge:
+            print(f"[OnChain] Gas 估算失敗，改用預設: {ge}")
+            gas_estimate = 2_000_000
+
+        # Mantle/OP 鏈建議帶 EIP-1559 欄位
+        base_gas_price = w3.eth.gas_price
+        max_fee = int(base_gas_price * 2)
+        max_priority = int(base_gas_price * 0.5)
+
+        tx = call.build_transaction({
+            'chainId': chain_id,
+            'from': account.address,
+            'gas': int(gas_estimate * 1.2),
+            'maxFeePerGas': max_fee,
+            'maxPriorityFeePerGas': max_priority,
+            'nonce': nonce,
+        })
+        print(f"[OnChain] 構建交易完成: from={account.address}, nonce={nonce}, gas={tx.get('gas')}, maxFeePerGas={tx.get('maxFeePerGas')}, maxPriorityFeePerGas={tx.get('maxPriorityFeePerGas')}")
+
+        signed = w3.eth.account.sign_transaction(tx, private_key)
+        # web3.py v6 使用 raw_transaction；v5 為 rawTransaction
+        raw_tx = getattr(signed, 'raw_transaction', None) or getattr(signed, 'rawTransaction')
+        tx_hash = w3.eth.send_raw_transaction(raw_tx)
+        print(f"[OnChain] 交易已發送: tx_hash={tx_hash.hex()}")
+        battle.onchain_status = 'sent'
+        battle.onchain_tx_hash = tx_hash.hex()
+        battle.onchain_contract = registry_address
+        battle.save(update_fields=['onchain_status','onchain_tx_hash','onchain_contract'])
+        print(f"[OnChain] DB 更新: status=sent, tx={tx_hash.hex()}")
+        return battle.onchain_tx_hash
+    except Exception as e:
+        print(f"[OnChain] 發生例外: {e}")
+        battle.onchain_status = 'failed'
+        battle.onchain_error = str(e)
+        battle.save(update_fields=['onchain_status','onchain_error'])
+        return None
+
+
+@shared_task(bind=True, max_retries=int(os.getenv('ONCHAIN_CONFIRM_MAX_RETRIES', 12)))
+def confirm_battle_tx_task(self, battle_id):
+    """階段五：輪詢交易收據，不阻塞 worker；尚未上鏈時以 retry 稍後再查"""
+    from web3.exceptions import TransactionNotFound
+
+    battle = Battle.objects.get(id=battle_id)
+    if battle.onchain_status != 'sent' or not battle.onchain_tx_hash:
+        return battle.onchain_status
+
+    rpc_url = os.getenv('RPC_URL', 'https://rpc.sepolia.mantle.xyz')
+    w3 = Web3(Web3.HTTPProvider(rpc_url))
+    try:
+        receipt = w3.eth.get_transaction_receipt(battle.onchain_tx_hash)
+    except TransactionNotFound:
+        receipt = None
+    except Exception as e:
+        print(f"[OnChain] 查詢收據失敗: {e}")
+        receipt = None
+
+    if receipt is None:
+        try:
+            raise self.retry(countdown=int(os.getenv('ONCHAIN_CONFIRM_INTERVAL', 10)))
+        except self.MaxRetriesExceededError:
+            print("[OnChain] 交易確認逾時，標記 failed")
             battle.onchain_status = 'failed'
-            battle.onchain_error = str(e)
+            battle.onchain_error = 'Receipt not found before confirmation deadline'
             battle.save(update_fields=['onchain_status','onchain_error'])
+            return battle.onchain_status
 
-    except Exception as e:
-        print(f"Error in run_battle_task for battle_id {battle_id}: {e}")
-        # 如果發生錯誤，更新戰鬥狀態
+    if receipt.status == 1:
+        print(f"[OnChain] 交易確認成功: block={receipt.blockNumber}")
+        battle.onchain_status = 'confirmed'
+        battle.onchain_block_number = receipt.blockNumber
         try:
-            battle = Battle.objects.get(id=battle_id)
-            battle.status = 'ERROR'
-            battle.battle_log = {'error': str(e)}
-            battle.save()
-        except Battle.DoesNotExist:
-            print(f"Battle with id {battle_id} not found when trying to log error.")
+            block = w3.eth.get_block(receipt.blockNumber)
+            battle.onchain_timestamp = timezone.datetime.fromtimestamp(block.timestamp, tz=timezone.get_current_timezone())
+        except Exception:
+            pass
+        battle.save(update_fields=['onchain_status','onchain_block_number','onchain_timestamp'])
+    else:
+        print("[OnChain] 交易執行失敗，標記 failed")
+        battle.onchain_status = 'failed'
+        battle.save(update_fields=['onchain_status'])
+    print("==================== On-Chain Attestation End ======================")
+    return battle.onchain_status
 
 
 
@@ -900,54 +766,63 @@ def cleanup_old_battles():
     return f"Cleaned up {count} old battles"
 
 
-@shared_task 
+@shared_task
+def scrape_node_metrics():
+    """定期抓取各節點的 /metrics，供選節點與後台顯示"""
+    from .node_metrics import scrape_nodes
+    updated = scrape_nodes()
+    return f"Scraped metrics from {updated} nodes"
+
+
+@shared_task
+def flush_node_heartbeats():
+    """把 Redis 中緩衝的節點心跳批次寫回資料庫"""
+    from .node_heartbeats import flush_heartbeats
+
+    flushed = flush_heartbeats()
+    if flushed:
+        print(f"[{timezone.now()}] 已寫回 {flushed} 個節點的心跳")
+    return f"Flushed {flushed} heartbeats"
+
+
+@shared_task
+def flush_node_stats():
+    """把本行程緩衝的節點請求統計寫回資料庫（其他行程由各自的背景執行緒定期寫回）"""
+    from .node_stats import recorder
+
+    flushed = recorder.flush()
+    if flushed:
+        print(f"[{timezone.now()}] 已寫回 {flushed} 個節點的請求統計")
+    return f"Flushed stats for {flushed} nodes"
+
+
+@shared_task
 def check_node_health():
     """定期檢查節點健康狀態，標記離線節點"""
+    from django.db.models import Q
     from .models import AINode
-    
+    from .node_heartbeats import flush_heartbeats
+
     print(f"[{timezone.now()}] 開始節點健康檢查...")
-    
-    # 找出超過5分鐘沒有心跳的節點
+
+    # 先寫回緩衝中的心跳，避免剛回報過的節點被誤判為逾時
+    flush_heartbeats()
+
+    # 超過5分鐘沒有心跳、或從未有心跳記錄的在線節點，以單一 UPDATE 標記為離線
     offline_threshold = timezone.now() - timedelta(minutes=5)
-    
-    # 獲取所有在線節點進行檢查
-    online_nodes = AINode.objects.filter(status='online')
-    total_online = online_nodes.count()
-    
-    print(f"[{timezone.now()}] 檢查 {total_online} 個在線節點...")
-    
-    # 更新狀態為offline的節點（原本是online但心跳超時的）
-    offline_nodes = online_nodes.filter(last_heartbeat__lt=offline_threshold)
-    
-    offline_count = 0
-    for node in offline_nodes:
-        print(f"[{timezone.now()}] 節點 {node.name} 心跳超時 (最後心跳: {node.last_heartbeat})")
-        node.status = 'offline'
-        node.save()
-        offline_count += 1
-    
-    # 找出沒有心跳記錄的節點也標記為離線
-    no_heartbeat_nodes = online_nodes.filter(last_heartbeat__isnull=True)
-    
-    no_heartbeat_count = 0
-    for node in no_heartbeat_nodes:
-        print(f"[{timezone.now()}] 節點 {node.name} 無心跳記錄")
-        node.status = 'offline'
-        node.save()
-        no_heartbeat_count += 1
-    
-    # 顯示當前所有節點狀態
-    all_nodes = AINode.objects.all()
-    for node in all_nodes:
-        status_info = f"節點 {node.name}: {node.status}"
-        if node.last_heartbeat:
-            time_diff = timezone.now() - node.last_heartbeat
-            status_info += f" (最後心跳: {time_diff.total_seconds():.0f}秒前)"
-        else:
-            status_info += " (無心跳記錄)"
-        print(f"[{timezone.now()}] {status_info}")
-    
-    total_marked_offline = offline_count + no_heartbeat_count
-    print(f"[{timezone.now()}] 健康檢查完成: 標記 {total_marked_offline} 個節點為離線")
-    
-    return f"Health check completed: {total_marked_offline} nodes marked offline" 
\ No newline at end of file
+    stale_nodes = AINode.objects.filter(status='online').filter(
+        Q(last_heartbeat__lt=offline_threshold) | Q(last_heartbeat__isnull=True)
+    )
+    stale_names = list(stale_nodes.values_list('name', flat=True)[:20])
+    total_marked_offline = stale_nodes.update(status='offline')
+
+    if total_marked_offline:
+        from .node_registry import invalidate_node_registry
+        invalidate_node_registry()
+        print(f"[{timezone.now()}] 心跳逾時的節點: {', '.join(stale_names)}"
+              f"{' ...' if total_marked_offline > len(stale_names) else ''}")
+
+    online_count = AINode.objects.filter(status='online').count()
+    print(f"[{timezone.now()}] 健康檢查完成: 標記 {total_marked_offline} 個節點為離線，目前在線 {online_count} 個")
+
+    return f"Health check completed: {total_marked_offline} nodes marked offline"
\ No newline at end of file
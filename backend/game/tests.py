@@ -1,3 +1,580 @@
-from django.test import TestCase
+import os
+import random
+import threading
+import time
+import unittest
+from datetime import timedelta
+from io import StringIO
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import DatabaseError
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from .battle_engine import INITIAL_HP, MAX_ROUNDS, battle_seed, matchup_payload, simulate_battle
+from .battle_verifier import (
+    ROUND_COUNT, WRONG_DAMAGE, WRONG_WINNER, needs_retry, repair_result, verify_result,
+)
+from .models import AINode, Battle, BattleResultBlob, BattleVotingRecord, Character, Player
+from .node_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreakerBoard
+from .node_heartbeats import DIRTY_KEY, HEARTBEATS_KEY, buffer_heartbeat, flush_heartbeats
+from .node_selection import InFlightTracker, select_nodes
+from .node_service import NodeManager, NodeRequestError
+from .win_probability import price_matchups
+
+
+def fighter(name, strength, agility, luck):
+    """引擎與勝率估算只讀屬性，不需要資料庫"""
+    return SimpleNamespace(
+        id=f'{name}-id', name=name, strength=strength, agility=agility, luck=luck,
+        prompt=f'{name} prompt', skill_description=f'{name} skill',
+    )
+
+
+def fleet(count, weight=1, capacity=4, latency=2.0):
+    return [
+        SimpleNamespace(
+            id=f'node-{i:02d}', weight=weight, max_concurrent_requests=capacity,
+            current_requests=0, last_heartbeat=None, avg_response_time=latency, ewma_response_time=0,
+        )
+        for i in range(count)
+    ]
+
+
+class BattleEngineTests(SimpleTestCase):
+    def test_same_seed_gives_same_battle(self):
+        a, b = fighter('A', 80, 60, 40), fighter('B', 70, 75, 55)
+        seed = battle_seed('3f0c8a52-0000-4000-8000-000000000001')
+        self.assertEqual(simulate_battle(a, b, seed), simulate_battle(a, b, seed))
+
+    def test_does_not_touch_global_rng(self):
+        a, b = fighter('A', 80, 60, 40), fighter('B', 70, 75, 55)
+        random.seed(1234)
+        expected = random.random()
+        random.seed(1234)
+        simulate_battle(a, b, 42)
+        self.assertEqual(random.random(), expected)
+
+    def test_log_replays_to_final_hp_and_winner(self):
+        """從初始血量逐筆扣除傷害，重播結果須與日誌、final_hp、勝者一致"""
+        matchups = [
+            (fighter('A', 90, 50, 30), fighter('B', 60, 80, 70)),  # 多半擊倒
+            (fighter('C', 10, 90, 50), fighter('D', 10, 90, 50)),  # 多半打滿回合
+        ]
+        endings = set()
+        for a, b in matchups:
+            for seed in range(100):
+                result = simulate_battle(a, b, seed)
+                hp = {a.id: INITIAL_HP, b.id: INITIAL_HP}
+                for i, entry in enumerate(result['battle_log']):
+                    self.assertGreaterEqual(entry['damage'], 0)
+                    # 有人倒下後不會再有任何出手
+                    self.assertTrue(all(value > 0 for value in hp.values()), f'seed {seed} 第 {i} 筆')
+                    hp[entry['defender']] = max(0, hp[entry['defender']] - entry['damage'])
+                    self.assertEqual(entry['remaining_hp'], hp[entry['defender']], f'seed {seed} 第 {i} 筆')
+                self.assertEqual(result['final_hp'], hp)
+                self.assertLessEqual(len(result['battle_log']), 2 * MAX_ROUNDS)
+
+                loser = b.id if result['winner'] == a.id else a.id
+                self.assertIn(result['winner'], hp)
+                if min(hp.values()) == 0:
+                    endings.add('knockout')
+                    self.assertEqual(hp[loser], 0)
+                    self.assertGreater(hp[result['winner']], 0)
+                else:
+                    # 回合用盡：血量高者勝，平手時任一方皆可
+                    endings.add('round_limit')
+                    self.assertEqual(len(result['battle_log']), 2 * MAX_ROUNDS)
+                    self.assertGreaterEqual(hp[result['winner']], hp[loser])
+        self.assertEqual(endings, {'knockout', 'round_limit'})
+
+
+AI_NODE_DIR = settings.BASE_DIR.parent / 'ai_node'
+
+
+@unittest.skipUnless(AI_NODE_DIR.is_dir(), 'ai_node 不在此部署中')
+class SharedModuleTests(SimpleTestCase):
+    """聚合器與節點各有一份的模組必須逐位元組相同（見各檔案開頭說明）"""
+
+    SHARED = ('battle_prompt.py', 'battle_verifier.py', 'llm_backend.py')
+
+    def test_copies_are_identical(self):
+        game_dir = Path(__file__).resolve().parent
+        for name in self.SHARED:
+            with self.subTest(name=name):
+                self.assertEqual(
+                    (game_dir / name).read_bytes(), (AI_NODE_DIR / name).read_bytes(),
+                    f'game/{name} 與 ai_node/{name} 不一致，修改時請同步兩份',
+                )
+
+
+class WinProbabilityTests(SimpleTestCase):
+    def test_price_matchups_matches_engine(self):
+        """向量化估算的勝率與逐場跑引擎的勝率差距在容許範圍內"""
+        matchups = [
+            (fighter('A', 80, 60, 40), fighter('B', 70, 75, 55)),
+            (fighter('C', 95, 40, 20), fighter('D', 50, 50, 50)),
+            (fighter('E', 60, 60, 60), fighter('F', 60, 60, 60)),
+        ]
+        battles = 2000
+        priced = price_matchups(matchups, simulations=4000, seed=7)
+        for (f1, f2), quote in zip(matchups, priced):
+            wins = sum(simulate_battle(f1, f2, seed)['winner'] == f1.id for seed in range(battles))
+            self.assertAlmostEqual(quote['fighter1_win_probability'], wins / battles, delta=0.05)
+            self.assertAlmostEqual(quote['fighter1_win_probability'] + quote['fighter2_win_probability'], 1.0)
+
+    def test_price_matchups_is_reproducible_with_seed(self):
+        matchups = [(fighter('A', 80, 60, 40), fighter('B', 70, 75, 55))]
+        self.assertEqual(price_matchups(matchups, seed=3), price_matchups(matchups, seed=3))
+
+
+class BattleVerifierTests(SimpleTestCase):
+    def setUp(self):
+        self.a, self.b = fighter('A', 80, 60, 40), fighter('B', 70, 75, 55)
+        self.engine = simulate_battle(self.a, self.b, 11)
+        self.matchup = matchup_payload(self.a, self.b, self.engine)
+
+    def narrated(self):
+        return {
+            'winner': self.engine['winner'],
+            'battle_log': [dict(entry, description=f"旁白 {i}") for i, entry in enumerate(self.engine['battle_log'])],
+            'battle_description': '一場激戰',
+        }
+
+    def test_accepts_result_matching_the_log(self):
+        self.assertEqual(verify_result(self.narrated(), self.matchup), [])
+
+    def test_repairs_numbers_and_winner(self):
+        result = self.narrated()
+        result['battle_log'][0]['damage'] += 7
+        result['winner'] = self.b.id if self.engine['winner'] == self.a.id else self.a.id
+        issues = verify_result(result, self.matchup)
+        self.assertEqual(set(issues), {WRONG_DAMAGE, WRONG_WINNER})
+        self.assertFalse(needs_retry(issues))
+
+        repaired = repair_result(result, self.matchup)
+        self.assertEqual(verify_result(repaired, self.matchup), [])
+        # 數值照固定日誌修正，敘事保留
+        self.assertEqual(repaired['battle_log'][0]['description'], '旁白 0')
+        self.assertEqual(repaired['battle_description'], '一場激戰')
+
+    def test_missing_rounds_ask_for_retry_and_are_filled_in(self):
+        result = self.narrated()
+        result['battle_log'] = result['battle_log'][:1]
+        issues = verify_result(result, self.matchup)
+        self.assertIn(ROUND_COUNT, issues)
+        self.assertTrue(needs_retry(issues))
+
+        repaired = repair_result(result, self.matchup)
+        self.assertEqual(verify_result(repaired, self.matchup), [])
+        self.assertEqual(len(repaired['battle_log']), len(self.engine['battle_log']))
+
+
+class RendezvousSelectionTests(SimpleTestCase):
+    def test_same_battle_gets_same_nodes(self):
+        nodes = fleet(10)
+        tracker = InFlightTracker()
+        first = select_nodes(nodes, 3, 'battle-1', tracker=tracker)
+        self.assertEqual(first, select_nodes(list(reversed(nodes)), 3, 'battle-1', tracker=tracker))
+
+    def test_removing_a_node_only_moves_its_battles(self):
+        nodes = fleet(10)
+        removed = nodes[4]
+        remaining = [node for node in nodes if node is not removed]
+        tracker = InFlightTracker()
+        moved = 0
+        for i in range(500):
+            before = [node.id for node in select_nodes(nodes, 3, f'battle-{i}', tracker=tracker)]
+            after = [node.id for node in select_nodes(remaining, 3, f'battle-{i}', tracker=tracker)]
+            if removed.id in before:
+                # 只有原本落在被移除節點的席位換人
+                self.assertEqual(len(set(before) & set(after)), 2)
+                moved += 1
+            else:
+                self.assertEqual(before, after)
+        self.assertGreater(moved, 0)
+
+    def test_retry_after_latency_and_health_changes_gets_same_nodes(self):
+        """延遲 EWMA 與節點指標在兩次請求之間變動，不影響重試時的節點分配"""
+        nodes = fleet(10)
+        for i, node in enumerate(nodes):
+            node.ewma_response_time = 1.0 + i * 0.3
+        tracker = InFlightTracker()
+        battles = [f'battle-{i}' for i in range(300)]
+        first = {battle: select_nodes(nodes, 3, battle, tracker=tracker) for battle in battles}
+
+        for i, node in enumerate(nodes):
+            node.ewma_response_time *= 1.1 if i % 2 else 0.9
+            node.metrics = {
+                'scraped_at': time.time(),
+                'window': {'attempts': 20, 'requests': 20, 'gemini_error_rate': 0.05 * (i % 3), 'rejections': i % 2},
+            }
+        for battle in battles:
+            self.assertEqual(select_nodes(nodes, 3, battle, tracker=tracker), first[battle])
+
+    def test_saturated_nodes_are_used_last(self):
+        nodes = fleet(5)
+        for node in nodes[:3]:
+            node.current_requests = node.max_concurrent_requests
+        tracker = InFlightTracker()
+        for i in range(50):
+            selected = [node.id for node in select_nodes(nodes, 3, f'battle-{i}', tracker=tracker)]
+            self.assertEqual({node.id for node in nodes[3:]}, set(selected[:2]))
+
+    def test_does_not_touch_global_rng(self):
+        random.seed(99)
+        expected = random.random()
+        random.seed(99)
+        select_nodes(fleet(6), 3, 'battle-x', tracker=InFlightTracker())
+        self.assertEqual(random.random(), expected)
+
+
+@override_settings(AI_NODE_BREAKER_FAILURES=3, AI_NODE_BREAKER_COOLDOWN=30, AI_NODE_BREAKER_MAX_COOLDOWN=300)
+class CircuitBreakerTests(SimpleTestCase):
+    """Redis 不可用時的行程內狀態（與 Redis 版本的狀態轉換相同）"""
+
+    def setUp(self):
+        patcher = mock.patch('game.node_breaker.get_redis', return_value=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.now = 1000.0
+        clock = mock.patch('game.node_breaker.time.time', side_effect=lambda: self.now)
+        clock.start()
+        self.addCleanup(clock.stop)
+        self.board = CircuitBreakerBoard()
+
+    def state(self):
+        return self.board.states(['n1'])['n1']['state']
+
+    def test_closed_open_half_open_closed(self):
+        for _ in range(2):
+            self.board.record('n1', success=False)
+        self.assertEqual(self.state(), CLOSED)
+
+        self.board.record('n1', success=False)
+        self.assertEqual(self.state(), OPEN)
+
+        self.now += 31
+        self.assertEqual(self.state(), HALF_OPEN)
+        # 同一時間只放行一個探測請求
+        self.assertTrue(self.board.acquire_probe('n1'))
+        self.assertFalse(self.board.acquire_probe('n1'))
+
+        self.board.record('n1', success=True)
+        self.assertEqual(self.state(), CLOSED)
+
+    def test_failed_probe_doubles_cooldown(self):
+        for _ in range(3):
+            self.board.record('n1', success=False)
+        self.now += 31
+        self.assertTrue(self.board.acquire_probe('n1'))
+        self.board.record('n1', success=False)
+        self.assertEqual(self.state(), OPEN)
+
+        self.now += 31
+        self.assertEqual(self.state(), OPEN)
+        self.now += 30
+        self.assertEqual(self.state(), HALF_OPEN)
+
+
+@mock.patch.dict(os.environ, {'LLM_BACKEND': 'stub', 'LLM_STUB_LATENCY': '0'})
+class RewardSettlementTests(TestCase):
+    def setUp(self):
+        # 沒有可用節點時走本地 stub 後端
+        patcher = mock.patch('game.tasks.NodeManager.get_available_nodes', return_value=[])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        player = Player.objects.create(user=User.objects.create(username='settle-test'))
+        self.player = player
+        self.character1 = Character.objects.create(
+            player=player, name='Hero', prompt='hero', strength=80, agility=60, luck=40, skill_description='slash',
+        )
+        self.character2 = Character.objects.create(
+            player=player, name='Rival', prompt='rival', strength=70, agility=75, luck=55, skill_description='dash',
+        )
+        self.battle = Battle.objects.create(character1=self.character1, character2=self.character2)
+
+    def run_battle(self):
+        from .tasks import run_battle_task
+        with self.captureOnCommitCallbacks() as callbacks:
+            run_battle_task(str(self.battle.id))
+        return callbacks
+
+    def test_rewards_are_paid_once(self):
+        from .tasks import settle_battle_rewards_task
+
+        gold = self.player.gold
+        callbacks = self.run_battle()
+        self.assertEqual(len(callbacks), 1)  # 提交後串接後續階段
+        self.battle.refresh_from_db()
+        self.assertEqual(self.battle.status, 'COMPLETED')
+        rewards = self.battle.battle_log['battle_rewards']
+
+        self.assertTrue(settle_battle_rewards_task(str(self.battle.id)))
+        # 後續階段重送、或 run_battle_task 重跑後再次串接，都不會重複發獎
+        self.assertFalse(settle_battle_rewards_task(str(self.battle.id)))
+        self.assertEqual(len(self.run_battle()), 1)
+        self.assertFalse(settle_battle_rewards_task(str(self.battle.id)))
+
+        self.player.refresh_from_db()
+        self.character1.refresh_from_db()
+        self.assertEqual(self.player.gold, gold + rewards['gold'])
+        self.assertEqual(self.character1.win_count + self.character1.loss_count, 1)
+
+    def test_unfinished_battle_is_not_settled(self):
+        from .tasks import settle_battle_rewards_task
+
+        self.assertFalse(settle_battle_rewards_task(str(self.battle.id)))
+        self.battle.refresh_from_db()
+        self.assertFalse(self.battle.rewards_settled)
+
+
+@override_settings(AI_NODE_EARLY_QUORUM=False, AI_NODE_MAX_HEDGES=0, AI_NODE_BATCHING=False)
+class RetryCacheTests(TestCase):
+    """重跑同一場戰鬥時送出相同的 (節點, battle_id, seed)，命中節點端以 (battle_id, seed) 為鍵的結果快取"""
+
+    def setUp(self):
+        for patcher in (mock.patch('game.node_breaker.get_redis', return_value=None),
+                        mock.patch.object(AINode, 'record_request')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        player = Player.objects.create(user=User.objects.create(username='retry-test'))
+        self.character1 = Character.objects.create(
+            player=player, name='Hero', prompt='hero', strength=80, agility=60, luck=40, skill_description='slash',
+        )
+        self.character2 = Character.objects.create(
+            player=player, name='Rival', prompt='rival', strength=70, agility=75, luck=55, skill_description='dash',
+        )
+        self.battle = Battle.objects.create(character1=self.character1, character2=self.character2)
+        self.nodes = [
+            AINode.objects.create(name=f'node-{i}', url=f'http://node-{i}.test', status='online')
+            for i in range(6)
+        ]
+
+    def run_consensus(self, node_cache, generated):
+        engine = simulate_battle(self.character1, self.character2, battle_seed(self.battle.id))
+        matchup = matchup_payload(self.character1, self.character2, engine)
+
+        def request_battle(node, payload, headers):
+            # 模擬節點的結果快取：鍵為 (battle_id, seed)
+            key = (node.id, payload['battle_id'], payload['seed'])
+            if key not in node_cache:
+                generated.append(key)
+                node_cache[key] = {
+                    'winner': engine['winner'],
+                    'battle_log': engine['battle_log'],
+                    'battle_description': '一場激戰',
+                }
+            return dict(node_cache[key])
+
+        manager = NodeManager()
+        with mock.patch.object(manager, 'get_available_nodes', return_value=list(self.nodes)), \
+                mock.patch.object(manager, 'request_battle', side_effect=request_battle):
+            result = manager.generate_battle_with_consensus_sync(self.battle, 'prompt', matchup=matchup)
+        self.assertEqual(str(result['winner']), str(engine['winner']))
+
+    def test_retry_hits_node_result_cache(self):
+        node_cache, generated = {}, []
+        self.run_consensus(node_cache, generated)
+        first = list(generated)
+        self.assertGreaterEqual(len(first), 3)
+        self.assertEqual({seed for _, _, seed in first}, {battle_seed(self.battle.id)})
+
+        # 任務重試：同樣的節點收到同樣的 battle_id 與 seed，全部命中快取，不再生成
+        self.run_consensus(node_cache, generated)
+        self.assertEqual(generated, first)
+
+
+class FakeRedis:
+    """心跳緩衝用到的 Redis 指令（集合與 hash）"""
+
+    def __init__(self):
+        self.sets, self.hashes = {}, {}
+
+    def pipeline(self, transaction=True):
+        return self
+
+    def execute(self):
+        return []
+
+    def hset(self, key, field, value):
+        self.hashes.setdefault(key, {})[field] = value
+
+    def hmget(self, key, fields):
+        return [self.hashes.get(key, {}).get(field) for field in fields]
+
+    def sadd(self, key, *members):
+        self.sets.setdefault(key, set()).update(members)
+
+    def spop(self, key, count):
+        members = self.sets.get(key, set())
+        return [members.pop() for _ in range(min(count, len(members)))]
+
+
+class HeartbeatFlushTests(TestCase):
+    def setUp(self):
+        self.redis = FakeRedis()
+        for patcher in (mock.patch('game.node_heartbeats.get_redis', return_value=self.redis),
+                        mock.patch('game.node_heartbeats.registry.is_online', return_value=True),
+                        mock.patch('game.node_heartbeats.mark_redis_down')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.nodes = [
+            AINode.objects.create(name=f'node-{i}', url=f'http://node-{i}.test', status='online')
+            for i in range(3)
+        ]
+        for node in self.nodes:
+            buffer_heartbeat(str(node.id), {'current_requests': 2})
+
+    def test_flush_writes_heartbeats(self):
+        self.assertEqual(flush_heartbeats(), 3)
+        self.assertEqual(self.redis.sets[DIRTY_KEY], set())
+        for node in self.nodes:
+            node.refresh_from_db()
+            self.assertIsNotNone(node.last_heartbeat)
+            self.assertEqual(node.current_requests, 2)
+
+    def test_failed_db_write_keeps_nodes_dirty(self):
+        from .node_heartbeats import mark_redis_down
+
+        with mock.patch.object(AINode.objects, 'bulk_update', side_effect=DatabaseError('db down')):
+            with self.assertRaises(DatabaseError):
+                flush_heartbeats()
+        # 資料庫失敗不是 Redis 失敗：不停用 Redis，已取出的節點放回待寫集合
+        mark_redis_down.assert_not_called()
+        self.assertEqual(self.redis.sets[DIRTY_KEY], {str(node.id) for node in self.nodes})
+        self.assertEqual(len(self.redis.hashes[HEARTBEATS_KEY]), 3)
+
+        self.assertEqual(flush_heartbeats(), 3)
+        for node in self.nodes:
+            node.refresh_from_db()
+            self.assertIsNotNone(node.last_heartbeat)
+
+
+@override_settings(AI_NODE_MAX_HEDGES=0, AI_NODE_BATCHING=False, MIN_CONSENSUS_NODES=3)
+class ConsensusVotingTests(TestCase):
+    """共識多數決與投票記錄寫入"""
+
+    def setUp(self):
+        for patcher in (mock.patch('game.node_breaker.get_redis', return_value=None),
+                        mock.patch.object(AINode, 'record_request')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        player = Player.objects.create(user=User.objects.create(username='consensus-test'))
+        self.character1 = Character.objects.create(
+            player=player, name='Hero', prompt='hero', strength=80, agility=60, luck=40, skill_description='slash',
+        )
+        self.character2 = Character.objects.create(
+            player=player, name='Rival', prompt='rival', strength=70, agility=75, luck=55, skill_description='dash',
+        )
+        self.battle = Battle.objects.create(character1=self.character1, character2=self.character2)
+        self.nodes = [
+            AINode.objects.create(name=f'node-{i}', url=f'http://node-{i}.test', status='online')
+            for i in range(8)
+        ]
+
+    def run_consensus(self):
+        """5 個計畫票中 2 個失敗、其餘 2:1，兩種模式的多數決分母不同"""
+        winners = [self.character1.id, self.character1.id, self.character2.id]
+        lock = threading.Lock()
+
+        def request_battle(node, payload, headers):
+            with lock:
+                winner = winners.pop() if winners else None
+            if winner is None:
+                raise NodeRequestError('generation failed', status_code=500)
+            return {'winner': str(winner), 'battle_log': [], 'battle_description': ''}
+
+        manager = NodeManager()
+        with mock.patch.object(manager, 'get_available_nodes', return_value=list(self.nodes)), \
+                mock.patch.object(manager, 'request_battle', side_effect=request_battle):
+            result = manager.generate_battle_with_consensus_sync(self.battle, 'prompt')
+        self.assertEqual(manager.last_consensus_stats['planned_votes'], 5)
+        return manager, result
+
+    @override_settings(AI_NODE_EARLY_QUORUM=False)
+    def test_without_early_quorum_majority_of_valid_votes(self):
+        manager, result = self.run_consensus()
+        self.assertEqual(result['winner'], str(self.character1.id))
+        # 與非同步版本（等待所有節點）的判定一致
+        votes = list(self.battle.voting_records.all())
+        self.assertEqual(len(votes), 3)
+        self.assertEqual(
+            manager.determine_consensus_result(votes, str(self.character1.id), str(self.character2.id)),
+            result,
+        )
+
+    @override_settings(AI_NODE_EARLY_QUORUM=True)
+    def test_early_quorum_needs_majority_of_planned_votes(self):
+        _, result = self.run_consensus()
+        self.assertIsNone(result)
+
+    def vote(self, node, winner):
+        result = {'winner': str(winner.id), 'battle_log': [], 'battle_description': ''}
+        return BattleVotingRecord(
+            battle=self.battle, node=node, voted_winner_id=str(winner.id),
+            result_blob=BattleResultBlob.for_result(result), response_time=1.0,
+        )
+
+    def test_rerun_skips_existing_votes(self):
+        manager = NodeManager()
+        self.assertEqual(manager.save_voting_records([self.vote(node, self.character1) for node in self.nodes[:3]]), 3)
+        with self.assertLogs('game.node_service', 'WARNING') as logs:
+            saved = manager.save_voting_records([self.vote(node, self.character2) for node in self.nodes[:4]])
+        self.assertEqual(saved, 1)
+        self.assertIn('Skipped 3 duplicate votes', logs.output[0])
+        self.assertEqual(self.battle.voting_records.count(), 4)
+        self.assertEqual(self.battle.voting_records.filter(voted_winner_id=str(self.character1.id)).count(), 3)
+
+    def test_concurrent_duplicate_falls_back_to_single_inserts(self):
+        manager = NodeManager()
+        manager.save_voting_records([self.vote(self.nodes[0], self.character1)])
+        # 模擬並行重跑：檢查時尚未看到另一個行程剛寫入的票，整批寫入違反唯一約束
+        with mock.patch.object(BattleVotingRecord.objects, 'filter') as existing:
+            existing.return_value.values_list.return_value = []
+            saved = manager.save_voting_records([self.vote(node, self.character2) for node in self.nodes[:3]])
+        self.assertEqual(saved, 2)
+        self.assertEqual(self.battle.voting_records.count(), 3)
+
+
+class CompactBattleResultsTests(TestCase):
+    def setUp(self):
+        player = Player.objects.create(user=User.objects.create(username='compact-test'))
+        character1 = Character.objects.create(
+            player=player, name='Hero', prompt='hero', strength=80, agility=60, luck=40, skill_description='slash',
+        )
+        character2 = Character.objects.create(
+            player=player, name='Rival', prompt='rival', strength=70, agility=75, luck=55, skill_description='dash',
+        )
+        self.battle = Battle.objects.create(character1=character1, character2=character2)
+        self.node = AINode.objects.create(name='node', url='http://node.test', status='online')
+
+    def blob(self, winner, age_hours):
+        blob = BattleResultBlob.for_result({'winner': winner})
+        blob.save()
+        BattleResultBlob.objects.filter(hash=blob.hash).update(created_at=timezone.now() - timedelta(hours=age_hours))
+        return blob
+
+    def test_gc_deletes_only_old_unreferenced_blobs(self):
+        used = self.blob('used', 48)
+        BattleVotingRecord.objects.create(
+            battle=self.battle, node=self.node, voted_winner_id='used', result_blob=used, response_time=1.0,
+        )
+        orphan = self.blob('orphan', 48)
+        fresh = self.blob('fresh', 0)  # 剛寫入、投票尚未寫入的內容
+
+        call_command('compact_battle_results', '--gc', '--dry-run', stdout=StringIO())
+        self.assertEqual(BattleResultBlob.objects.count(), 3)
+
+        call_command('compact_battle_results', '--gc', '--batch-size', '1', stdout=StringIO())
+        self.assertEqual(
+            set(BattleResultBlob.objects.values_list('hash', flat=True)), {used.hash, fresh.hash},
+        )
+        self.assertFalse(BattleResultBlob.objects.filter(hash=orphan.hash).exists())
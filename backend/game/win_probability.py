@@ -0,0 +1,125 @@
+# 勝率估算：以 NumPy 向量化蒙地卡羅模擬，計算天梯對戰的勝率與開盤賠率
+from decimal import Decimal
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from .battle_engine import (
+    INITIAL_HP, MAX_ROUNDS, MAX_HIT, CRIT_MULTIPLIER, LUCK_SWING, INITIATIVE_EDGE,
+    combat_profile,
+)
+
+DEFAULT_SIMULATIONS = 2000
+
+# 與下注後動態賠率相同的上下限
+MIN_ODDS = Decimal('1.1')
+MAX_ODDS = Decimal('10.0')
+
+
+def _profile_arrays(matchups: Sequence[Tuple]) -> dict:
+    """將對戰組合轉為 (M, 2) 的參數陣列，索引 0 為 fighter1、1 為 fighter2"""
+    rows = [
+        (combat_profile(f1, f2), combat_profile(f2, f1))
+        for f1, f2 in matchups
+    ]
+    arrays = {
+        key: np.array([[p1[key], p2[key]] for p1, p2 in rows], dtype=np.float64)
+        for key in ('dmg_low', 'dmg_high', 'crit', 'dodge', 'luck')
+    }
+    agility = np.array([[f1.agility, f2.agility] for f1, f2 in matchups], dtype=np.float64)
+    arrays['p_first'] = np.where(
+        agility[:, 0] > agility[:, 1], INITIATIVE_EDGE,
+        np.where(agility[:, 0] < agility[:, 1], 1 - INITIATIVE_EDGE, 0.5)
+    )
+    return arrays
+
+
+def win_probabilities(matchups: Sequence[Tuple], simulations: int = DEFAULT_SIMULATIONS,
+                      seed: Optional[int] = None) -> np.ndarray:
+    """
+    一次向量化模擬所有對戰組合，回傳每組 fighter1 的勝率。
+    規則與 battle_engine.simulate_battle 相同：傷害區間 + 0~2 微隨機、暴擊、閃避、
+    全場一次的幸運意外、單次傷害上限，以及回合用盡時以剩餘血量判定勝負。
+    """
+    if not matchups:
+        return np.zeros(0)
+
+    rng = np.random.default_rng(seed)
+    params = _profile_arrays(matchups)
+    m, n = len(matchups), simulations
+
+    # 參數保持 (M, 1)，與 (M, N) 的隨機數直接廣播
+    def side(key, s):
+        return params[key][:, s:s + 1]
+
+    low = (side('dmg_low', 0), side('dmg_low', 1))
+    span = (side('dmg_high', 0) - low[0] + 1, side('dmg_high', 1) - low[1] + 1)
+    crit = (side('crit', 0), side('crit', 1))
+    dodge = (side('dodge', 0), side('dodge', 1))
+    luck = (side('luck', 0), side('luck', 1))
+    p_first = params['p_first'][:, None]
+
+    hp = np.full((2, m, n), INITIAL_HP, dtype=np.float64)
+    luck_used = np.zeros((m, n), dtype=bool)
+
+    for _ in range(MAX_ROUNDS):
+        if not ((hp[0] > 0) & (hp[1] > 0)).any():
+            break
+        fighter1_first = rng.random((m, n)) < p_first
+        for step in (0, 1):
+            alive = (hp[0] > 0) & (hp[1] > 0)
+            # 本次出手的一方：先手者於 step 0 出手
+            attacker_is_1 = fighter1_first if step == 0 else ~fighter1_first
+            # 一次取出本次出手所需的全部隨機數：傷害、微隨機、暴擊、幸運、幸運偏移、閃避
+            u = rng.random((6, m, n))
+
+            damage = (np.where(attacker_is_1, low[0], low[1])
+                      + np.floor(u[0] * np.where(attacker_is_1, span[0], span[1]))
+                      + np.floor(u[1] * 3))
+            is_crit = u[2] < np.where(attacker_is_1, crit[0], crit[1])
+            damage = np.where(is_crit, damage * CRIT_MULTIPLIER, damage)
+
+            lucky = ~luck_used & (u[3] < np.where(attacker_is_1, luck[0], luck[1]))
+            damage = np.where(lucky, damage * (1 + LUCK_SWING * (2 * u[4] - 1)), damage)
+
+            damage = np.clip(np.rint(damage), 1, MAX_HIT)
+            dodged = u[5] < np.where(attacker_is_1, dodge[1], dodge[0])
+            hit = alive & ~dodged
+            damage = np.where(hit, damage, 0)
+            # 閃避時不消耗幸運意外
+            luck_used |= lucky & hit
+
+            hp[1] = np.where(attacker_is_1, np.maximum(0, hp[1] - damage), hp[1])
+            hp[0] = np.where(attacker_is_1, hp[0], np.maximum(0, hp[0] - damage))
+
+    # 血量先歸零者輸；回合用盡則血量高者勝，平手各半
+    fighter1_wins = (hp[1] <= 0) | ((hp[0] > 0) & (hp[0] > hp[1]))
+    ties = (hp[0] > 0) & (hp[1] > 0) & (hp[0] == hp[1])
+    wins = fighter1_wins.sum(axis=1) + 0.5 * ties.sum(axis=1)
+    return wins / n
+
+
+def fair_odds(probability: float) -> Tuple[Decimal, Decimal]:
+    """以勝率換算雙方的公平賠率（1 / p），並套用賠率上下限"""
+    def to_odds(p):
+        if p <= 0:
+            return MAX_ODDS
+        odds = Decimal(str(round(1.0 / p, 2)))
+        return max(MIN_ODDS, min(MAX_ODDS, odds))
+    return to_odds(probability), to_odds(1.0 - probability)
+
+
+def price_matchups(matchups: Sequence[Tuple], simulations: int = DEFAULT_SIMULATIONS,
+                   seed: Optional[int] = None) -> List[dict]:
+    """批量估算多組對戰的勝率與開盤賠率"""
+    probabilities = win_probabilities(matchups, simulations=simulations, seed=seed)
+    priced = []
+    for p in probabilities:
+        odds1, odds2 = fair_odds(float(p))
+        priced.append({
+            'fighter1_win_probability': float(p),
+            'fighter2_win_probability': 1.0 - float(p),
+            'fighter1_odds': odds1,
+            'fighter2_odds': odds2,
+        })
+    return priced